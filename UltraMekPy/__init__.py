@@ -21,4 +21,19 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
-from . import client, parsers, boards
+# submodules are imported on first access (UltraMekPy.client), so that
+# importing the package or one of its modules does not import all the others
+SUBMODULES = ("batch", "benchmark", "boards", "client", "cluster", "constants", "data", "events",
+              "functions", "game", "journal", "logs", "metrics", "parsers", "player", "replay",
+              "requests", "rolls", "schema", "server", "sessions", "udp", "wire")
+__all__ = list(SUBMODULES)
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        # __import__ instead of importlib.import_module, so that -X importtime reports it
+        __import__(f"{__name__}.{name}")
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
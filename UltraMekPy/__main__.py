@@ -21,25 +21,132 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+import argparse
+import asyncio
+import atexit
 import json
+import os
+import signal
 import socketserver
 import socket
 
+from . import boards
+from . import logs
+from . import metrics
 from . import server
 from . import game
+from . import journal
+from . import replay
+from . import requests as req
+from . import udp
+
+TCP_MODE = "tcp"
+THREADED_MODE = "threaded"
+ASYNC_MODE = "async"
+MODES = (TCP_MODE, THREADED_MODE, ASYNC_MODE)
 
 with open("UltraMekPy/config.json",'r') as conf:
-    conn_dict = json.load(conf)['connection']
+    config = json.load(conf)
+conn_dict = config['connection']
+log_dict = config.get('logging', {})
+metrics_dict = config.get('metrics', {})
+journal_dict = config.get('journal', {})
+board_dict = config.get('board_cache', {})
+
+parser = argparse.ArgumentParser(prog="UltraMekPy", description="UltraMek game server")
+parser.add_argument("--mode", choices=MODES, default=conn_dict.get('mode', TCP_MODE),
+                    help="tcp: one request per connection, threaded: one thread per connection, "
+                         "async: persistent pipelined connections")
+parser.add_argument("--ip", default=conn_dict['ip'])
+parser.add_argument("--port", type=int, default=conn_dict['port'])
+parser.add_argument("--workers", type=int, default=conn_dict.get('workers', 1),
+                    help="number of worker processes sharing the port (async mode only)")
+parser.add_argument("--internal-port", type=int, default=conn_dict.get('internal_port'),
+                    help="first localhost port the workers use to forward requests")
+parser.add_argument("--udp-port", type=int, default=conn_dict.get('udp_port'),
+                    help="also listen for small requests (hover, heartbeat, dice rolls) on this UDP port")
+parser.add_argument("--journal-dir", default=journal_dict.get('directory'),
+                    help="directory the games are journaled to and recovered from on restart")
+parser.add_argument("--board-cache-dir", default=board_dict.get('directory'),
+                    help="directory of the compiled boards shared by all server processes (empty: no compiling)")
+parser.add_argument("--record", default=None,
+                    help="records the requests and game seeds to this file, see python -m UltraMekPy.replay")
+parser.add_argument("--log-level", default=log_dict.get('level', logs.LEVEL),
+                    help="DEBUG logs (sampled, truncated) requests and answers")
+parser.add_argument("--log-file", default=log_dict.get('file'))
+parser.add_argument("--stats-file", default=metrics_dict.get('dump_file'),
+                    help="file the request statistics are dumped to periodically")
+parser.add_argument("--stats-interval", type=float, default=metrics_dict.get('dump_interval', 60.))
+args = parser.parse_args()
+
+logs.setup_logging(args.log_level, args.log_file,
+                   max_payload=log_dict.get('max_payload', logs.MAX_PAYLOAD),
+                   sample_rate=log_dict.get('sample_rate', logs.SAMPLE_RATE))
+if args.board_cache_dir:
+    req.BoardRequest.cache.binary_cache = boards.BinaryBoardCache(args.board_cache_dir)
 
+def setup_worker(worker_id=None):
+    """
+    Recovers the games from the journal, starts recording and dumping
+    the statistics and returns the function which closes them.
+    """
+    closers = []
+    if args.stats_file is not None:
+        # every worker dumps its own statistics
+        filename = args.stats_file if worker_id is None else f"{args.stats_file}.worker{worker_id}"
+        metrics.metrics.start_dump(filename, args.stats_interval)
+        closers.append(metrics.metrics.stop_dump)
+    if config.get(server.REQUEST_MODULES_KEY):
+        req.reload_processors(config[server.REQUEST_MODULES_KEY])
+    if args.journal_dir is not None:
+        directory = args.journal_dir
+        if worker_id is not None:
+            directory = os.path.join(directory, f"worker{worker_id}")
+        game_journal = journal.Journal(directory, journal_dict.get('snapshot_every', journal.SNAPSHOT_EVERY))
+        game_journal.recover(server.session_registry, lambda filename: req.BoardRequest.cache.get(filename).board)
+        game_journal.start()
+        closers.append(game_journal.close)
+    if args.record is not None:
+        # recovered games are not recorded, a recording starts with new games
+        filename = args.record if worker_id is None else f"{args.record}.worker{worker_id}"
+        server.session_registry.recorder = replay.Recorder(filename)
+        closers.append(server.session_registry.recorder.close)
+    def close():
+        for closer in closers:
+            closer()
+    return close
 
-host, port = conn_dict['ip'], conn_dict['port']
-with socketserver.TCPServer((host,port), server.UltraMekHandler) as server:
+host, port = args.ip, args.port
+if args.udp_port is not None and args.workers > 1:
+    parser.error("UDP is not supported with several workers")
+if args.udp_port is not None and args.mode != ASYNC_MODE:
+    udp.UDPServer(host, args.udp_port).start_thread()
+
+sharded = args.mode == ASYNC_MODE and args.workers > 1
+if not sharded:
+    # SIGHUP reloads the config (the workers of sharded servers handle it themselves)
+    signal.signal(signal.SIGHUP, server.handle_reload_signal)
+    atexit.register(setup_worker())
+
+if sharded:
+    from . import cluster
+    cluster.serve_sharded(host, port, args.workers, args.internal_port, setup_worker)
+elif args.mode == ASYNC_MODE:
+    async def serve():
+        if args.udp_port is not None:
+            await udp.UDPServer(host, args.udp_port).start()
+        await server.AsyncUltraMekServer(host, port).serve_forever()
+    asyncio.run(serve())
+elif args.mode == THREADED_MODE:
+    with server.ThreadedUltraMekServer((host,port), server.UltraMekHandler) as tcp_server:
+        tcp_server.serve_forever(poll_interval=0.5)
+else:
+    with socketserver.TCPServer((host,port), server.UltraMekHandler) as tcp_server:
         # Activate the server; this will keep running until you
         # interrupt the program with Ctrl-C
         #sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         #server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.allow_reuse_address=True
-        server.serve_forever(poll_interval=0.5)
-        server.request_queue_size=40
-        server.timeout = None
-
+        tcp_server.allow_reuse_address=True
+        tcp_server.serve_forever(poll_interval=0.5)
+        tcp_server.request_queue_size=40
+        tcp_server.timeout = None
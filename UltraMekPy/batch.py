@@ -0,0 +1,204 @@
+"""
+batch.py - Classes and Tools for executing batches of dependent requests
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+import contextvars
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .constants import ERROR_KEY
+
+ID_KEY = "id"
+AFTER_KEY = "after"
+DEPENDENCY_FAILED_MSG = "Error: Dependency {} failed!"
+
+class BatchError(ValueError):
+    pass
+
+class BatchExecutor:
+    """
+    Executes a batch of requests on a pool of worker threads.
+    Every entry of a batch is a request dictionary with an optional id
+    (default: its position) and an optional list of ids it has to run after.
+    Entries without pending dependencies run concurrently, the results
+    are returned in the order of the batch.
+    """
+    MAX_WORKERS = 8
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self._pool = None
+        self.lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self.lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="batch")
+            return self._pool
+
+    @staticmethod
+    def get_dependencies(entries):
+        """
+        Returns the ids of the entries and their dependencies and checks
+        that ids are unique, dependencies exist and have no cycles.
+        The ids are normalized to strings, so 1 and "1" are the same id.
+        """
+        ids = [str(entry.get(ID_KEY, k)) for k, entry in enumerate(entries)]
+        if len(set(ids)) != len(ids):
+            raise BatchError("Error: Ids of batch entries are not unique!")
+        dependencies = {}
+        for ID, entry in zip(ids, entries):
+            after = entry.get(AFTER_KEY, [])
+            if isinstance(after, (str, int)):
+                after = [after]
+            after = {str(a) for a in after}
+            unknown = after.difference(ids)
+            if unknown:
+                raise BatchError(f"Error: Unknown dependencies {sorted(unknown)} of {ID}!")
+            dependencies[ID] = after
+
+        # Kahn's algorithm, everything left over lies on a cycle
+        remaining = {ID: set(after) for ID, after in dependencies.items()}
+        ready = [ID for ID, after in remaining.items() if not after]
+        while ready:
+            done = ready.pop()
+            del remaining[done]
+            for ID, after in remaining.items():
+                if done in after:
+                    after.discard(done)
+                    if not after:
+                        ready.append(ID)
+        if remaining:
+            raise BatchError(f"Error: Cyclic dependencies between {sorted(remaining)}!")
+        return ids, dependencies
+
+    @staticmethod
+    def strip_entry(entry):
+        return {key: val for key, val in entry.items() if key not in (ID_KEY, AFTER_KEY)}
+
+    def run(self, entries, process):
+        """
+        Runs process on every entry (without id and after) and returns
+        a list of answers {id: ..., <results of process>} or
+        {id: ..., ERROR: ...} in the order of entries. The answers carry
+        the ids as they were sent.
+        """
+        ids, dependencies = self.get_dependencies(entries)
+        requests = {ID: self.strip_entry(entry) for ID, entry in zip(ids, entries)}
+        results = {}
+        failed = set()
+        running = {}
+        while len(results) < len(ids):
+            for ID in ids:
+                if ID in results or ID in running.values():
+                    continue
+                after = dependencies[ID]
+                broken = after.intersection(failed)
+                if broken:
+                    results[ID] = {ERROR_KEY: DEPENDENCY_FAILED_MSG.format(sorted(broken)[0])}
+                    failed.add(ID)
+                elif after.issubset(results):
+                    # copy the context, so the entries keep the correlation id for logging
+                    context = contextvars.copy_context()
+                    running[self.pool.submit(context.run, process, requests[ID])] = ID
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                ID = running.pop(future)
+                try:
+                    results[ID] = future.result()
+                except Exception as err:
+                    results[ID] = {ERROR_KEY: str(err)}
+                    failed.add(ID)
+
+        answers = []
+        for k, (ID, entry) in enumerate(zip(ids, entries)):
+            answer = {ID_KEY: entry.get(ID_KEY, k)}
+            answer.update(results[ID])
+            answers.append(answer)
+        return answers
+
+
+##########################################################
+# Tests
+#########################################################
+
+class BatchExecutorTests(unittest.TestCase):
+    """
+    Tests for the BatchExecutor class.
+    """
+    def setUp(self):
+        self.executor = BatchExecutor(4)
+        self.started = {}
+        self.finished = {}
+
+    def process(self, request):
+        ID = request["TEST"]
+        self.started[ID] = time.monotonic()
+        time.sleep(0.05)
+        if ID == "bad":
+            raise KeyError("bad")
+        self.finished[ID] = time.monotonic()
+        return {"TEST": ID}
+
+    def test_get_dependencies(self):
+        ids, deps = BatchExecutor.get_dependencies([{ID_KEY:"a"},{ID_KEY:"b",AFTER_KEY:["a"]},{}])
+        self.assertEqual(ids, ["a","b","2"])
+        self.assertEqual(deps, {"a":set(),"b":{"a"},"2":set()})
+        with self.assertRaises(BatchError):
+            BatchExecutor.get_dependencies([{ID_KEY:"a"},{ID_KEY:"a"}])
+        with self.assertRaises(BatchError):
+            BatchExecutor.get_dependencies([{ID_KEY:"a",AFTER_KEY:["c"]}])
+        with self.assertRaises(BatchError):
+            BatchExecutor.get_dependencies([{ID_KEY:"a",AFTER_KEY:["b"]},{ID_KEY:"b",AFTER_KEY:"a"}])
+
+    def test_run(self):
+        entries = [{ID_KEY:"init",AFTER_KEY:["p1","p2"],"TEST":"init"},
+                   {ID_KEY:"board","TEST":"board"},
+                   {ID_KEY:"p1","TEST":"p1"},
+                   {ID_KEY:"p2","TEST":"p2"}]
+        start = time.monotonic()
+        answers = self.executor.run(entries, self.process)
+        self.assertLess(time.monotonic() - start, 0.15)
+        self.assertEqual([a[ID_KEY] for a in answers], ["init","board","p1","p2"])
+        self.assertEqual([a["TEST"] for a in answers], ["init","board","p1","p2"])
+        self.assertGreaterEqual(self.started["init"], max(self.finished["p1"], self.finished["p2"]))
+
+    def test_run_ids(self):
+        entries = [{ID_KEY:1,"TEST":"p1"},
+                   {ID_KEY:"init",AFTER_KEY:1,"TEST":"init"},
+                   {"TEST":"board"}]
+        answers = self.executor.run(entries, self.process)
+        self.assertEqual([a[ID_KEY] for a in answers], [1,"init",2])
+        self.assertGreaterEqual(self.started["init"], self.finished["p1"])
+
+    def test_run_failure(self):
+        entries = [{ID_KEY:"bad","TEST":"bad"},
+                   {ID_KEY:"next",AFTER_KEY:["bad"],"TEST":"next"},
+                   {ID_KEY:"other","TEST":"other"}]
+        answers = self.executor.run(entries, self.process)
+        self.assertEqual(answers[0][ERROR_KEY], "'bad'")
+        self.assertEqual(answers[1][ERROR_KEY], DEPENDENCY_FAILED_MSG.format("bad"))
+        self.assertNotIn("next", self.started)
+        self.assertEqual(answers[2]["TEST"], "other")
@@ -0,0 +1,377 @@
+"""
+benchmark.py - Load generation and end to end benchmarks for the server
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Usage (from the repository root):
+    python -m UltraMekPy.benchmark --mode async --clients 32 --requests 200
+Starts the server with python -m UltraMekPy, lets the simulated clients send
+a scripted mix of requests and writes the results as JSON file.
+    python -m UltraMekPy.benchmark --import-time
+measures how long importing the package and its entry points takes instead.
+    python -m UltraMekPy.benchmark --board-parse
+measures the parse throughput of a large generated board.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import unittest
+from collections import defaultdict
+
+from .constants import ERROR_KEY
+from .metrics import Histogram
+from . import client
+
+SAMPLES_PATH = os.path.join("test","samples")
+BOARDS = [os.path.join(SAMPLES_PATH, f) for f in ("snow.board","test.board")]
+FORCES = [os.path.join(SAMPLES_PATH, f) for f in ("player1.mul","player2.mul")]
+DEFAULT_MIX = {"BOARD_REQUEST": 1, "PLAYER_REQUEST": 1, "INITIATIVE_REQUEST": 8}
+PLAYERS_PER_TABLE = 2
+HOST = "127.0.0.1"
+PORT = 8663
+STARTUP_TIMEOUT = 30.
+IMPORT_MODULES = ("UltraMekPy", "UltraMekPy.client", "UltraMekPy.server")
+IMPORT_RUNS = 5
+SLOWEST_IMPORTS = 10
+BOARD_PARSE_SIZE = 500
+BOARD_PARSE_RUNS = 3
+
+def build_request(request_type, session_id, player, step, rng):
+    """
+    Creates a request of the scripted mix for the player of a table.
+    """
+    request = {"session_id": session_id}
+    if request_type == "BOARD_REQUEST":
+        request[request_type] = {"filename": rng.choice(BOARDS)}
+    elif request_type == "PLAYER_REQUEST":
+        request[request_type] = {player: {"Name": player, "color": [0.5,0,0],
+                                          "deployment_border": "N", "forces": rng.choice(FORCES)}}
+    else:
+        request[request_type] = {"player": player, "round_nr": step}
+    return request
+
+class ServerProcess:
+    """
+    Runs python -m UltraMekPy with the given arguments as subprocess.
+    """
+    def __init__(self, host=HOST, port=PORT, args=()):
+        self.host = host
+        self.port = port
+        self.args = list(args)
+        self.process = None
+
+    def __enter__(self):
+        cmd = [sys.executable, "-m", "UltraMekPy", "--ip", self.host, "--port", str(self.port)] + self.args
+        self.process = subprocess.Popen(cmd)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Error: Server stopped with code {self.process.returncode}!")
+            try:
+                socket.create_connection((self.host, self.port), timeout=0.5).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.__exit__()
+        raise TimeoutError("Error: Server did not start!")
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        try:
+            self.process.wait(5.)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+class LoadResults:
+    """
+    Latencies and errors of all simulated clients.
+    """
+    def __init__(self):
+        self.latencies = defaultdict(Histogram)
+        self.errors = defaultdict(int)
+        self.answer_bytes = 0
+        self.duration = 0.
+
+    def add(self, request_type, seconds, answer):
+        """
+        answer is the decoded answer or None if the request failed.
+        """
+        self.latencies[request_type].add(seconds)
+        if answer is None or ERROR_KEY in answer:
+            self.errors[request_type] += 1
+
+    def to_dict(self):
+        total = sum(hist.count for hist in self.latencies.values())
+        return {"requests": total,
+                "duration_s": self.duration,
+                "throughput_rps": total/self.duration if self.duration else 0.,
+                "errors": sum(self.errors.values()),
+                "error_rate": sum(self.errors.values())/total if total else 0.,
+                "answer_bytes": self.answer_bytes,
+                "per_type": {key: dict(hist.to_dict(), errors=self.errors[key])
+                             for key, hist in self.latencies.items()}}
+
+async def _request(host, port, request, connection):
+    """
+    Sends a request and returns its decoded answer and the number of bytes
+    received. connection is an AsyncClient for persistent connections or
+    None for one connection per request.
+    """
+    if connection is not None:
+        received = connection.received_bytes
+        answer = await connection.request(request)
+        return answer, connection.received_bytes - received
+    async with client.AsyncClient(port, host) as connection:
+        answer = await connection.request(request)
+        return answer, connection.received_bytes
+
+async def run_client(host, port, client_id, nr_requests, mix, persistent, results, seed):
+    rng = random.Random(seed + client_id)
+    session_id = f"bench{client_id//PLAYERS_PER_TABLE}"
+    player = f"player{client_id%PLAYERS_PER_TABLE + 1}"
+    connection = client.AsyncClient(port, host) if persistent else None
+    types, weights = zip(*mix.items())
+    script = ["PLAYER_REQUEST"] + rng.choices(types, weights, k=nr_requests - 1)
+    try:
+        for step, request_type in enumerate(script):
+            request = build_request(request_type, session_id, player, step, rng)
+            start = time.perf_counter()
+            try:
+                answer, nbytes = await _request(host, port, request, connection)
+            except (OSError, asyncio.TimeoutError):
+                answer, nbytes = None, 0
+            results.add(request_type, time.perf_counter() - start, answer)
+            results.answer_bytes += nbytes
+    finally:
+        if connection is not None:
+            await connection.close()
+
+async def run_load(host, port, clients, nr_requests, mix=DEFAULT_MIX, persistent=True, seed=0):
+    """
+    Runs clients simulated clients sending nr_requests requests each and
+    returns the LoadResults.
+    """
+    results = LoadResults()
+    start = time.perf_counter()
+    await asyncio.gather(*[run_client(host, port, k, nr_requests, mix, persistent, results, seed)
+                           for k in range(clients)])
+    results.duration = time.perf_counter() - start
+    return results
+
+async def fetch_stats(host, port):
+    answer, _ = await _request(host, port, {"STATS_REQUEST": {}}, None)
+    return answer.get("STATS_REQUEST")
+
+def import_times(module, runs=IMPORT_RUNS, slowest=SLOWEST_IMPORTS):
+    """
+    Imports module in fresh interpreters with -X importtime and returns the
+    fastest time of its import and the slowest modules it imports (in ms).
+    """
+    cumulative = {}
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                              capture_output=True, text=True, check=True)
+        for line in proc.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name = fields[2].strip()
+            us = int(fields[1])
+            cumulative[name] = min(us, cumulative.get(name, us))
+    total = cumulative.pop(module, 0)
+    imports = sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:slowest]
+    return {"module": module, "total_ms": total/1000.,
+            "slowest_imports": {name: us/1000. for name, us in imports}}
+
+def generate_board(filename, size_x, size_y, seed=0):
+    """
+    Writes a board of size_x x size_y hexes with random heights, whose
+    properties and tile types are drawn from the hexes of the sample boards.
+    """
+    tails = []
+    for board_file in BOARDS:
+        with open(board_file, 'r', encoding="utf-8") as fp:
+            tails += [line.split(maxsplit=3)[3].rstrip() for line in fp if line.startswith("hex ")]
+    rng = random.Random(seed)
+    with open(filename, 'w', encoding="utf-8") as fp:
+        fp.write(f"size {size_x} {size_y}\n")
+        for y in range(1, size_y + 1):
+            fp.write("".join(f"hex {x:02d}{y:02d} {rng.randint(-3, 5)} {rng.choice(tails)}\n"
+                             for x in range(1, size_x + 1)))
+        fp.write("end\n")
+
+def board_parse_times(size_x=BOARD_PARSE_SIZE, size_y=BOARD_PARSE_SIZE, runs=BOARD_PARSE_RUNS, seed=0):
+    """
+    Parses a generated board runs times and returns the fastest time and
+    the throughput in tiles and megabytes per second, and the fastest time
+    of loading its compiled board (including hashing the file).
+    """
+    import tempfile
+    from .boards import Board, BinaryBoardCache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "generated.board")
+        generate_board(filename, size_x, size_y, seed)
+        size = os.path.getsize(filename)
+        binary_cache = BinaryBoardCache(os.path.join(tmp_dir, "compiled"))
+        best = best_binary = float("inf")
+        for _ in range(runs):
+            start = time.perf_counter()
+            board = Board(filename)
+            best = min(best, time.perf_counter() - start)
+        binary_cache.store(board, binary_cache.digest(filename))
+        for _ in range(runs):
+            start = time.perf_counter()
+            Board.load(filename, binary_cache)
+            best_binary = min(best_binary, time.perf_counter() - start)
+    return {"size_x": size_x, "size_y": size_y, "file_mb": size/2**20, "parse_ms": best*1000.,
+            "tiles_per_s": size_x*size_y/best, "mb_per_s": size/2**20/best,
+            "binary_load_ms": best_binary*1000.}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="UltraMekPy.benchmark", description="UltraMek server benchmark")
+    parser.add_argument("--mode", default="async", help="server mode, see python -m UltraMekPy --help")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--ip", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=100, help="requests per client")
+    parser.add_argument("--mix", type=json.loads, default=DEFAULT_MIX,
+                        help='weights of the request types as JSON, e.g. \'{"BOARD_REQUEST": 1}\'')
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON result file (default: bench_<time>.json)")
+    parser.add_argument("--no-server", action="store_true", help="use an already running server")
+    parser.add_argument("--import-time", action="store_true",
+                        help="measure the import time of the package instead of the server")
+    parser.add_argument("--board-parse", action="store_true",
+                        help="measure how fast a large generated board is parsed instead of the server")
+    args = parser.parse_args(argv)
+
+    if args.board_parse:
+        report = {"board_parse": board_parse_times(seed=args.seed)}
+        output = args.output or time.strftime("boards_%Y%m%d_%H%M%S.json")
+        with open(output, 'w', encoding="utf-8") as fp:
+            json.dump(report, fp, indent=2)
+        result = report["board_parse"]
+        print(f"{result['size_x']}x{result['size_y']} board ({result['file_mb']:.1f}MB) parsed in "
+              f"{result['parse_ms']:.1f}ms: {result['tiles_per_s']:.0f} tiles/s, {result['mb_per_s']:.1f}MB/s, "
+              f"compiled board loaded in {result['binary_load_ms']:.1f}ms")
+        print(f"Results written to {output}")
+        return report
+
+    if args.import_time:
+        report = {"import_times": [import_times(module) for module in IMPORT_MODULES]}
+        output = args.output or time.strftime("import_%Y%m%d_%H%M%S.json")
+        with open(output, 'w', encoding="utf-8") as fp:
+            json.dump(report, fp, indent=2)
+        for result in report["import_times"]:
+            print(f"{result['module']}: {result['total_ms']:.1f}ms")
+            for name, ms in result["slowest_imports"].items():
+                print(f"  {name}: {ms:.1f}ms")
+        print(f"Results written to {output}")
+        return report
+
+    persistent = args.mode == "async"
+    server_args = ["--mode", args.mode, "--workers", str(args.workers)]
+    async def bench():
+        results = await run_load(args.ip, args.port, args.clients, args.requests,
+                                 args.mix, persistent, args.seed)
+        return results, await fetch_stats(args.ip, args.port)
+
+    if args.no_server:
+        results, stats = asyncio.run(bench())
+    else:
+        with ServerProcess(args.ip, args.port, server_args):
+            results, stats = asyncio.run(bench())
+
+    report = {"config": {"mode": args.mode, "workers": args.workers, "clients": args.clients,
+                         "requests_per_client": args.requests, "mix": args.mix, "seed": args.seed},
+              "results": results.to_dict(),
+              "server_stats": stats}
+    output = args.output or time.strftime("bench_%Y%m%d_%H%M%S.json")
+    with open(output, 'w', encoding="utf-8") as fp:
+        json.dump(report, fp, indent=2)
+    summary = report["results"]
+    print(f"{summary['requests']} requests in {summary['duration_s']:.2f}s: "
+          f"{summary['throughput_rps']:.1f} req/s, error rate {summary['error_rate']:.2%}")
+    for request_type, stats in summary["per_type"].items():
+        print(f"  {request_type}: p50 {stats['p50_ms']:.2f}ms p95 {stats['p95_ms']:.2f}ms "
+              f"p99 {stats['p99_ms']:.2f}ms errors {stats['errors']}")
+    print(f"Results written to {output}")
+    return report
+
+
+##########################################################
+# Tests
+#########################################################
+
+class BenchmarkTests(unittest.TestCase):
+    """
+    Tests for the load generation (against an in process server).
+    """
+    async def _run(self, persistent):
+        from . import server
+        srv = server.AsyncUltraMekServer(HOST, 0)
+        await srv.start()
+        results = await run_load(HOST, srv.port, 4, 5, {"BOARD_REQUEST": 1, "INITIATIVE_REQUEST": 1},
+                                 persistent)
+        stats = await fetch_stats(HOST, srv.port)
+        await srv.close()
+        return results, stats
+
+    def test_run_load(self):
+        for persistent in (True, False):
+            results, stats = asyncio.run(self._run(persistent))
+            summary = results.to_dict()
+            self.assertEqual(summary["requests"], 20)
+            self.assertGreater(summary["throughput_rps"], 0)
+            self.assertEqual(summary["per_type"]["PLAYER_REQUEST"]["count"], 4)
+            self.assertIn("requests", stats)
+
+    def test_import_times(self):
+        result = import_times("UltraMekPy.server", runs=1, slowest=1000)
+        self.assertGreater(result["total_ms"], 0.)
+        self.assertIn("UltraMekPy.requests", result["slowest_imports"])
+        # heavy dependencies are only imported when they are used
+        self.assertNotIn("pandas", result["slowest_imports"])
+
+    def test_board_parse_times(self):
+        result = board_parse_times(20, 10, runs=1)
+        self.assertEqual(result["size_x"], 20)
+        self.assertGreater(result["tiles_per_s"], 0.)
+        self.assertGreater(result["binary_load_ms"], 0.)
+
+    def test_build_request(self):
+        rng = random.Random(0)
+        request = build_request("INITIATIVE_REQUEST", "bench0", "player1", 3, rng)
+        self.assertEqual(request, {"session_id": "bench0",
+                                   "INITIATIVE_REQUEST": {"player": "player1", "round_nr": 3}})
+        request = build_request("BOARD_REQUEST", "bench0", "player1", 3, rng)
+        self.assertIn(request["BOARD_REQUEST"]["filename"], BOARDS)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,14 +20,29 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+from collections import OrderedDict, defaultdict
 from dataclasses import dataclass, field, asdict
+import hashlib
+import io
 import json
+import mmap
 import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
 import unittest
+
+import numpy as np
+
 from .functions import strip_and_part_line
+from . import logs
 
 from .constants import U8
 
+logger = logs.get_logger("boards")
+
 @dataclass
 class Tile:
     """
@@ -50,6 +65,43 @@ class Tile:
                 return p[1]
         return [0,0] if prop == "road" else 0
 
+class TileColumn:
+    """
+    Column x of the tiles of a board, its Tile objects are created on access.
+    """
+    __slots__ = ("board", "x")
+
+    def __init__(self, board, x):
+        self.board = board
+        self.x = x
+
+    def __len__(self):
+        return self.board.size_y
+
+    def __getitem__(self, y):
+        return self.board.tile(self.x, range(self.board.size_y)[y])
+
+    def __iter__(self):
+        return (self.board.tile(self.x, y) for y in range(self.board.size_y))
+
+class TileColumns:
+    """
+    The tiles of a board as board.tiles[x][y] (like the former list of lists).
+    """
+    __slots__ = ("board",)
+
+    def __init__(self, board):
+        self.board = board
+
+    def __len__(self):
+        return self.board.size_x
+
+    def __getitem__(self, x):
+        return TileColumn(self.board, range(self.board.size_x)[x])
+
+    def __iter__(self):
+        return (TileColumn(self.board, x) for x in range(self.board.size_x))
+
 class Board:
     """
     Class to parse and handle board files and provide logic and transforms.
@@ -60,57 +112,443 @@ class Board:
     |
     |
     y
+    The board is stored as one typed array of shape (size_x, size_y) per
+    layer (self.layers, road has a third axis for its two values). Tile
+    types and the property lists of the tiles are interned, tile_type_codes
+    and property_codes index tile_types and property_sets. Tile objects are
+    only created on access (self.tiles[x][y], self.tile(x, y)) and changing
+    them does not change the board, set_hex and set_property do. They
+    track the changed cells, which delta returns as patch for clients.
     """
     SIZE_IDENTIFIER = "size"
     HEX_IDENTIFIER = "hex"
     END_IDENTIFIER = "end"
 
-    LAYERS = {"woods","heights","rough","sand","swamp","water","planted_fields","foliage_elev",
-                  "tile_type","road"}
+    # a tuple, so the layers of flat boards are always encoded in the same order
+    LAYERS = ("woods","heights","rough","sand","swamp","water","planted_fields","foliage_elev",
+                  "tile_type","road")
+    HEIGHTS_LAYER = "heights"
+    TILE_TYPE_LAYER = "tile_type"
+    ROAD_LAYER = "road"
+    # layers holding the value of a property
+    PROPERTY_LAYERS = ("woods","rough","sand","swamp","water","planted_fields","foliage_elev","road")
+    ROAD_VALUES = 2
+    LAYER_DTYPE = np.int16
+    CODE_DTYPE = np.uint32
+    CHUNK_SIZE = 2**20
+    # hex <id> <height> "<properties>" "<tile type>", the id is implied by the order
+    HEX_PATTERN = re.compile(r'^hex[ \t]+\S+[ \t]+(-?\d+)[ \t]+("[^"\n]*"[ \t]+"[^"\n]*")[ \t]*$', re.MULTILINE)
+    TAIL_PATTERN = re.compile(r'"([^"]*)"[ \t]+"([^"]*)"')
     
     def __init__(self,filename):
         if not os.path.exists(filename):
             raise FileNotFoundError(f"Error: File {filename} does not exist!")
-
+        self.filename = filename
         with open(filename,'r',encoding=U8) as fp:
-            for line in fp:
-                if line.startswith(self.SIZE_IDENTIFIER): # We assume this is always first!
-                    self.size_x, self.size_y = self.get_dims(line)
-                    line_nr = 0
-                    self.tiles = [[None for k in range(self.size_y)]
-                                      for l in range(self.size_x)] 
-                elif line.startswith(self.HEX_IDENTIFIER):
-                    tile = self.create_tile_from_line(line,line_nr)
-                    self.tiles[tile.pos_x][tile.pos_y] = tile
-                    line_nr += 1
-                elif line.startswith(self.END_IDENTIFIER):
-                    break
-
-        self.layers = None
-                    
-                
+            self.parse(fp)
+
+    @classmethod
+    def load(cls, filename, binary_cache=None, digest=None):
+        """
+        Loads a board from its compiled file in binary_cache (a
+        BinaryBoardCache) and only parses the text file if there is none or
+        it is stale, the parsed board is compiled for the next time then.
+        digest is the content hash of the file if it is known already.
+        """
+        if binary_cache is None:
+            return cls(filename)
+        if digest is None:
+            digest = binary_cache.digest(filename)
+        board = binary_cache.load(filename, digest)
+        if board is None:
+            board = cls(filename)
+            binary_cache.store(board, digest)
+        return board
+
+    def parse(self, fp, chunk_size=CHUNK_SIZE):
+        """
+        Parses a board from a text stream in one pass: the hex lines of
+        every chunk of chunk_size characters are tokenized with one regular
+        expression, so huge boards are never held as lines. Heights go
+        straight into arrays. Properties and tile type of a hex ("tail") are
+        interned and only the distinct tails are parsed and turned into
+        layer values.
+        """
+        self.size_x = self.size_y = 0
+        for line in iter(fp.readline, ''):
+            if line.startswith(self.SIZE_IDENTIFIER): # We assume this is always first!
+                self.size_x, self.size_y = self.get_dims(line)
+                break
+        nr_tiles = self.size_x*self.size_y
+        # code of every distinct tail, new tails get the next code
+        tails = defaultdict()
+        tails.default_factory = tails.__len__
+        heights, codes = [], []
+        count = 0
+        rest = ""
+        ended = False
+        while not ended:
+            chunk = fp.read(chunk_size)
+            if chunk:
+                cut = chunk.rfind("\n") + 1
+                if cut == 0:
+                    rest += chunk
+                    continue
+                text, rest = rest + chunk[:cut], chunk[cut:]
+            else:
+                text, ended = rest, True
+            # like the line parser, the first line starting with end ends the board
+            end = 0 if text.startswith(self.END_IDENTIFIER) else text.find("\n" + self.END_IDENTIFIER) + 1
+            if end or text.startswith(self.END_IDENTIFIER):
+                text, ended = text[:end], True
+            matches = self.HEX_PATTERN.findall(text)
+            # every line starting with hex is a hex, a line the pattern skips would shift the others
+            if len(matches) != text.count("\n" + self.HEX_IDENTIFIER) + text.startswith(self.HEX_IDENTIFIER):
+                raise ValueError(f"Error: Malformed hex line {self.find_malformed(text)!r} "
+                                 f"in board {self.filename}!")
+            if not matches:
+                continue
+            count += len(matches)
+            if count > nr_tiles:
+                raise ValueError(f"Error: Board {self.filename} has more hexes than its size!")
+            chunk_heights, chunk_tails = zip(*matches)
+            heights.append(self.to_heights(chunk_heights, count - len(matches)))
+            codes.append(np.fromiter(map(tails.__getitem__, chunk_tails), self.CODE_DTYPE, len(matches)))
+        if count < nr_tiles:
+            raise ValueError(f"Error: Board {self.filename} has {count} hexes, "
+                             f"its size needs {nr_tiles}!")
+
+        type_index, property_index, parsed_properties = {}, {}, {}
+        self.property_sets = []
+        tail_types, tail_properties = [], []
+        for tail in tails:
+            properties, tile_type = self.TAIL_PATTERN.match(tail).groups()
+            tail_types.append(type_index.setdefault(tile_type, len(type_index)))
+            if properties not in property_index:
+                property_index[properties] = len(self.property_sets)
+                self.property_sets.append(self.parse_properties(properties, parsed_properties))
+            tail_properties.append(property_index[properties])
+        self.tile_types = list(type_index)
+        tail_codes = self._to_grid(np.concatenate(codes) if codes else np.zeros(0, self.CODE_DTYPE))
+        self.tile_type_codes = np.array(tail_types, dtype=self.CODE_DTYPE)[tail_codes]
+        self.property_codes = np.array(tail_properties, dtype=self.CODE_DTYPE)[tail_codes]
+        self.layers = self.extract_layers(
+            self._to_grid(np.concatenate(heights) if heights else np.zeros(0, self.LAYER_DTYPE)))
+        self.dirty = defaultdict(set)
+
+    @classmethod
+    def find_malformed(cls, text):
+        for line in text.splitlines():
+            if line.startswith(cls.HEX_IDENTIFIER) and not cls.HEX_PATTERN.match(line):
+                return line
+        return None
+
+    def position(self, nr):
+        """
+        pos_x and pos_y of the nr-th hex of the file.
+        """
+        return nr%self.size_x, nr//self.size_x
+
+    def to_heights(self, values, first):
+        """
+        Converts the heights of the hexes first, first + 1, ... to a layer
+        array. Raises a ValueError naming the first hex whose height does
+        not fit into LAYER_DTYPE.
+        """
+        limits = np.iinfo(self.LAYER_DTYPE)
+        try:
+            heights = np.fromiter(map(int, values), np.int64, len(values))
+            wrong = np.flatnonzero((heights < limits.min) | (heights > limits.max))
+        except OverflowError:
+            wrong = [k for k, value in enumerate(values) if not limits.min <= int(value) <= limits.max]
+        if len(wrong):
+            x, y = self.position(first + int(wrong[0]))
+            raise ValueError(f"Error: Height {values[wrong[0]]} of hex {x},{y} in board {self.filename} "
+                             f"is out of range [{limits.min}, {limits.max}]!")
+        return heights.astype(self.LAYER_DTYPE)
+
+    def _to_grid(self, values):
+        # values are in file order (x runs fastest), the arrays are indexed [x, y]
+        return values.reshape(self.size_y, self.size_x).T.copy()
+
+    def extract_layers(self, heights):
+        """
+        Creates the layers from the heights and the interned properties in
+        one pass over the properties of the distinct property sets: every
+        property fills the slot of its set in the column of its layer,
+        which is spread over the board with the codes.
+        """
+        nr_sets = len(self.property_sets)
+        columns = {layer: [self.get_property((), layer)]*nr_sets for layer in self.PROPERTY_LAYERS}
+        for code, properties in enumerate(self.property_sets):
+            # the first of repeated properties wins, like in get_property
+            for p in reversed(properties):
+                column = columns.get(p[0])
+                if column is not None:
+                    value = self.property_value(p)
+                    if not all(map(self.check_value, value if isinstance(value, list) else [value])):
+                        x, y = np.argwhere(self.property_codes == code)[0]
+                        limits = np.iinfo(self.LAYER_DTYPE)
+                        raise ValueError(f"Error: Property {':'.join(map(str, p))} of hex {x},{y} in board "
+                                         f"{self.filename} is out of range [{limits.min}, {limits.max}]!")
+                    column[code] = value
+        tables = {layer: np.array(column, self.LAYER_DTYPE).reshape((nr_sets,) + self.layer_shape(layer)[2:])
+                  for layer, column in columns.items()}
+        layers = {}
+        for layer in self.LAYERS:
+            if layer == self.HEIGHTS_LAYER:
+                layers[layer] = heights
+            elif layer == self.TILE_TYPE_LAYER:
+                layers[layer] = self.tile_type_codes
+            else:
+                layers[layer] = tables[layer][self.property_codes]
+        return layers
+
+    def layer_shape(self, layer):
+        if layer == self.ROAD_LAYER:
+            return (self.size_x, self.size_y, self.ROAD_VALUES)
+        return (self.size_x, self.size_y)
+
     @staticmethod
     def get_dims(line):
         line = strip_and_part_line(line)
         size_x = int(line[1])
         size_y = int(line[2])
         return size_x, size_y
+
+    @staticmethod
+    def parse_hex_line(line):
+        """
+        Returns height, the properties (unparsed) and the tile type of a hex line.
+        """
+        line = strip_and_part_line(line)
+        return int(line[2]), line[-2].replace('"',""), line[-1].replace('"',"")
+
+    @staticmethod
+    def parse_properties(properties, parsed=None):
+        """
+        Parses properties like "woods:1;foliage_elev:2" into a tuple of tuples.
+        parsed (a dict) interns the single properties over several calls.
+        """
+        if properties == '':
+            return ()
+        if parsed is None:
+            parsed = {}
+        result = []
+        for p in properties.split(';'):
+            prop = parsed.get(p)
+            if prop is None:
+                prop = parsed[p] = tuple(int(e) if k > 0 else e for k,e in enumerate(p.split(':')))
+            result.append(prop)
+        return tuple(result)
+
+    @classmethod
+    def property_value(cls, p):
+        """
+        Value of a parsed property (name, values...).
+        """
+        if p[0] == cls.ROAD_LAYER:
+            return (list(p[1:3]) + [0]*cls.ROAD_VALUES)[:cls.ROAD_VALUES]
+        return p[1]
+
+    @classmethod
+    def get_property(cls, properties, prop):
+        """
+        Value of prop in the parsed properties of a tile (see Tile.get_property).
+        """
+        for p in properties:
+            if prop == p[0]:
+                return cls.property_value(p)
+        return [0]*cls.ROAD_VALUES if prop == cls.ROAD_LAYER else 0
+
+    def get_tile_property(self, x, y, prop):
+        """
+        Value of prop of the tile on pos_x x and pos_y y (like
+        Tile.get_property), read from its layer if it has one.
+        """
+        if prop in self.PROPERTY_LAYERS:
+            return self.layers[prop][x,y].tolist()
+        return self.get_property(self.property_sets[self.property_codes[x,y]], prop)
         
     def create_tile_from_line(self,line,line_nr):
         pos_x = line_nr%self.size_x
         pos_y = line_nr//self.size_x
-        line = strip_and_part_line(line)
-        tile_type = line[-1].replace('"',"")
-        properties = line[-2].replace('"',"")
-        if properties != '':
-            properties = properties.split(';')
-            properties = [[int(e) if k > 0 else e for k,e in enumerate(p.split(':'))]
-                            for p in properties]
-        else:
-            properties = []
-        height = int(line[2])
+        height, properties, tile_type = self.parse_hex_line(line)
+        properties = [list(p) for p in self.parse_properties(properties)]
         return Tile(pos_x=pos_x,pos_y=pos_y,tile_type=tile_type,properties=properties,height=height)
 
+    def tile(self, x, y):
+        """
+        Creates the Tile on pos_x x and pos_y y.
+        """
+        return Tile(pos_x=x,pos_y=y,tile_type=self.tile_types[self.tile_type_codes[x,y]],
+                    properties=[list(p) for p in self.property_sets[self.property_codes[x,y]]],
+                    height=int(self.layers[self.HEIGHTS_LAYER][x,y]))
+
+    @property
+    def tiles(self):
+        return TileColumns(self)
+
+    def copy(self):
+        """
+        Copy of the board with arrays of its own, which can be changed
+        (boards of the BoardCache are shared, compiled boards read only).
+        """
+        board = Board.__new__(Board)
+        board.filename = self.filename
+        board.size_x, board.size_y = self.size_x, self.size_y
+        board.tile_types = list(self.tile_types)
+        board.property_sets = list(self.property_sets)
+        board.tile_type_codes = self.tile_type_codes.copy()
+        board.property_codes = self.property_codes.copy()
+        board.layers = {layer: board.tile_type_codes if layer == self.TILE_TYPE_LAYER else values.copy()
+                        for layer, values in self.layers.items()}
+        board.dirty = defaultdict(set)
+        return board
+
+    def check_hex(self, x, y):
+        if not (0 <= x < self.size_x and 0 <= y < self.size_y):
+            raise ValueError(f"Error: Hex {x}, {y} is not on the board!")
+
+    @classmethod
+    def check_value(cls, value):
+        limits = np.iinfo(cls.LAYER_DTYPE)
+        return isinstance(value, int) and not isinstance(value, bool) and limits.min <= value <= limits.max
+
+    @classmethod
+    def check_property(cls, p):
+        """
+        Raises a ValueError unless p is a property (name, values...) whose
+        values fit into the layers, properties with a layer but road need
+        a value.
+        """
+        if (not isinstance(p, (list, tuple)) or not p or not isinstance(p[0], str)
+                or not all(cls.check_value(v) for v in p[1:])
+                or (p[0] in cls.PROPERTY_LAYERS and p[0] != cls.ROAD_LAYER and len(p) < 2)):
+            raise ValueError(f"Error: Invalid property {p}!")
+
+    @staticmethod
+    def _intern(items, item):
+        # the distinct tile types and property sets are few, a new one gets the next code
+        try:
+            return items.index(item)
+        except ValueError:
+            items.append(item)
+            return len(items) - 1
+
+    def _set_cell(self, layer, x, y, value):
+        values = self.layers[layer]
+        if np.array_equal(values[x,y], value):
+            return
+        values[x,y] = value
+        self.dirty[layer].add((x, y))
+
+    def set_hex(self, x, y, height=None, tile_type=None, properties=None):
+        """
+        Changes height, tile type and properties (a list like Tile.properties)
+        of the hex on pos_x x and pos_y y, if they are not None. Only the
+        cells of the layers which change are written, they are dirty until
+        the next delta.
+        """
+        self.check_change({"x": x, "y": y, "height": height, "tile_type": tile_type, "properties": properties})
+        if not self.tile_type_codes.flags.writeable:
+            raise ValueError("Error: The board is read only, change a copy of it!")
+        if properties is not None:
+            properties = tuple(tuple(p) for p in properties)
+        if height is not None:
+            self._set_cell(self.HEIGHTS_LAYER, x, y, height)
+        if tile_type is not None:
+            self._set_cell(self.TILE_TYPE_LAYER, x, y, self._intern(self.tile_types, tile_type))
+        if properties is not None:
+            self.property_codes[x,y] = self._intern(self.property_sets, properties)
+            for layer in self.PROPERTY_LAYERS:
+                self._set_cell(layer, x, y, self.get_property(properties, layer))
+
+    def set_property(self, x, y, prop, value):
+        """
+        Sets the property prop of the hex on pos_x x and pos_y y to value
+        (an int or a list of ints like the road values), None removes it.
+        """
+        self.check_hex(x, y)
+        properties = [p for p in self.property_sets[self.property_codes[x,y]] if p[0] != prop]
+        if value is not None:
+            properties.append(self.property_entry(prop, value))
+        self.set_hex(x, y, properties=properties)
+
+    @staticmethod
+    def property_entry(prop, value):
+        return (prop,) + tuple(value if isinstance(value, (list, tuple)) else [value])
+
+    def check_change(self, change):
+        """
+        Raises a ValueError if a change (see apply_changes) can not be applied.
+        """
+        self.check_hex(change["x"], change["y"])
+        height = change.get("height")
+        if height is not None and not self.check_value(height):
+            raise ValueError(f"Error: Invalid height {height}!")
+        tile_type = change.get("tile_type")
+        if tile_type is not None and not isinstance(tile_type, str):
+            raise ValueError(f"Error: Invalid tile type {tile_type}!")
+        for p in change.get("properties") or ():
+            self.check_property(p)
+        for prop, values in change.get("set_properties", {}).items():
+            if not isinstance(values, (list, tuple)):
+                raise ValueError(f"Error: Values of property {prop} have to be a list!")
+            self.check_property(self.property_entry(prop, values))
+        for prop in change.get("remove_properties", ()):
+            if not isinstance(prop, str):
+                raise ValueError(f"Error: Invalid property {prop}!")
+
+    def apply_changes(self, changes):
+        """
+        Applies changes like [{"x": 3, "y": 4, "height": 1, "tile_type": "snow",
+        "properties": [["woods", 1]], "set_properties": {"fire": [1], "road": [1, 9]},
+        "remove_properties": ["woods"]}], all keys but x and y are optional.
+        Nothing is changed if one of the changes is invalid.
+        """
+        for change in changes:
+            self.check_change(change)
+        for change in changes:
+            x, y = change["x"], change["y"]
+            self.set_hex(x, y, change.get("height"), change.get("tile_type"), change.get("properties"))
+            for prop, values in change.get("set_properties", {}).items():
+                self.set_property(x, y, prop, values)
+            for prop in change.get("remove_properties", ()):
+                self.set_property(x, y, prop, None)
+
+    def delta(self, clear=True):
+        """
+        The changed cells of the layers since the last delta as dictionary
+        {"size_x": .., "size_y": .., "layers": {layer: {"x": [..], "y": [..],
+        "values": [..]}}}, which patches a flat dictionary of the board (see
+        patch_flat_dict).
+        """
+        layers = {}
+        for layer in self.LAYERS:
+            cells = self.dirty.get(layer)
+            if not cells:
+                continue
+            xs, ys = (list(axis) for axis in zip(*sorted(cells)))
+            values = self.layers[layer][xs, ys].tolist()
+            if layer == self.TILE_TYPE_LAYER:
+                values = [self.tile_types[v] for v in values]
+            layers[layer] = {"x": xs, "y": ys, "values": values}
+        if clear:
+            self.dirty.clear()
+        return {"size_x": self.size_x, "size_y": self.size_y, "layers": layers}
+
+    @staticmethod
+    def patch_flat_dict(flat_dict, delta):
+        """
+        Applies a delta to a flat dictionary of the board (in place).
+        """
+        for layer, cells in delta["layers"].items():
+            values = flat_dict[layer]
+            for x, y, value in zip(cells["x"], cells["y"], cells["values"]):
+                values[x][y] = value
+        return flat_dict
+
     def to_dict(self):
         """
         Creates a dictionary object which is easyily convertible to json.
@@ -128,32 +566,260 @@ class Board:
 
     def flatten(self):
         """
-        Flattens the board in that sense as it stores it in several
-        flat layers which are easier to process by logic
+        The layers are flat arrays since parsing, kept for compatibility.
         """
-        layer_dict = {}
-        for layer in self.LAYERS:
-            if layer == "heights":
-                layer_dict[layer] = [[tile.height for tile in row] for row in self.tiles]
-            elif layer == "tile_type":
-                layer_dict[layer] = [[tile.tile_type for tile in row] for row in self.tiles]
-            else:
-                layer_dict[layer] = [[tile.get_property(layer) for tile in row]
-                                        for row in self.tiles]
-        self.layers = layer_dict
-
+        return self.layers
 
     def to_flat_dict(self):
         """
         Creates a dictionary object which is easyily convertible to json.
         """
-        if self.layers is None:
-            self.flatten()
         dic = {"size_x": self.size_x,"size_y":self.size_y}
-        dic.update(self.layers)
+        for layer, values in self.layers.items():
+            if layer == self.TILE_TYPE_LAYER:
+                dic[layer] = np.array(self.tile_types, dtype=object)[values].tolist()
+            else:
+                dic[layer] = values.tolist()
         return dic
         
 
+
+class FileDigests:
+    """
+    Content hashes of files, memoized by path, mtime and size, so that
+    unchanged files are not read again on every lookup. Keeps the hashes
+    of the max_size files used last.
+    """
+    MAX_SIZE = 256
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.computed = 0
+        self.lock = threading.Lock()
+
+    def get_key(self, filename):
+        """
+        Returns (path, mtime, size, digest) of the file.
+        """
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f"Error: File {filename} does not exist!")
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self.entries.get(key)
+            if digest is not None:
+                self.entries.move_to_end(key)
+                return key + (digest,)
+        with open(path, 'rb') as fp:
+            digest = hashlib.sha1(fp.read()).hexdigest()
+        with self.lock:
+            self.computed += 1
+            self.entries[key] = digest
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return key + (digest,)
+
+file_digests = FileDigests()
+
+class BinaryBoardCache:
+    """
+    Compiled boards on disk, keyed by the content hash of their text file.
+    A compiled board (<hash>.umb in directory) starts with MAGIC and the
+    length of a JSON header (sizes, tile types, property sets and dtype,
+    shape and offset of every array), followed by the raw arrays aligned
+    to ALIGNMENT bytes (offsets count from the aligned end of the header). They are loaded with mmap as read only arrays, so
+    all server processes loading a board share its pages.
+    """
+    MAGIC = b"UMB1"
+    HEADER = struct.Struct("<4sI")
+    ALIGNMENT = 64
+    SUFFIX = ".umb"
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as err:
+            # boards are parsed as without compiled boards then
+            logger.warning("Could not create the board cache %s: %s", self.directory, err)
+
+    @staticmethod
+    def digest(filename):
+        return file_digests.get_key(filename)[3]
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest + self.SUFFIX)
+
+    @classmethod
+    def align(cls, offset):
+        return -(-offset//cls.ALIGNMENT)*cls.ALIGNMENT
+
+    def arrays(self, board):
+        arrays = {name: values for name, values in board.layers.items() if name != Board.TILE_TYPE_LAYER}
+        arrays["tile_type_codes"] = board.tile_type_codes
+        arrays["property_codes"] = board.property_codes
+        return arrays
+
+    def store(self, board, digest):
+        """
+        Writes the compiled board (atomically, readers never see half a file).
+        Returns False if it could not be written.
+        """
+        arrays = {name: np.ascontiguousarray(values) for name, values in self.arrays(board).items()}
+        layout, offset = {}, 0
+        for name, values in arrays.items():
+            layout[name] = [values.dtype.str, list(values.shape), offset]
+            offset = self.align(offset + values.nbytes)
+        header = {"digest": digest, "size_x": board.size_x, "size_y": board.size_y,
+                  "tile_types": board.tile_types, "property_sets": board.property_sets, "arrays": layout}
+        data = json.dumps(header).encode()
+        start = self.align(self.HEADER.size + len(data))
+        tmp_file = None
+        try:
+            fd, tmp_file = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(self.HEADER.pack(self.MAGIC, len(data)) + data)
+                for name, values in arrays.items():
+                    fp.seek(start + layout[name][2])
+                    fp.write(values.tobytes())
+                fp.truncate(start + offset)
+            os.replace(tmp_file, self.path(digest))
+        except OSError as err:
+            logger.warning("Could not write the compiled board of %s: %s", board.filename, err)
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+        return True
+
+    def load(self, filename, digest):
+        """
+        Returns the board compiled from the file with content hash digest,
+        None if it is missing, stale or broken.
+        """
+        try:
+            with open(self.path(digest), 'rb') as fp:
+                buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # missing (or empty, which mmap refuses)
+            self.misses += 1
+            return None
+        try:
+            board = self.from_buffer(filename, buffer, digest)
+        except (KeyError, TypeError, ValueError, struct.error) as err:
+            logger.warning("Ignoring broken compiled board of %s: %s", filename, err)
+            board = None
+        if board is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return board
+
+    def from_buffer(self, filename, buffer, digest):
+        magic, header_size = self.HEADER.unpack_from(buffer)
+        if magic != self.MAGIC:
+            raise ValueError(f"Error: {self.path(digest)} is no compiled board!")
+        header = json.loads(bytes(buffer[self.HEADER.size:self.HEADER.size + header_size]))
+        if header["digest"] != digest:
+            return None
+        start = self.align(self.HEADER.size + header_size)
+        board = Board.__new__(Board)
+        board.filename = filename
+        board.size_x, board.size_y = header["size_x"], header["size_y"]
+        board.tile_types = header["tile_types"]
+        board.property_sets = [tuple(tuple(p) for p in properties) for properties in header["property_sets"]]
+        arrays = {}
+        for name, (dtype, shape, offset) in header["arrays"].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            arrays[name] = np.frombuffer(buffer, dtype, count, start + offset).reshape(shape)
+        board.tile_type_codes = arrays.pop("tile_type_codes")
+        board.property_codes = arrays.pop("property_codes")
+        board.layers = {layer: board.tile_type_codes if layer == Board.TILE_TYPE_LAYER else arrays[layer]
+                        for layer in Board.LAYERS}
+        board.dirty = defaultdict(set)
+        return board
+
+    def stats(self):
+        return {"directory": self.directory, "hits": self.hits, "misses": self.misses}
+
+@dataclass
+class CachedBoard:
+    """
+    Parsed board of the BoardCache together with its encodings.
+    """
+    key: tuple
+    board: Board
+    encodings: dict = field(default_factory=dict)
+
+    def encoding(self, name, factory):
+        """
+        Returns the encoding name of the board and creates it with factory
+        if it does not exist yet.
+        """
+        enc = self.encodings.get(name)
+        if enc is None:
+            enc = factory()
+            self.encodings[name] = enc
+        return enc
+
+class BoardCache:
+    """
+    Bounded LRU cache of parsed boards. Entries are keyed by path, mtime, size
+    and content hash of the board file, so a changed file is parsed again.
+    Boards missing in the cache are loaded from binary_cache (a
+    BinaryBoardCache) if there is one. Boards in the cache are shared and
+    must not be modified.
+    """
+    MAX_SIZE = 16
+
+    def __init__(self, max_size=MAX_SIZE, binary_cache=None):
+        self.max_size = max_size
+        self.binary_cache = binary_cache
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(filename):
+        return file_digests.get_key(filename)
+
+    def get(self, filename):
+        """
+        Returns the CachedBoard of the file and parses it if necessary.
+        """
+        key = self.get_key(filename)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        # parse outside of the lock, so other boards can be served meanwhile
+        entry = CachedBoard(key, Board.load(filename, self.binary_cache, key[3]))
+        with self.lock:
+            entry = self.entries.setdefault(key, entry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        stats = {"size": len(self.entries), "max_size": self.max_size,
+                 "hits": self.hits, "misses": self.misses}
+        if self.binary_cache is not None:
+            stats["binary"] = self.binary_cache.stats()
+        return stats
+
 ##########################################################
 # Tests
 #########################################################
@@ -241,9 +907,239 @@ class BoardTests(unittest.TestCase):
     def test_to_flat_dict(self):
         b = self.boards[0]
         f = b.to_flat_dict()
-        with open('test_json.json','w') as fp:
-            json.dump(f,fp)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'test_json.json'),'w') as fp:
+                json.dump(f,fp)
+
+    def test_tiles(self):
+        for b, f in zip(self.boards, self.board_files):
+            with open(os.path.join(self.path,f),'r',encoding=U8) as fp:
+                lines = [line for line in fp if line.startswith(Board.HEX_IDENTIFIER)]
+            for line_nr, line in enumerate(lines):
+                tile = b.create_tile_from_line(line,line_nr)
+                self.assertEqual(b.tiles[tile.pos_x][tile.pos_y], tile)
+            self.assertEqual(len(b.tiles), b.size_x)
+            self.assertEqual(len(list(b.tiles[-1])), b.size_y)
+            with self.assertRaises(IndexError):
+                b.tiles[b.size_x]
+
+    def test_layers(self):
+        for b in self.boards:
+            f = b.to_flat_dict()
+            for row in b.tiles:
+                for t in row:
+                    self.assertEqual(f["heights"][t.pos_x][t.pos_y], t.height)
+                    self.assertEqual(f["tile_type"][t.pos_x][t.pos_y], t.tile_type)
+                    for layer in ("woods","water","road"):
+                        self.assertEqual(f[layer][t.pos_x][t.pos_y], t.get_property(layer))
+            self.assertEqual(b.layers["woods"].shape, (b.size_x, b.size_y))
+            self.assertEqual(b.layers["road"].shape, (b.size_x, b.size_y, Board.ROAD_VALUES))
+            self.assertLessEqual(len(b.tile_types), 2)
+
+    def test_get_tile_property(self):
+        for b in self.boards:
+            for row in b.tiles:
+                for t in row:
+                    for prop in Board.PROPERTY_LAYERS + ("elevation",):
+                        self.assertEqual(b.get_tile_property(t.pos_x, t.pos_y, prop), t.get_property(prop))
+        # repeated properties: the first one counts, also in the layers
+        b = self.boards[0]
+        b.parse(io.StringIO('size 2 1\nhex 0101 0 "woods:2;road:1;woods:1" "snow"\nhex 0201 0 "" ""\nend\n'))
+        self.assertEqual(b.get_tile_property(0, 0, "woods"), 2)
+        self.assertEqual(b.tile(0, 0).get_property("woods"), 2)
+        self.assertEqual(b.get_tile_property(0, 0, "road"), [1, 0])
+        self.assertEqual(b.get_tile_property(1, 0, "road"), [0, 0])
+
+    def test_changes(self):
+        b = self.boards[0]
+        flat = b.to_flat_dict()
+        c = b.copy()
+        c.apply_changes([{"x": 3, "y": 4, "height": 5, "tile_type": "lava", "properties": [["woods", 2]]},
+                         {"x": 0, "y": 0, "set_properties": {"road": [1, 9], "fire": [1]}},
+                         {"x": 1, "y": 0, "height": int(flat["heights"][1][0])}])
+        self.assertEqual(c.tile(3, 4), Tile(pos_x=3, pos_y=4, tile_type="lava", height=5, properties=[["woods", 2]]))
+        self.assertEqual(c.get_tile_property(0, 0, "fire"), 1)
+        delta = c.delta()
+        # only the cells which changed, the original board stays as it was
+        self.assertEqual(delta["layers"]["heights"], {"x": [3], "y": [4], "values": [5]})
+        self.assertEqual(delta["layers"]["tile_type"]["values"], ["lava"])
+        self.assertEqual(delta["layers"]["road"], {"x": [0], "y": [0], "values": [[1, 9]]})
+        self.assertNotIn("water", delta["layers"])
+        self.assertEqual(Board.patch_flat_dict(flat, delta), c.to_flat_dict())
+        self.assertEqual(b.to_flat_dict()["tile_type"][3][4], "snow")
+        self.assertEqual(c.delta()["layers"], {})
+
+        c.set_property(0, 0, "fire", None)
+        self.assertEqual(c.delta()["layers"], {})
+        self.assertEqual(c.tile(0, 0).properties, [["road", 1, 9]])
+        with self.assertRaises(ValueError):
+            c.apply_changes([{"x": 0, "y": 0, "height": 1}, {"x": c.size_x, "y": 0, "height": 1}])
+        self.assertEqual(c.delta()["layers"], {})
+        with self.assertRaises(ValueError):
+            c.set_hex(0, 0, properties=[["woods", "dense"]])
+        # invalid changes are found before anything is changed
+        for invalid in ({"set_properties": {"woods": [2**15]}}, {"set_properties": {"woods": []}},
+                        {"set_properties": {"woods": 1}}, {"height": -2**15 - 1},
+                        {"properties": [["water"]]}, {"remove_properties": [1]}):
+            with self.assertRaises(ValueError):
+                c.apply_changes([{"x": 1, "y": 1, "height": 7}, dict(invalid, x=2, y=2)])
+            self.assertEqual(c.delta()["layers"], {})
+        c.apply_changes([{"x": 0, "y": 0, "remove_properties": ["road"]}])
+        self.assertEqual(c.tile(0, 0).properties, [])
+
+    def test_parse_chunks(self):
+        for b, f in zip(self.boards, self.board_files):
+            with open(os.path.join(self.path,f),'r',encoding=U8) as fp:
+                text = fp.read()
+            # hex lines split over tiny chunks parse the same
+            b.parse(io.StringIO(text), chunk_size=7)
+            self.assertEqual(b.to_flat_dict(), Board(os.path.join(self.path,f)).to_flat_dict())
+            # nothing after end is parsed, missing hexes are an error
+            lines = text.splitlines()
+            with self.assertRaises(ValueError):
+                b.parse(io.StringIO("\n".join(lines[:3] + ["end", 'hex 0101 9 "" "bla"'])))
+            with self.assertRaises(ValueError):
+                b.parse(io.StringIO("\n".join(lines[:-1] + [lines[1], "end"])))
+
+    def test_parse_malformed(self):
+        b = self.boards[0]
+        lines = ['size 3 1', 'hex 0101 1 "" "a"', 'hex 0201 x2 "" "b"', 'hex 0301 3 "" "c"', 'end']
+        for chunk_size in (7, Board.CHUNK_SIZE):
+            with self.assertRaisesRegex(ValueError, "x2"):
+                b.parse(io.StringIO("\n".join(lines)), chunk_size=chunk_size)
+        # lines not starting with hex are skipped like before, so the board misses a hex
+        lines[2] = ' hex 0201 2 "" "b"'
+        with self.assertRaises(ValueError):
+            b.parse(io.StringIO("\n".join(lines)))
+        lines[2] = 'hex 0201 2 "" "b"'
+        b.parse(io.StringIO("\n".join(lines)))
+        self.assertEqual(b.tile_types, ["a", "b", "c"])
+
+    def test_parse_out_of_range(self):
+        b = self.boards[0]
+        lines = ['size 2 1', 'hex 0101 1 "" "a"', 'hex 0201 40000 "" "b"', 'end']
+        with self.assertRaisesRegex(ValueError, "hex 1,0"):
+            b.parse(io.StringIO("\n".join(lines)))
+        lines[2] = 'hex 0201 2 "woods:40000" "b"'
+        with self.assertRaisesRegex(ValueError, "woods:40000 of hex 1,0"):
+            b.parse(io.StringIO("\n".join(lines)))
+        lines[2] = 'hex 0201 -32768 "road:1:32767" "b"'
+        b.parse(io.StringIO("\n".join(lines)))
+        self.assertEqual(b.tile(1, 0).height, -32768)
 
 
 
     
+
+
+class BoardCacheTests(unittest.TestCase):
+    """
+    Tests for the BoardCache class.
+    """
+    def setUp(self):
+        self.path = os.path.join("test","samples")
+        self.cache = BoardCache(max_size=2)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tmp_board = os.path.join(self.tmp_dir, "tmp.board")
+        shutil.copy(os.path.join(self.path,"snow.board"), self.tmp_board)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_get(self):
+        entry = self.cache.get(self.tmp_board)
+        self.assertIs(entry, self.cache.get(self.tmp_board))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+        self.assertEqual(entry.encoding("json", lambda: b"{}"), b"{}")
+        self.assertEqual(entry.encoding("json", lambda: b"[]"), b"{}")
+        with open(self.tmp_board, 'a', encoding=U8) as fp:
+            fp.write("end\n")
+        self.assertIsNot(entry, self.cache.get(self.tmp_board))
+        self.assertEqual(self.cache.misses, 2)
+        with self.assertRaises(FileNotFoundError):
+            self.cache.get("bla.board")
+
+    def test_file_digests(self):
+        digests = FileDigests(max_size=1)
+        key = digests.get_key(self.tmp_board)
+        self.assertEqual(key, digests.get_key(self.tmp_board))
+        self.assertEqual(digests.computed, 1)
+        with open(self.tmp_board, 'a', encoding=U8) as fp:
+            fp.write("end\n")
+        self.assertNotEqual(key[3], digests.get_key(self.tmp_board)[3])
+        self.assertEqual(digests.computed, 2)
+        self.assertEqual(len(digests.entries), 1)
+        with self.assertRaises(FileNotFoundError):
+            digests.get_key("bla.board")
+
+    def test_eviction(self):
+        files = [self.tmp_board] + [os.path.join(self.path, f) for f in ("snow.board", "test.board")]
+        for f in files:
+            self.cache.get(f)
+        self.assertEqual(len(self.cache.entries), 2)
+        self.cache.get(files[0])
+        self.assertEqual(self.cache.misses, 4)
+
+class BinaryBoardCacheTests(unittest.TestCase):
+    """
+    Tests for the BinaryBoardCache class.
+    """
+    def setUp(self):
+        self.path = os.path.join("test","samples")
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = BinaryBoardCache(os.path.join(self.tmp_dir, "compiled"))
+        self.tmp_board = os.path.join(self.tmp_dir, "tmp.board")
+        shutil.copy(os.path.join(self.path,"test.board"), self.tmp_board)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_load(self):
+        board = Board.load(self.tmp_board, self.cache)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+        compiled = Board.load(self.tmp_board, self.cache)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(compiled.to_flat_dict(), board.to_flat_dict())
+        self.assertEqual(compiled.tiles[3][5], board.tiles[3][5])
+        self.assertEqual(compiled.property_sets, board.property_sets)
+        # the arrays are the shared pages of the file, changes need a copy
+        self.assertFalse(compiled.layers["woods"].flags.writeable)
+        with self.assertRaises(ValueError):
+            compiled.set_hex(0, 0, height=3)
+        changed = compiled.copy()
+        changed.set_hex(0, 0, height=3)
+        self.assertEqual(changed.tile(0, 0).height, 3)
+        self.assertEqual(compiled.layers["road"].shape, (board.size_x, board.size_y, Board.ROAD_VALUES))
+
+    def test_stale(self):
+        Board.load(self.tmp_board, self.cache)
+        with open(self.tmp_board, 'r', encoding=U8) as fp:
+            text = fp.read()
+        with open(self.tmp_board, 'w', encoding=U8) as fp:
+            fp.write(text.replace("hex 0101 2", "hex 0101 7", 1))
+        board = Board.load(self.tmp_board, self.cache)
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(board.tile(0, 0).height, 7)
+        self.assertEqual(len(os.listdir(self.cache.directory)), 2)
+
+    def test_broken(self):
+        digest = self.cache.digest(self.tmp_board)
+        Board.load(self.tmp_board, self.cache)
+        with open(self.cache.path(digest), 'rb') as fp:
+            data = fp.read()
+        for data in (b"", b"UMB0" + data[4:], data[:len(data)//2]):
+            with open(self.cache.path(digest), 'wb') as fp:
+                fp.write(data)
+            self.assertIsNone(self.cache.load(self.tmp_board, digest))
+        # broken compiled boards are replaced
+        Board.load(self.tmp_board, self.cache)
+        self.assertIsNotNone(self.cache.load(self.tmp_board, digest))
+
+    def test_board_cache(self):
+        cache = BoardCache(binary_cache=self.cache)
+        cache.get(self.tmp_board)
+        cache.clear()
+        entry = cache.get(self.tmp_board)
+        self.assertEqual(cache.stats()["binary"]["hits"], 1)
+        self.assertEqual(entry.board.size_x, 16)
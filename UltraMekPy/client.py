@@ -18,23 +18,69 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+TCPClient/AsyncClient speak the line protocol of the TCP servers (see wire.py).
+Every request gets a request_id, which the server echoes, so answers are
+matched to their requests even when many requests are in flight on one
+connection. Answers are reassembled (binary blocks, streamed frames) and
+decoded to dictionaries. ClientPool/AsyncClientPool spread requests over
+several connections. Events of subscribed games (see events.py) are kept
+apart from the answers and read with read_event/next_event.
 """
 
+import asyncio
+import collections
+import itertools
+import json
+import queue
 import socket
+import threading
+import unittest
+from contextlib import contextmanager
+
+from .constants import NL, ERROR_KEY
+from . import events
+from . import logs
+from . import wire
 
 PORT = 8563
 IP = "127.0.0.1"
 BUFFER_SIZE = 1024
+DATAGRAM_SIZE = 2**16
+UDP_TIMEOUT = 0.25
+UDP_RETRIES = 3
+TIMEOUT = 30.
+POOL_SIZE = 4
+LIMIT = 2**24 # max. length of a single answer line
+
+logger = logs.get_logger("client")
+
+def _prepare(request, options, request_id):
+    """
+    Adds the default options and the request id to a request and encodes it as line.
+    """
+    request = dict(options, **request)
+    request[wire.REQUEST_ID_KEY] = request_id
+    return (json.dumps(request) + NL).encode()
+
+def _decode(answer):
+    result = wire.decode_answer(answer)
+    result.pop(wire.REQUEST_ID_KEY, None)
+    return result
 
 class UDPClient:
     """
-    Simple UDP client for testing stuff
+    Simple UDP client for testing stuff and for the UDP fast path of the
+    server (see udp.py): request numbers its datagrams and resends them
+    until the answer arrives.
     """
     PROTOCOL = socket.SOCK_DGRAM
-    def __init__(self,port=PORT,ip=IP,standard_buffer_size=BUFFER_SIZE):
+    def __init__(self,port=PORT,ip=IP,standard_buffer_size=BUFFER_SIZE,options=None):
         self.port = port
         self.ip = ip
         self.standard_buffer_size = standard_buffer_size
+        self.options = dict(options or {})
+        self.ids = itertools.count(1)
         self.create_socket()
 
     def create_socket(self):
@@ -52,3 +98,358 @@ class UDPClient:
         else:
             return data
 
+    def request(self, request, timeout=UDP_TIMEOUT, retries=UDP_RETRIES):
+        """
+        Sends a request datagram and returns its decoded answer. The server
+        answers resent datagrams from its cache, so resending is safe.
+        """
+        request_id = next(self.ids)
+        data = _prepare(request, self.options, request_id)
+        self.socket.settimeout(timeout)
+        for attempt in range(retries + 1):
+            self.socket.sendto(data, (self.ip, self.port))
+            try:
+                while True:
+                    answer = self.recieve(DATAGRAM_SIZE)
+                    if wire.answer_id(answer) == request_id:
+                        return _decode(answer)
+            except socket.timeout:
+                continue
+        raise TimeoutError(f"Error: No answer for request {request_id}!")
+
+
+
+class TCPClient:
+    """
+    Blocking client for one persistent connection. pipeline sends a list
+    of requests at once and waits for all answers. options (e.g. session_id,
+    format, compression) are added to every request. If a timeout or a
+    connection error occurs the connection is closed and reopened by the
+    next request, since later answers could not be matched anymore.
+    """
+    def __init__(self, port=PORT, ip=IP, timeout=TIMEOUT, options=None):
+        self.port = port
+        self.ip = ip
+        self.timeout = timeout
+        self.options = dict(options or {})
+        self.socket = None
+        self.rfile = None
+        self.ids = itertools.count(1)
+        self.events = collections.deque()
+
+    def connect(self):
+        self.socket = socket.create_connection((self.ip, self.port), self.timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.socket.makefile('rb')
+
+    def close(self):
+        if self.socket is not None:
+            self.rfile.close()
+            self.socket.close()
+            self.socket = None
+            self.rfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def pipeline(self, requests):
+        """
+        Sends all requests and returns their decoded answers in the same order.
+        """
+        if self.socket is None:
+            self.connect()
+        ids = [next(self.ids) for request in requests]
+        answers = {}
+        try:
+            self.socket.sendall(b"".join(_prepare(request, self.options, request_id)
+                                         for request, request_id in zip(requests, ids)))
+            waiting = list(ids)
+            while waiting:
+                answer = self._read()
+                if events.is_event(answer):
+                    self.events.append(events.decode_event(answer))
+                    continue
+                request_id = wire.answer_id(answer)
+                if request_id not in waiting:
+                    # answers without id (e.g. unparsable requests) come in order
+                    request_id = waiting[0]
+                waiting.remove(request_id)
+                answers[request_id] = answer
+        except (OSError, ValueError):
+            self.close()
+            raise
+        return [_decode(answers[request_id]) for request_id in ids]
+
+    def request(self, request):
+        return self.pipeline([request])[0]
+
+    def _read(self):
+        answer = wire.read_answer_sync(self.rfile)
+        if not answer:
+            raise ConnectionError("Error: Connection closed by server!")
+        return answer
+
+    def read_event(self):
+        """
+        Returns the next event of the subscribed games.
+        """
+        if self.events:
+            return self.events.popleft()
+        if self.socket is None:
+            self.connect()
+        try:
+            while True:
+                answer = self._read()
+                if events.is_event(answer):
+                    return events.decode_event(answer)
+                logger.debug("Dropped answer of request %s", wire.answer_id(answer))
+        except (OSError, ValueError):
+            self.close()
+            raise
+
+
+class ClientPool:
+    """
+    Thread safe pool of TCPClient connections. Every thread borrows a
+    connection for the duration of a request (or a pipeline).
+    """
+    def __init__(self, port=PORT, ip=IP, size=POOL_SIZE, timeout=TIMEOUT, options=None):
+        self.clients = queue.LifoQueue()
+        for k in range(size):
+            self.clients.put(TCPClient(port, ip, timeout, options))
+
+    @contextmanager
+    def connection(self, timeout=None):
+        client = self.clients.get(timeout=timeout)
+        try:
+            yield client
+        finally:
+            self.clients.put(client)
+
+    def request(self, request):
+        with self.connection() as client:
+            return client.request(request)
+
+    def pipeline(self, requests):
+        with self.connection() as client:
+            return client.pipeline(requests)
+
+    def close(self):
+        while True:
+            try:
+                self.clients.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncClient:
+    """
+    asyncio client for one persistent connection. Any number of tasks may
+    send requests concurrently, they are pipelined on the connection and a
+    background task hands the answers to the waiting requests by their id.
+    """
+    def __init__(self, port=PORT, ip=IP, timeout=TIMEOUT, options=None):
+        self.port = port
+        self.ip = ip
+        self.timeout = timeout
+        self.options = dict(options or {})
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.waiting = {}
+        self.ids = itertools.count(1)
+        self.received_bytes = 0
+        self.events = asyncio.Queue()
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        """
+        Number of requests waiting for their answer.
+        """
+        return len(self.waiting)
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port, limit=LIMIT), self.timeout)
+        self.receiver = asyncio.create_task(self._receive(self.reader))
+
+    async def _receive(self, reader):
+        try:
+            while True:
+                answer = await wire.read_answer(reader)
+                if not answer:
+                    break
+                self.received_bytes += len(answer)
+                if events.is_event(answer):
+                    self.events.put_nowait(events.decode_event(answer))
+                    continue
+                request_id = wire.answer_id(answer)
+                if request_id not in self.waiting:
+                    if request_id is not None or not self.waiting:
+                        logger.debug("Dropped answer of request %s", request_id)
+                        continue
+                    # answers without id (e.g. unparsable requests) come in order
+                    request_id = next(iter(self.waiting))
+                future = self.waiting.pop(request_id)
+                if not future.done():
+                    future.set_result(answer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.writer = None
+            waiting, self.waiting = self.waiting, {}
+            for future in waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Error: Lost connection to server!"))
+
+    async def send(self, request, timeout=None):
+        """
+        Sends a request and returns its raw (undecoded) answer.
+        """
+        async with self.lock:
+            if self.writer is None:
+                await self.connect()
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = future
+        try:
+            self.writer.write(_prepare(request, self.options, request_id))
+            await self.writer.drain()
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        finally:
+            self.waiting.pop(request_id, None)
+
+    async def request(self, request, timeout=None):
+        """
+        Sends a request and returns its decoded answer.
+        """
+        return _decode(await self.send(request, timeout))
+
+    async def next_event(self, timeout=None):
+        """
+        Returns the next event of the subscribed games.
+        """
+        return await asyncio.wait_for(self.events.get(), self.timeout if timeout is None else timeout)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.receiver is not None:
+            await self.receiver
+            self.receiver = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+class AsyncClientPool:
+    """
+    Spreads requests over size AsyncClient connections, every request goes
+    to the connection with the fewest answers outstanding.
+    """
+    def __init__(self, port=PORT, ip=IP, size=POOL_SIZE, timeout=TIMEOUT, options=None):
+        self.clients = [AsyncClient(port, ip, timeout, options) for k in range(size)]
+
+    async def send(self, request, timeout=None):
+        return await min(self.clients, key=len).send(request, timeout)
+
+    async def request(self, request, timeout=None):
+        return await min(self.clients, key=len).request(request, timeout)
+
+    async def close(self):
+        for client in self.clients:
+            await client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+##########################################################
+# Tests
+#########################################################
+
+class ClientTests(unittest.TestCase):
+    """
+    Tests for the TCP clients (against an in process server).
+    """
+    def setUp(self):
+        from . import server, sessions
+        self.server_module = server
+        self.sessions = sessions.SessionRegistry(unit_handler=server.session_registry.unit_handler)
+        self.board_request = {"BOARD_REQUEST": {"filename": "test/samples/snow.board"}}
+
+    async def _start(self):
+        srv = self.server_module.AsyncUltraMekServer(IP, 0)
+        srv.sessions = self.sessions
+        await srv.start()
+        return srv
+
+    def test_async_client(self):
+        async def run():
+            srv = await self._start()
+            async with AsyncClient(srv.port, options={"session_id": "client"}) as client:
+                answers = await asyncio.gather(
+                    client.request(self.board_request),
+                    client.request({"format": "binary", "compression": "zlib", **self.board_request}),
+                    client.request({"UNKNOWN_REQUEST": {}}))
+                self.assertEqual(len(client), 0)
+                self.assertGreater(client.received_bytes, 0)
+            await srv.close()
+            return answers
+        board, binary, error = asyncio.run(run())
+        self.assertEqual(board["BOARD_REQUEST"], binary["BOARD_REQUEST"])
+        self.assertIn(ERROR_KEY, error)
+        self.assertEqual(set(board), {"BOARD_REQUEST"})
+        self.assertIn("client", self.sessions)
+
+    def test_async_timeout(self):
+        async def run():
+            srv = await self._start()
+            slow = asyncio.Event()
+            dispatch = srv.dispatch
+            async def wait_dispatch(request, data):
+                await slow.wait()
+                return await dispatch(request, data)
+            srv.dispatch = lambda request, data: asyncio.ensure_future(wait_dispatch(request, data))
+            pool = AsyncClientPool(srv.port, size=2, timeout=0.05)
+            with self.assertRaises(asyncio.TimeoutError):
+                await pool.request(self.board_request)
+            slow.set()
+            answer = await pool.request(self.board_request, timeout=5.)
+            await pool.close()
+            await srv.close()
+            return answer
+        self.assertIn("BOARD_REQUEST", asyncio.run(run()))
+
+    def test_client_pool(self):
+        loop = asyncio.new_event_loop()
+        srv = loop.run_until_complete(self._start())
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            with ClientPool(srv.port, size=2, options={"format": "binary"}) as pool:
+                answers = pool.pipeline([self.board_request, {"UNKNOWN_REQUEST": {}}, self.board_request])
+                single = pool.request(self.board_request)
+        finally:
+            asyncio.run_coroutine_threadsafe(srv.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.assertEqual(answers[0], answers[2])
+        self.assertIn(ERROR_KEY, answers[1])
+        self.assertEqual(single, answers[0])
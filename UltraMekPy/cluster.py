@@ -0,0 +1,460 @@
+"""
+cluster.py - Classes and Tools for running the server on several processes
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+import asyncio
+import bisect
+import collections
+import gc
+import hashlib
+import json
+import os
+import signal
+import socket
+import tempfile
+import time
+import traceback
+import unittest
+
+from .constants import NL
+from . import events
+from . import server
+from . import sessions
+from . import wire
+
+LOCALHOST = "127.0.0.1"
+
+class HashRing:
+    """
+    Consistent hash ring which maps keys (session ids) onto nodes (workers).
+    Every node is placed replicas times on the ring, so keys are spread evenly
+    and only few keys move if the number of nodes changes.
+    md5 is used since it is stable between processes in contrast to hash().
+    """
+    REPLICAS = 64
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def hash_key(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+    def add_node(self, node):
+        for k in range(self.replicas):
+            point = self.hash_key(f"{node}#{k}")
+            ind = bisect.bisect(self.points, point)
+            self.points.insert(ind, point)
+            self.owners.insert(ind, node)
+
+    def get_node(self, key):
+        ind = bisect.bisect(self.points, self.hash_key(key)) % len(self.points)
+        return self.owners[ind]
+
+
+class PeerConnection:
+    """
+    Persistent, pipelined connection to the internal port of another worker.
+    Answers come back in order, so they are matched to the waiting
+    requests first in first out. Events of games the connection subscribed
+    to are handed to on_event.
+    """
+    def __init__(self, host, port, on_event=None):
+        self.host = host
+        self.port = port
+        self.on_event = on_event
+        self.reader = None
+        self.writer = None
+        self.waiting = collections.deque()
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, limit=server.AsyncUltraMekServer.LIMIT)
+        self.receiver = asyncio.create_task(self._receive(self.reader))
+
+    async def _receive(self, reader):
+        try:
+            while True:
+                answer = await wire.read_answer(reader)
+                if not answer:
+                    break
+                if events.is_event(answer):
+                    if self.on_event is not None:
+                        self.on_event(answer)
+                    continue
+                if self.waiting:
+                    self.waiting.popleft().set_result(answer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writer = None
+            while self.waiting:
+                self.waiting.popleft().set_exception(ConnectionError("Error: Lost connection to worker!"))
+
+    async def send(self, data):
+        """
+        Sends a request line to the peer and returns its answer line.
+        """
+        async with self.lock:
+            if self.writer is None:
+                await self.connect()
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append(future)
+        self.writer.write(data + NL.encode())
+        await self.writer.drain()
+        return await future
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.receiver
+
+
+class ShardedServer(server.AsyncUltraMekServer):
+    """
+    Worker of a multi process server. All workers accept connections on the
+    same public port (SO_REUSEPORT), but every game session belongs to exactly
+    one worker chosen by a consistent hash of its session id. Requests for
+    sessions of other workers are forwarded to the internal port of the owner.
+    Subscriptions to games of other workers are forwarded as well, the owner
+    sends the events once over the peer connection and they are relayed to
+    the local subscribers.
+    """
+    SUBSCRIBE = "SUBSCRIBE_REQUEST"
+    UNSUBSCRIBE = "UNSUBSCRIBE_REQUEST"
+
+    def __init__(self, host, port, worker_id, workers, internal_ports):
+        super().__init__(host, port)
+        self.worker_id = worker_id
+        self.ring = HashRing(range(workers))
+        self.internal_ports = internal_ports
+        self.internal = None
+        self.peers = {}
+        # session id -> Counter of the local subscribers of a game of another worker
+        self.relays = collections.defaultdict(collections.Counter)
+
+    @staticmethod
+    def session_id(request):
+        session_id = sessions.DEFAULT_SESSION
+        if isinstance(request, dict):
+            session_id = request.get(sessions.SESSION_KEY, session_id)
+        return str(session_id)
+
+    def owner(self, request):
+        return self.ring.get_node(self.session_id(request))
+
+    def get_peer(self, worker_id):
+        if worker_id not in self.peers:
+            self.peers[worker_id] = PeerConnection(LOCALHOST, self.internal_ports[worker_id], self.relay)
+        return self.peers[worker_id]
+
+    def relay(self, line):
+        session_id = events.decode_event(line)[events.SESSION_KEY]
+        subscribers = self.relays.get(session_id)
+        if subscribers:
+            for subscriber in list(subscribers):
+                subscriber(line)
+
+    def track_relays(self, request):
+        """
+        Mirrors the subscriptions of a request forwarded to another worker.
+        """
+        subscriber = events.subscriber_var.get()
+        if subscriber is None or not isinstance(request, dict):
+            return
+        session_id = self.session_id(request)
+        if self.SUBSCRIBE in request:
+            self.relays[session_id][subscriber] += 1
+        if self.UNSUBSCRIBE in request and session_id in self.relays:
+            relay = self.relays[session_id]
+            relay[subscriber] -= 1
+            if relay[subscriber] <= 0:
+                del relay[subscriber]
+            if not relay:
+                del self.relays[session_id]
+
+    def release_subscriber(self, subscriber):
+        super().release_subscriber(subscriber)
+        for session_id, relay in list(self.relays.items()):
+            count = relay.pop(subscriber, 0)
+            if not relay:
+                del self.relays[session_id]
+            if not count or not self.server.is_serving():
+                continue
+            # the owner counts the subscriptions of the peer connection
+            request = {sessions.SESSION_KEY: session_id, self.UNSUBSCRIBE: {}}
+            data = json.dumps(request).encode()
+            for k in range(count):
+                asyncio.ensure_future(self.forward(self.owner(request), data, request))
+
+    async def forward(self, worker_id, data, request=None):
+        try:
+            return await self.get_peer(worker_id).send(data)
+        except OSError as err:
+            return server.error_answer(err, request)
+
+    def dispatch(self, request, data):
+        worker_id = self.owner(request)
+        if worker_id == self.worker_id:
+            return super().dispatch(request, data)
+        self.track_relays(request)
+        return asyncio.ensure_future(self.forward(worker_id, data, request))
+
+    async def start(self, **kwargs):
+        # the internal port only serves the own sessions, so nothing is forwarded twice.
+        # The requests of all clients forwarded by a worker share one connection,
+        # so it does not remember options, the forwarded requests carry them.
+        self.internal = server.AsyncUltraMekServer(LOCALHOST, self.internal_ports[self.worker_id],
+                                                   negotiate=False)
+        self.internal.sessions = self.sessions
+        await self.internal.start()
+        self.internal_ports[self.worker_id] = self.internal.port
+        return await super().start(**kwargs)
+
+    async def close(self, timeout=1.):
+        for peer in self.peers.values():
+            await peer.close()
+        await self.internal.close(timeout)
+        await super().close(timeout)
+
+    async def serve_forever(self):
+        # the master passes SIGTERM on to its workers, they close their connections
+        # and return, so the teardown of serve_sharded runs
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        if self.server is None:
+            await self.start(reuse_port=True)
+        await stop.wait()
+        await self.close()
+
+
+def serve_sharded(host, port, workers, internal_port=None, worker_setup=None):
+    """
+    Forks workers processes which all serve the same port and waits for them.
+    Worker k listens on internal_port + k on localhost for forwarded requests.
+    worker_setup(k) is called in worker k before it serves and may return
+    a function called when it stops.
+    """
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+        raise OSError("Error: Sharding needs fork and SO_REUSEPORT!")
+    if internal_port is None:
+        internal_port = port + 1
+    internal_ports = [internal_port + k for k in range(workers)]
+
+    # load read only resources before forking, so the workers share their pages,
+    # and move them out of the gc, so its bookkeeping does not copy them again.
+    registry = server.session_registry
+    registry.unit_handler
+    registry.mul_parser
+    gc.collect()
+    gc.freeze()
+
+    pids = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, server.handle_reload_signal)
+            teardown = None
+            try:
+                if worker_setup is not None:
+                    teardown = worker_setup(worker_id)
+                ShardedServer(host, port, worker_id, workers, internal_ports).run()
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                if teardown is not None:
+                    teardown()
+                os._exit(code)
+        pids.append(pid)
+
+    def signal_workers(signum, frame):
+        # SIGHUP reloads the workers, SIGTERM and SIGINT stop them
+        worker_signal = signal.SIGHUP if signum == signal.SIGHUP else signal.SIGTERM
+        for pid in pids:
+            try:
+                os.kill(pid, worker_signal)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, signal_workers)
+    signal.signal(signal.SIGINT, signal_workers)
+    signal.signal(signal.SIGHUP, signal_workers)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+##########################################################
+# Tests
+#########################################################
+
+class HashRingTests(unittest.TestCase):
+    """
+    Tests for the HashRing class.
+    """
+    def setUp(self):
+        self.ring = HashRing(range(4))
+        self.keys = [f"table{k}" for k in range(1000)]
+
+    def test_get_node(self):
+        owners = [self.ring.get_node(key) for key in self.keys]
+        self.assertEqual(owners, [HashRing(range(4)).get_node(key) for key in self.keys])
+        counts = collections.Counter(owners)
+        self.assertEqual(set(counts.keys()), {0,1,2,3})
+        self.assertGreater(min(counts.values()), 100)
+
+    def test_add_node(self):
+        owners = [self.ring.get_node(key) for key in self.keys]
+        self.ring.add_node(4)
+        moved = [key for key, owner in zip(self.keys, owners) if self.ring.get_node(key) != owner]
+        self.assertTrue(all(self.ring.get_node(key) == 4 for key in moved))
+        self.assertLess(len(moved), len(self.keys)//2)
+
+
+class ShardedServerTests(unittest.TestCase):
+    """
+    Tests for the ShardedServer class (both workers run in one process).
+    """
+    def setUp(self):
+        self.board_request = {"BOARD_REQUEST":{"filename":"test/samples/snow.board"},
+                              wire.FORMAT_KEY:wire.BINARY_FORMAT}
+
+    async def _run_workers(self, tables):
+        ports = [0, 0]
+        workers = [ShardedServer(LOCALHOST, 0, k, 2, ports) for k in range(2)]
+        for worker in workers:
+            worker.sessions = sessions.SessionRegistry(unit_handler=server.session_registry.unit_handler)
+            await worker.start()
+        reader, writer = await asyncio.open_connection(LOCALHOST, workers[0].port)
+        for table in tables:
+            writer.write((json.dumps(dict(self.board_request, session_id=table)) + NL).encode())
+        await writer.drain()
+        answers = [wire.decode_answer(await wire.read_answer(reader)) for table in tables]
+        writer.close()
+        for worker in workers:
+            await worker.close()
+        return workers, answers
+
+    def test_forwarding(self):
+        tables = [f"table{k}" for k in range(8)]
+        workers, answers = asyncio.run(self._run_workers(tables))
+        self.assertTrue(all("BOARD_REQUEST" in answer for answer in answers))
+        for table in tables:
+            owner = workers[0].ring.get_node(table)
+            self.assertIn(table, workers[owner].sessions)
+            self.assertNotIn(table, workers[1-owner].sessions)
+
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork"), "needs fork and SO_REUSEPORT")
+    def test_terminate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            closed = os.path.join(tmp_dir, "closed")
+            with socket.socket() as sock:
+                sock.bind((LOCALHOST, 0))
+                port = sock.getsockname()[1]
+            def setup(worker_id):
+                return lambda: open(f"{closed}{worker_id}", 'w').close()
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    serve_sharded(LOCALHOST, port, 2, 0, setup)
+                except BaseException:
+                    code = 1
+                finally:
+                    os._exit(code)
+            for k in range(100):
+                try:
+                    socket.create_connection((LOCALHOST, port)).close()
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(0.05)
+            # both workers install their handlers before they listen
+            time.sleep(0.2)
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+            self.assertTrue(os.path.exists(closed + "0"))
+            self.assertTrue(os.path.exists(closed + "1"))
+
+    def test_forwarded_options(self):
+        async def run():
+            ports = [0, 0]
+            workers = [ShardedServer(LOCALHOST, 0, k, 2, ports) for k in range(2)]
+            for worker in workers:
+                worker.sessions = sessions.SessionRegistry(unit_handler=server.session_registry.unit_handler)
+                await worker.start()
+            table = next(f"table{k}" for k in range(100) if workers[0].ring.get_node(f"table{k}") == 1)
+            request = {"session_id": table, "HEARTBEAT_REQUEST": {}}
+            connections = [await asyncio.open_connection(LOCALHOST, workers[0].port) for k in range(2)]
+            raw = []
+            # both clients are forwarded over the same peer connection, only the first asked for zlib
+            for k, options in enumerate([{wire.COMPRESSION_KEY: wire.ZLIB}, {}, {}]):
+                reader, writer = connections[min(k, 1)]
+                writer.write((json.dumps(dict(request, **options)) + NL).encode())
+                raw.append(await wire.read_answer(reader))
+            connections[0][1].write((json.dumps(request) + NL).encode())
+            raw.append(await wire.read_answer(connections[0][0]))
+            for reader, writer in connections:
+                writer.close()
+            for worker in workers:
+                await worker.close()
+            return raw
+        raw = asyncio.run(run())
+        self.assertTrue(wire.STREAM_PATTERN.match(raw[0]))
+        self.assertFalse(wire.STREAM_PATTERN.match(raw[1]))
+        self.assertFalse(wire.STREAM_PATTERN.match(raw[2]))
+        # the first client keeps its option
+        self.assertTrue(wire.STREAM_PATTERN.match(raw[3]))
+
+    def test_relayed_events(self):
+        from .client import AsyncClient
+        async def run():
+            ports = [0, 0]
+            workers = [ShardedServer(LOCALHOST, 0, k, 2, ports) for k in range(2)]
+            for worker in workers:
+                worker.sessions = sessions.SessionRegistry(unit_handler=server.session_registry.unit_handler)
+                await worker.start()
+            table = next(f"table{k}" for k in range(100) if workers[0].ring.get_node(f"table{k}") == 1)
+            clients = [AsyncClient(workers[0].port, LOCALHOST, options={"session_id": table}) for k in range(2)]
+            for client in clients:
+                await client.request({"SUBSCRIBE_REQUEST": {}})
+            game_state = workers[1].sessions.get(table)
+            self.assertEqual(sum(game_state.subscribers.values()), 2)
+            game_state.set_new_round(3)
+            received = [await client.next_event(1.) for client in clients]
+            await clients[1].close()
+            await asyncio.sleep(0.05)
+            self.assertEqual(sum(game_state.subscribers.values()), 1)
+            await clients[0].close()
+            for worker in workers:
+                await worker.close()
+            return received
+        received = asyncio.run(run())
+        self.assertEqual(received[0], received[1])
+        self.assertEqual(received[0]["data"], {"round_nr": 3})
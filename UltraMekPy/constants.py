@@ -3,3 +3,5 @@ NL = '\n'
 ENTITY_DATA = "entity_data"
 GFX_DATA = "gfx_data"
 U8 = 'utf-8-sig'
+ERROR_KEY = "ERROR"
+ERROR_DETAILS_KEY = "details"
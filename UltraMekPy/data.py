@@ -21,9 +21,9 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import json
 import os
 import shutil
-import pandas as pd
 import sqlite3
 import shlex
+import threading
 import unittest
 from copy import deepcopy
 from tempfile import mkdtemp
@@ -32,6 +32,14 @@ from zipfile import ZipFile
 from .constants import CONFIG_FILE, U8
 from .parsers import MulParser, BlkParser, MtfParser
 
+def _pandas():
+    """
+    pandas is imported when the unit databases are used for the first time,
+    it takes longer to import than all the rest of the server.
+    """
+    import pandas
+    return pandas
+
 class UnitHandler:
     MEKHQ_KEY = "mekhq_data"
     UNITS_PATH_KEY = "units"
@@ -81,12 +89,12 @@ class UnitHandler:
     """
     Class to manage unit data
     """
-    def __init__(self):
-        path = os.path.split(__file__)[0]
-        config_file = os.path.join(path,CONFIG_FILE)
+    def __init__(self, config=None):
+        if config is None:
+            config = self.read_config()
         self.dir2extract = mkdtemp()
-        with open(config_file,'r') as fp:
-            config = json.load(fp)
+        # the handler is shared by all games, the lock guards its files and dbs
+        self.lock = threading.RLock()
         self.mekhq_path = os.path.expanduser(config[self.MEKHQ_KEY])
         self.units_path = os.path.expanduser(config[self.UNITS_PATH_KEY])
         self.custom_path = os.path.join(self.units_path,self.CUSTOM_PATH)
@@ -99,6 +107,20 @@ class UnitHandler:
                 json.dump({},gfp)
         
 
+    @staticmethod
+    def read_config():
+        path = os.path.split(__file__)[0]
+        config_file = os.path.join(path,CONFIG_FILE)
+        with open(config_file,'r') as fp:
+            return json.load(fp)
+
+    def uses_paths_of(self, config):
+        """
+        True if the handler reads units from the paths config points to.
+        """
+        return (self.mekhq_path == os.path.expanduser(config[self.MEKHQ_KEY]) and
+                self.units_path == os.path.expanduser(config[self.UNITS_PATH_KEY]))
+
     def __del__(self):
         shutil.rmtree(self.dir2extract,ignore_errors = True)
         
@@ -153,6 +175,7 @@ class UnitHandler:
         # category = self.get_category(entity)
         name = self.get_entity_name(entity)
         
+        pd = _pandas()
         db_fname = os.path.join(self.dbs_path,category+self.SQL_SUFFIX)
         new_row = {}
         if not os.path.exists(db_fname):
@@ -189,6 +212,7 @@ class UnitHandler:
         if not os.path.exists(db_fname):
             return None
         
+        pd = _pandas()
         con = sqlite3.connect(db_fname)
         df = pd.read_sql(self.QUERY_CODE.format(", ".join(self.DATA_COLUMNS),self.TABLE_NAME),con,index_col=self.ID_KEY)
         name = self.get_entity_name(entity)
@@ -228,6 +252,10 @@ class UnitHandler:
         return found_entity
     
     def get_entity(self,entity):
+        with self.lock:
+            return self._get_entity(entity)
+
+    def _get_entity(self,entity):
         # first try to find custom entity
         result = self.get_custom_entity(entity)
         if result is not None:
@@ -249,6 +277,10 @@ class UnitHandler:
         return result
     
     def get_gfx(self,entity):
+        with self.lock:
+            return self._get_gfx(entity)
+
+    def _get_gfx(self,entity):
         name = self.get_entity_name(entity)
         category = self.get_category(entity)
         with open(self.gfx_data_file,'r',encoding=U8) as gfp:
@@ -0,0 +1,160 @@
+"""
+events.py - Classes and Tools for pushing game events to clients
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Events are JSON lines {"EVENT": {"session_id": ..., "type": ..., "data": ...}}
+written to the persistent connections which subscribed to a game. They are
+encoded once by the game and the same bytes are written to all subscribers,
+always between two answers and never inside one.
+"""
+import asyncio
+import contextvars
+import json
+import unittest
+
+from .constants import NL
+
+EVENT_KEY = "EVENT"
+EVENT_PREFIX = b'{"EVENT": '
+SESSION_KEY = "session_id"
+TYPE_KEY = "type"
+DATA_KEY = "data"
+
+INITIATIVE_EVENT = "INITIATIVE"
+PLAYERS_EVENT = "PLAYERS"
+ROUND_EVENT = "ROUND"
+HOVER_EVENT = "HOVER"
+BOARD_EVENT = "BOARD"
+
+# subscriber of the connection the current request came in on (None if it can not receive events)
+subscriber_var = contextvars.ContextVar("subscriber", default=None)
+
+def encode_event(session_id, event_type, data):
+    event = {SESSION_KEY: session_id, TYPE_KEY: event_type, DATA_KEY: data}
+    return (json.dumps({EVENT_KEY: event}) + NL).encode()
+
+def is_event(answer):
+    return answer.startswith(EVENT_PREFIX)
+
+def decode_event(line):
+    return json.loads(line)[EVENT_KEY]
+
+class Subscriber:
+    """
+    Writes the events of the subscribed games to one connection. Games call
+    it from any thread, the events are queued and written by a task of the
+    connection's event loop under write_lock, which the connection also
+    holds while writing an answer. If a slow client lets max_pending events
+    pile up, further events are dropped (and counted).
+    """
+    MAX_PENDING = 1024
+
+    def __init__(self, writer, write_lock, max_pending=MAX_PENDING):
+        self.writer = writer
+        self.write_lock = write_lock
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(max_pending)
+        self.dropped = 0
+        self.games = set()
+        # the writing task is started by the first event
+        self.task = None
+
+    def __call__(self, line):
+        try:
+            self.loop.call_soon_threadsafe(self._put, line)
+        except RuntimeError:
+            # the loop of the connection is closed already
+            pass
+
+    def _put(self, line):
+        if self.task is None:
+            self.task = self.loop.create_task(self._run())
+        try:
+            self.queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _run(self):
+        while True:
+            line = await self.queue.get()
+            async with self.write_lock:
+                self.writer.write(line)
+                while not self.queue.empty():
+                    self.writer.write(self.queue.get_nowait())
+                await self.writer.drain()
+
+    def subscribe(self, game_state):
+        self.games.add(game_state)
+        return game_state.subscribe(self)
+
+    def unsubscribe(self, game_state):
+        self.games.discard(game_state)
+        return game_state.unsubscribe(self)
+
+    def close(self):
+        """
+        Unsubscribes from all games and stops writing.
+        """
+        for game_state in list(self.games):
+            game_state.unsubscribe(self, everything=True)
+        self.games.clear()
+        if self.task is not None:
+            self.task.cancel()
+
+
+##########################################################
+# Tests
+#########################################################
+
+class EventTests(unittest.TestCase):
+    """
+    Tests for the event encoding and the Subscriber class.
+    """
+    def test_encode_event(self):
+        line = encode_event("table1", ROUND_EVENT, {"round_nr": 2})
+        self.assertTrue(is_event(line))
+        self.assertTrue(line.endswith(NL.encode()))
+        self.assertEqual(decode_event(line), {SESSION_KEY: "table1", TYPE_KEY: ROUND_EVENT,
+                                              DATA_KEY: {"round_nr": 2}})
+        self.assertFalse(is_event(b'{"ERROR": "Error: bla!"}\n'))
+
+    def test_subscriber(self):
+        class Writer:
+            def __init__(self):
+                self.data = []
+            def write(self, data):
+                self.data.append(data)
+            async def drain(self):
+                pass
+        async def run():
+            writer = Writer()
+            lock = asyncio.Lock()
+            subscriber = Subscriber(writer, lock, max_pending=2)
+            async with lock:
+                for k in range(3):
+                    subscriber(encode_event("table1", ROUND_EVENT, k))
+                await asyncio.sleep(0.01)
+                self.assertEqual(writer.data, [])
+            await asyncio.sleep(0.01)
+            subscriber.close()
+            return writer.data, subscriber.dropped
+        data, dropped = asyncio.run(run())
+        self.assertEqual([decode_event(line)[DATA_KEY] for line in data], [0, 1])
+        self.assertEqual(dropped, 1)
@@ -19,16 +19,39 @@ You should have received a copy of the GNU General Public License
 along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
+from collections import Counter
 from copy import deepcopy
+import functools
+import os
+import random
+import threading
 
 from . import boards
 from . import parsers as par
 from . import data
+from . import metrics as met
 from . import constants as const
+from . import events as ev
 from .player import Player
 from . import rolls
 import unittest
 
+RECORD_BOARD = "board"
+RECORD_PLAYERS = "players"
+RECORD_ROUND = "round"
+RECORD_INITIATIVE = "initiative"
+RECORD_BOARD_CHANGES = "board_changes"
+
+def synchronized(method):
+    """
+    Decorator which runs a method of GameState under the lock of the game.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class GameState:
     FORCES_KEY = "forces"
     ROLL_TYPE_KEY = "roll_type"
@@ -38,46 +61,154 @@ class GameState:
     INITIATIVE_KEY = "initiative_rolled"
     DICES_KEY = "dices"
     ROUND_KEY = "round_nr"
+    HOVER_KEYS = ("x", "y")
     
-    def __init__(self):
-        self.unit_handler = data.UnitHandler()
-        self.mul_parser = par.MulParser()
+    def __init__(self, unit_handler=None, mul_parser=None, seed=None):
+        # unit handler and mul parser are read only and can be shared between games
+        self.unit_handler = unit_handler if unit_handler is not None else data.UnitHandler()
+        self.mul_parser = mul_parser if mul_parser is not None else par.MulParser()
         self.players ={}
         self.player_order = []
         self.round_nr = -1
+        self.session_id = None
+        # changes of the board since it was set up, the board is shared (boards.BoardCache)
+        # until the first change makes a copy of it for the game
+        self.board_changes = []
+        # hex each player points at (cursor), updated often and only shown to the others
+        self.hover = {}
+        # listeners (e.g. events.Subscriber) called with every encoded event, counted per subscription
+        self.subscribers = Counter()
+        # journal.Journal the changes of the game are appended to (None: not persisted)
+        self.journal = None
+        # the rolls of the game draw from its own generator, so recorded games can be replayed
+        self.reseed(seed)
+        # guards players, player_order, round_nr and board if games are served by several threads
+        self.lock = threading.RLock()
+
+    def reseed(self, seed=None):
+        """
+        Restarts the random generator of the game with seed (a random one if None).
+        """
+        self.seed = seed if seed is not None else random.SystemRandom().getrandbits(64)
+        self.rng = random.Random(self.seed)
+
+    @synchronized
+    def subscribe(self, listener):
+        self.subscribers[listener] += 1
+        return self.subscribers[listener]
+
+    @synchronized
+    def unsubscribe(self, listener, everything=False):
+        """
+        Removes one subscription of listener (all of them if everything is True)
+        and returns the number of subscriptions left.
+        """
+        if everything or self.subscribers[listener] <= 1:
+            self.subscribers.pop(listener, None)
+            return 0
+        self.subscribers[listener] -= 1
+        return self.subscribers[listener]
+
+    @synchronized
+    def publish(self, event_type, data):
+        """
+        Encodes an event once and hands it to all subscribers.
+        """
+        if not self.subscribers:
+            return
+        line = ev.encode_event(self.session_id, event_type, data)
+        for listener in list(self.subscribers):
+            listener(line)
+
+    def record(self, kind, data):
+        """
+        Appends a change to the journal, called under the lock of the game.
+        """
+        if self.journal is not None:
+            self.journal.append(self.session_id, kind, data)
 
+    @synchronized
     def setup_board(self, board):
         self.board = board
+        self.board_changes = []
+        self.record(RECORD_BOARD, {"filename": getattr(board, "filename", None)})
+
+    @synchronized
+    def join_board(self, board):
+        """
+        Sets up board unless the game changed the board of the same file
+        already, which is kept with its changes (for players joining late
+        or reconnecting). Returns the board of the game.
+        """
+        current = getattr(self, "board", None)
+        if (not self.board_changes or current.filename is None or board.filename is None
+                or os.path.realpath(current.filename) != os.path.realpath(board.filename)):
+            self.setup_board(board)
+        return self.board
+
+    def _change_board(self, changes):
+        board = getattr(self, "board", None)
+        if board is None:
+            raise ValueError("Error: The game has no board yet!")
+        if not self.board_changes:
+            board = board.copy()
+        board.apply_changes(changes)
+        self.board = board
+        self.board_changes.extend(changes)
+
+    @synchronized
+    def change_board(self, changes):
+        """
+        Changes hexes of the board (see boards.Board.apply_changes) and
+        returns the delta of the changed layer cells, which is also sent
+        to the subscribers.
+        """
+        self._change_board(changes)
+        delta = self.board.delta()
+        self.record(RECORD_BOARD_CHANGES, {"changes": changes})
+        self.publish(ev.BOARD_EVENT, delta)
+        return delta
     
     def process_units(self, forces):
         # parse corrseponding mul file
         mulp = self.mul_parser
+        # the unit handler may be swapped by a reload, all units of the forces use the same
+        unit_handler = self.unit_handler
         forces = mulp(forces)
         entities = forces[mulp.ENTITY_PLURAL]
-        for ID, entity in entities.items():
-            entity_data = self.unit_handler(entity)
-            forces[mulp.ENTITY_PLURAL][ID][const.ENTITY_DATA] = entity_data
-            gfx_data = self.unit_handler.get_gfx(entity)
-            forces[mulp.ENTITY_PLURAL][ID][const.GFX_DATA] = gfx_data
+        with met.metrics.time_stage(met.UNIT_RESOLUTION_STAGE):
+            for ID, entity in entities.items():
+                entity_data = unit_handler(entity)
+                forces[mulp.ENTITY_PLURAL][ID][const.ENTITY_DATA] = entity_data
+                gfx_data = unit_handler.get_gfx(entity)
+                forces[mulp.ENTITY_PLURAL][ID][const.GFX_DATA] = gfx_data
         return forces
     
     def setup_players(self, player_request):
+        # resolving units is slow and does not touch the game, so no lock is needed for it
         players = {}
         for key, val in player_request.items():
             val1 = deepcopy(val)
             val1[self.FORCES_KEY] = self.process_units(val[self.FORCES_KEY])
             players[key] = Player(key,val1)
         
-        self.players.update(players)
+        with self.lock:
+            self.players.update(players)
+            self.record(RECORD_PLAYERS, {key: player.forces for key, player in players.items()})
+            self.publish(ev.PLAYERS_EVENT, {"players": list(players), "all_players": list(self.players)})
         return players
     
+    @synchronized
     def set_new_round(self,round_nr):
         self.player_order = []
         for player in self.players.values():
             player.initiative = 0
         self.round_nr = round_nr
+        self.record(RECORD_ROUND, {self.ROUND_KEY: round_nr})
+        self.publish(ev.ROUND_EVENT, {self.ROUND_KEY: round_nr})
         
     
+    @synchronized
     def roll_initiative(self, initiative_request):
         player_name = initiative_request[self.PLAYER_NAME_KEY]
         round_nr = initiative_request[self.ROUND_KEY]
@@ -105,6 +236,9 @@ class GameState:
                 for player in self.players.values():
                     player.initiative = 0
         answer[self.PLAYER_ORDER_KEY] = inits
+        self.record(RECORD_INITIATIVE, {"initiatives": {p.name: p.initiative for p in self.players.values()},
+                                        self.PLAYER_ORDER_KEY: inits})
+        self.publish(ev.INITIATIVE_EVENT, answer)
         return answer
             
         
@@ -116,6 +250,77 @@ class GameState:
     #         roll.roll()
         
     
+    @synchronized
+    def set_hover(self, player_name, x, y):
+        """
+        Remembers the hex the player points at and tells the subscribers
+        if it changed.
+        """
+        position = (x, y)
+        if self.hover.get(player_name) != position:
+            self.hover[player_name] = position
+            self.publish(ev.HOVER_EVENT, {self.PLAYER_NAME_KEY: player_name,
+                                          **dict(zip(self.HOVER_KEYS, position))})
+        return position
+
+    @synchronized
+    def to_snapshot(self):
+        """
+        Compact state of the game: board reference and changes, players, order and round.
+        """
+        board = getattr(self, "board", None)
+        return {"board": getattr(board, "filename", None),
+                "board_changes": self.board_changes,
+                "players": {name: {"forces": p.forces, "initiative": p.initiative}
+                            for name, p in self.players.items()},
+                self.PLAYER_ORDER_KEY: [p.name for p in self.player_order],
+                self.ROUND_KEY: self.round_nr}
+
+    @synchronized
+    def restore(self, snapshot, load_board):
+        if snapshot["board"] is not None:
+            self.board = load_board(snapshot["board"])
+            self.board_changes = []
+            if snapshot.get("board_changes"):
+                self._change_board(snapshot["board_changes"])
+                self.board.dirty.clear()
+        self.players = {}
+        for name, val in snapshot["players"].items():
+            self.players[name] = Player(name, val["forces"])
+            self.players[name].initiative = val["initiative"]
+        self.player_order = [self.players[name] for name in snapshot[self.PLAYER_ORDER_KEY]]
+        self.round_nr = snapshot[self.ROUND_KEY]
+
+    @synchronized
+    def apply_record(self, kind, data, load_board):
+        """
+        Applies a journal record. Records set the state they describe, so
+        applying one twice does no harm.
+        """
+        if kind == RECORD_BOARD:
+            if data["filename"] is not None:
+                self.board = load_board(data["filename"])
+                self.board_changes = []
+        elif kind == RECORD_BOARD_CHANGES:
+            self._change_board(data["changes"])
+            self.board.dirty.clear()
+        elif kind == RECORD_PLAYERS:
+            for name, forces in data.items():
+                self.players[name] = Player(name, forces)
+        elif kind == RECORD_ROUND:
+            self.player_order = []
+            for player in self.players.values():
+                player.initiative = 0
+            self.round_nr = data[self.ROUND_KEY]
+        elif kind == RECORD_INITIATIVE:
+            for name, initiative in data["initiatives"].items():
+                if name in self.players:
+                    self.players[name].initiative = initiative
+            self.player_order = [self.players[name] for name in data[self.PLAYER_ORDER_KEY]]
+        else:
+            raise ValueError(f"Error: Unknown journal record {kind}!")
+
+    @synchronized
     def players2dict(self,players=None):
         if players is None:
             players = self.players
@@ -132,8 +337,7 @@ class TestGame(unittest.TestCase):
         self.game.setup_players(self.player_request["PLAYER_REQUEST"])
 
     def test_roll_initiative(self):
-        import random
-        random.seed(0)
+        self.game.reseed(0)
         answers = [self.game.roll_initiative(req['INITIATIVE_REQUEST']) for req in self.initiative_requests]
         breakpoint()
         self.assertEqual(answers[0]['player_order'],[])
@@ -142,3 +346,88 @@ class TestGame(unittest.TestCase):
         else:
             order = [answers[0]['player'],answers[1]['player']]
         self.assertEqual(order,answers[1]['player_order'])
+
+class GameStateThreadingTests(unittest.TestCase):
+    def setUp(self):
+        self.game = GameState()
+        self.game.players = {name: Player(name,{}) for name in ["player1","player2","player3"]}
+
+    def test_roll_initiative_locked(self):
+        answers = []
+        roll = lambda: answers.append(self.game.roll_initiative({"player":"player1","round_nr":1}))
+        with self.game.lock:
+            thread = threading.Thread(target=roll)
+            thread.start()
+            thread.join(0.1)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(answers, [])
+        thread.join()
+        self.assertEqual(len(answers), 1)
+        self.assertEqual(self.game.round_nr, 1)
+
+    def test_concurrent_initiative(self):
+        def roll(name):
+            for round_nr in range(50):
+                self.game.roll_initiative({"player":name,"round_nr":round_nr})
+        threads = [threading.Thread(target=roll,args=(name,)) for name in self.game.players]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        order = [p.name for p in self.game.player_order]
+        self.assertIn(len(order), (0, 3))
+        if order:
+            self.assertEqual(set(order), set(self.game.players))
+
+    def test_publish(self):
+        received = []
+        self.game.session_id = "table1"
+        self.game.subscribe(received.append)
+        self.game.subscribe(received.append)
+        self.game.roll_initiative({"player":"player1","round_nr":2})
+        self.assertEqual(len(received), 2)
+        self.assertEqual(ev.decode_event(received[0])["data"], {self.game.ROUND_KEY: 2})
+        self.assertEqual(ev.decode_event(received[1])["type"], ev.INITIATIVE_EVENT)
+        self.assertEqual(self.game.unsubscribe(received.append), 1)
+        self.assertEqual(self.game.unsubscribe(received.append), 0)
+        self.game.set_new_round(3)
+        self.assertEqual(len(received), 2)
+
+    def test_reseed(self):
+        def rolls(seed):
+            self.game.reseed(seed)
+            return [self.game.roll_initiative({"player":name,"round_nr":r})["dices"]
+                    for r in range(5) for name in self.game.players]
+        self.assertEqual(rolls(7), rolls(7))
+        self.assertNotEqual(rolls(7), rolls(8))
+
+    def test_change_board(self):
+        received = []
+        shared = boards.Board("test/samples/snow.board")
+        self.game.subscribe(received.append)
+        with self.assertRaises(ValueError):
+            self.game.change_board([{"x": 0, "y": 0, "height": 4}])
+        self.game.setup_board(shared)
+        delta = self.game.change_board([{"x": 0, "y": 0, "height": 4, "set_properties": {"woods": [2]}}])
+        self.assertEqual(delta["layers"]["woods"], {"x": [0], "y": [0], "values": [2]})
+        self.assertEqual(ev.decode_event(received[-1])["data"], delta)
+        # the shared board is copied by the first change
+        self.assertIsNot(self.game.board, shared)
+        self.assertEqual(shared.tile(0, 0).height, -1)
+        self.game.change_board([{"x": 1, "y": 0, "tile_type": "lava"}])
+
+        restored = GameState(self.game.unit_handler, self.game.mul_parser)
+        restored.restore(self.game.to_snapshot(), lambda filename: shared)
+        self.assertEqual(restored.board.to_flat_dict(), self.game.board.to_flat_dict())
+        self.assertEqual(restored.board.delta()["layers"], {})
+        restored.apply_record(RECORD_BOARD, {"filename": shared.filename}, lambda filename: shared)
+        restored.apply_record(RECORD_BOARD_CHANGES, {"changes": self.game.board_changes}, lambda filename: shared)
+        self.assertEqual(restored.board.to_flat_dict(), self.game.board.to_flat_dict())
+
+        # requesting the loaded board again keeps the changes, another board resets them
+        changed = self.game.board
+        self.assertIs(self.game.join_board(boards.Board("test/samples/snow.board")), changed)
+        self.assertEqual(len(self.game.board_changes), 2)
+        other = boards.Board("test/samples/test.board")
+        self.assertIs(self.game.join_board(other), other)
+        self.assertEqual(self.game.board_changes, [])
@@ -0,0 +1,321 @@
+"""
+journal.py - Classes and Tools for persisting games in a journal
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+The games append their changes (board, players, new round, initiative) as
+JSON lines [session_id, kind, data] to journal-<generation>.log. A background
+thread writes all records queued in the meantime with one write and fsync
+(group commit). Every snapshot_every records it starts a new generation and
+writes the state of all games to snapshot-<generation>.json, after which the
+older files are removed. Recovery loads the last snapshot and applies the
+journals of its generation and later ones.
+"""
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import unittest
+
+from .constants import NL
+from . import boards
+from . import logs
+
+JOURNAL_PATTERN = re.compile(r"^journal-(\d+)\.log$")
+SNAPSHOT_PATTERN = re.compile(r"^snapshot-(\d+)\.json$")
+SNAPSHOT_EVERY = 10000
+REMOVE_RECORD = "remove"
+RESTORE_RECORD = "restore"
+
+logger = logs.get_logger("journal")
+
+class Journal:
+    """
+    Append only journal with snapshots of the games of a SessionRegistry.
+    """
+    def __init__(self, directory, snapshot_every=SNAPSHOT_EVERY, fsync=True):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.registry = None
+        self.generation = 0
+        self.fp = None
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.since_snapshot = 0
+        # appended and committed records, for sync
+        self.appended = 0
+        self.committed = 0
+        self.commit = threading.Condition()
+        os.makedirs(directory, exist_ok=True)
+
+    def _files(self, pattern):
+        files = {}
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                files[int(match.group(1))] = os.path.join(self.directory, name)
+        return files
+
+    def journal_file(self, generation):
+        return os.path.join(self.directory, f"journal-{generation}.log")
+
+    def snapshot_file(self, generation):
+        return os.path.join(self.directory, f"snapshot-{generation}.json")
+
+    def append(self, session_id, kind, data):
+        """
+        Queues a record, it is encoded and written by the background thread.
+        """
+        with self.commit:
+            self.appended += 1
+        self.queue.put((session_id, kind, data))
+
+    def remove(self, session_id):
+        self.append(session_id, REMOVE_RECORD, None)
+
+    def sync(self, timeout=None):
+        """
+        Waits until all records appended so far are written.
+        """
+        with self.commit:
+            target = self.appended
+            return self.commit.wait_for(lambda: self.committed >= target, timeout)
+
+    @staticmethod
+    def read_records(filename):
+        """
+        Yields the records of a journal file. A torn last line (crash while
+        writing) ends the journal.
+        """
+        with open(filename, 'r', encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    session_id, kind, data = json.loads(line)
+                except ValueError:
+                    logger.warning("Journal %s ends with an incomplete record", filename)
+                    break
+                yield session_id, kind, data
+
+    def recover(self, registry, load_board=boards.Board):
+        """
+        Rebuilds the games of registry from the last snapshot and the journal
+        tail. Afterwards all games of registry write to this journal.
+        Returns the number of applied records.
+        """
+        snapshots = self._files(SNAPSHOT_PATTERN)
+        journals = self._files(JOURNAL_PATTERN)
+        base = max(snapshots, default=0)
+        start = time.perf_counter()
+        if snapshots:
+            with open(snapshots[base], 'r', encoding="utf-8") as fp:
+                snapshot = json.load(fp)
+            for session_id, state in snapshot["sessions"].items():
+                self._restore(registry, session_id, RESTORE_RECORD, state, load_board)
+        applied = 0
+        for generation in sorted(gen for gen in journals if gen >= base):
+            for session_id, kind, data in self.read_records(journals[generation]):
+                self._restore(registry, session_id, kind, data, load_board)
+                applied += 1
+        logger.info("Recovered %d games (%d journal records) in %.1fms", len(registry),
+                    applied, (time.perf_counter() - start)*1000.)
+
+        self.registry = registry
+        with registry.lock:
+            registry.journal = self
+            for game_state in registry.sessions.values():
+                game_state.journal = self
+        self.generation = max(list(snapshots) + list(journals), default=0) + 1
+        self.since_snapshot = applied
+        return applied
+
+    @staticmethod
+    def _restore(registry, session_id, kind, data, load_board):
+        if kind == REMOVE_RECORD:
+            registry.remove(session_id)
+            return
+        game_state = registry.get(session_id)
+        try:
+            if kind == RESTORE_RECORD:
+                game_state.restore(data, load_board)
+            else:
+                game_state.apply_record(kind, data, load_board)
+        except (OSError, KeyError, ValueError) as err:
+            logger.warning("Could not recover %s of %s: %s", kind, session_id, err)
+
+    def start(self):
+        """
+        Opens a new generation and starts the background thread. Starts
+        with a snapshot if the journal tail is long.
+        """
+        self.fp = open(self.journal_file(self.generation), 'ab')
+        self.thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        if self.since_snapshot >= self.snapshot_every:
+            self.snapshot()
+        stop = False
+        while not stop:
+            records = [self.queue.get()]
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                stop = True
+                records = [record for record in records if record is not None]
+            lines = []
+            for record in records:
+                try:
+                    lines.append(json.dumps(record) + NL)
+                except (TypeError, ValueError) as err:
+                    logger.warning("Could not journal %s: %s", record[:2], err)
+            self.fp.write("".join(lines).encode())
+            self.fp.flush()
+            if self.fsync:
+                os.fsync(self.fp.fileno())
+            with self.commit:
+                self.committed += len(records)
+                self.commit.notify_all()
+            self.since_snapshot += len(records)
+            if self.since_snapshot >= self.snapshot_every:
+                self.snapshot()
+
+    def snapshot(self):
+        """
+        Starts a new generation and writes the state of all games. Records
+        written while the snapshot is taken go to the new generation, since
+        they only set state they are applied again on top of the snapshot.
+        Only called by the background thread (or before it runs).
+        """
+        self.fp.close()
+        self.generation += 1
+        self.fp = open(self.journal_file(self.generation), 'ab')
+        self.since_snapshot = 0
+
+        with self.registry.lock:
+            games = list(self.registry.sessions.items())
+        snapshot = {"generation": self.generation,
+                    "sessions": {session_id: game_state.to_snapshot() for session_id, game_state in games}}
+        fd, tmp_file = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding="utf-8") as fp:
+            json.dump(snapshot, fp)
+            fp.flush()
+            if self.fsync:
+                os.fsync(fp.fileno())
+        os.replace(tmp_file, self.snapshot_file(self.generation))
+
+        for pattern in (JOURNAL_PATTERN, SNAPSHOT_PATTERN):
+            for generation, filename in self._files(pattern).items():
+                if generation < self.generation:
+                    os.remove(filename)
+
+    def close(self):
+        """
+        Writes the pending records and stops the background thread.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+##########################################################
+# Tests
+#########################################################
+
+class JournalTests(unittest.TestCase):
+    """
+    Tests for the Journal class.
+    """
+    def setUp(self):
+        from . import sessions
+        from .player import Player
+        from . import game
+        self.game = game
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.registry = sessions.SessionRegistry(unit_handler=object(), mul_parser=object())
+        self.Player = Player
+        self.board_file = os.path.join("test", "samples", "snow.board")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def play(self, journal, rounds):
+        game_state = self.registry.get("table1")
+        game_state.setup_board(boards.Board(self.board_file))
+        with game_state.lock:
+            game_state.players.update({name: self.Player(name, {"Name": name}) for name in ("p1", "p2")})
+            game_state.record(self.game.RECORD_PLAYERS, {name: {"Name": name} for name in ("p1", "p2")})
+        for round_nr in range(rounds):
+            for name in ("p1", "p2"):
+                game_state.roll_initiative({"player": name, "round_nr": round_nr})
+        self.assertTrue(journal.sync(5.))
+        return game_state.to_snapshot()
+
+    def recover(self):
+        from . import sessions
+        registry = sessions.SessionRegistry(unit_handler=object(), mul_parser=object())
+        journal = Journal(self.tmp_dir.name, snapshot_every=10)
+        journal.recover(registry)
+        return registry, journal
+
+    def test_recover(self):
+        journal = Journal(self.tmp_dir.name, snapshot_every=10)
+        journal.recover(self.registry)
+        journal.start()
+        state = self.play(journal, 7)
+        journal.close()
+        self.assertEqual(len(journal._files(SNAPSHOT_PATTERN)), 1)
+        self.assertEqual(len(journal._files(JOURNAL_PATTERN)), 1)
+
+        registry, journal = self.recover()
+        game_state = registry.get("table1")
+        self.assertEqual(game_state.to_snapshot(), state)
+        self.assertEqual(game_state.board.size_x, 16)
+        self.assertIs(game_state.journal, journal)
+
+    def test_torn_journal(self):
+        journal = Journal(self.tmp_dir.name, snapshot_every=1000)
+        journal.recover(self.registry)
+        journal.start()
+        state = self.play(journal, 2)
+        journal.close()
+        with open(journal.journal_file(journal.generation), 'ab') as fp:
+            fp.write(b'["table1", "round", {"round')
+        registry, journal = self.recover()
+        self.assertEqual(registry.get("table1").to_snapshot(), state)
+
+    def test_remove(self):
+        journal = Journal(self.tmp_dir.name)
+        journal.recover(self.registry)
+        journal.start()
+        self.play(journal, 1)
+        self.registry.remove("table1")
+        journal.close()
+        registry, journal = self.recover()
+        self.assertNotIn("table1", registry)
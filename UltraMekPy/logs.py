@@ -0,0 +1,269 @@
+"""
+logs.py - Classes and Tools for logging of the server
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Log records are put into a bounded queue by the request path and written
+by a background thread. Records are formatted in that thread as well,
+payloads (requests, answers) are wrapped into Payload objects, which are
+truncated and only decoded when the record is actually written.
+"""
+import atexit
+import contextvars
+import io
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import unittest
+
+LOGGER_NAME = "UltraMek"
+LEVEL = "WARNING"
+MAX_PAYLOAD = 256
+SAMPLE_RATE = 1.
+QUEUE_SIZE = 10000
+NO_REQUEST_ID = "-"
+
+request_id_var = contextvars.ContextVar("request_id", default=NO_REQUEST_ID)
+_request_counter = itertools.count(1)
+_listener = None
+_settings = None
+_sample_rate = SAMPLE_RATE
+_max_payload = MAX_PAYLOAD
+
+def get_logger(name):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+def new_request_id():
+    """
+    Creates a new correlation id and sets it for the current context
+    (thread or asyncio task).
+    """
+    request_id = f"{os.getpid():x}-{next(_request_counter):x}"
+    request_id_var.set(request_id)
+    return request_id
+
+def sampled():
+    """
+    Decides if the payloads of the current request are logged.
+    """
+    return _sample_rate >= 1. or random.random() < _sample_rate
+
+class Payload:
+    """
+    Lazy log argument for requests and answers. It is decoded and truncated
+    to max_len characters only when the record is written.
+    """
+    __slots__ = ("data", "max_len")
+
+    def __init__(self, data, max_len=None):
+        self.data = data
+        self.max_len = max_len
+
+    def __str__(self):
+        max_len = _max_payload if self.max_len is None else self.max_len
+        data = self.data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            size = len(data)
+            text = bytes(data[:max_len]).decode(errors="replace")
+        elif isinstance(data, list) and all(isinstance(part, (bytes, bytearray, memoryview)) for part in data):
+            # answers written as several buffers
+            size = sum(len(part) for part in data)
+            text = b"".join(bytes(part[:max_len]) for part in data)[:max_len].decode(errors="replace")
+        elif isinstance(data, str):
+            size = len(data)
+            text = data[:max_len]
+        else:
+            text = repr(data)
+            size = len(text)
+            text = text[:max_len]
+        if size > max_len:
+            text += f"... ({size} total)"
+        return text
+
+class RequestIdFilter(logging.Filter):
+    """
+    Adds the correlation id of the current request to the records.
+    """
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines.
+    """
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname,
+                 "logger": record.name, "request_id": getattr(record, "request_id", NO_REQUEST_ID),
+                 "msg": record.getMessage()}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler which never blocks: records are dropped (and counted)
+    if the queue is full, and formatting is left to the listener thread.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(level=LEVEL, filename=None, stream=None, max_payload=MAX_PAYLOAD,
+                  sample_rate=SAMPLE_RATE, queue_size=QUEUE_SIZE):
+    """
+    Sets up the UltraMek logger with a queue handler and a background
+    thread writing to filename or stream (default: stderr).
+    Returns the queue handler.
+    """
+    global _listener, _settings, _sample_rate, _max_payload
+    stop_logging()
+    _settings = dict(level=level, filename=filename, stream=stream, max_payload=max_payload,
+                     sample_rate=sample_rate, queue_size=queue_size)
+    _sample_rate = sample_rate
+    _max_payload = max_payload
+    if filename is not None:
+        target = logging.FileHandler(filename, encoding="utf-8")
+    else:
+        target = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    target.setFormatter(StructuredFormatter())
+
+    log_queue = queue.Queue(queue_size)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+    logger = logging.getLogger(LOGGER_NAME)
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, target)
+    _listener.start()
+    return handler
+
+def stop_logging():
+    """
+    Writes the pending records and stops the background thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+def _restart_after_fork():
+    """
+    The listener thread does not survive a fork, so a forked worker
+    starts its own. The old listener is dropped without stopping it,
+    its queue may have been locked by the parent.
+    """
+    global _listener
+    if _listener is not None:
+        _listener = None
+        setup_logging(**_settings)
+
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+##########################################################
+# Tests
+#########################################################
+
+class LogTests(unittest.TestCase):
+    """
+    Tests for the logging tools.
+    """
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = setup_logging("DEBUG", stream=self.stream, max_payload=8)
+        self.logger = get_logger("test")
+
+    def tearDown(self):
+        logger = logging.getLogger(LOGGER_NAME)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+        logger.propagate = True
+        stop_logging()
+
+    def test_payload(self):
+        self.assertEqual(str(Payload(b"0123456789")), "01234567... (10 total)")
+        self.assertEqual(str(Payload("0123", 2)), "01... (4 total)")
+        self.assertEqual(str(Payload({"a": 1}, 100)), "{'a': 1}")
+        self.assertEqual(str(Payload([b"0123", b"456789"])), "01234567... (10 total)")
+
+    def test_logging(self):
+        def request():
+            request_id = new_request_id()
+            self.logger.debug("Answer: %s", Payload(b"0123456789"))
+            return request_id
+        thread_ids = []
+        thread = threading.Thread(target=lambda: thread_ids.append(request()))
+        thread.start()
+        thread.join()
+        stop_logging()
+        entry = json.loads(self.stream.getvalue().splitlines()[0])
+        self.assertEqual(entry["request_id"], thread_ids[0])
+        self.assertEqual(entry["level"], "DEBUG")
+        self.assertEqual(entry["msg"], "Answer: 01234567... (10 total)")
+        self.assertEqual(request_id_var.get(), NO_REQUEST_ID)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_fork(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "server.log")
+            setup_logging("INFO", filename)
+            pid = os.fork()
+            if pid == 0:
+                get_logger("test").info("worker")
+                stop_logging()
+                os._exit(0)
+            os.waitpid(pid, 0)
+            self.logger.info("master")
+            stop_logging()
+            with open(filename, 'r', encoding="utf-8") as fp:
+                messages = sorted(json.loads(line)["msg"] for line in fp)
+        self.assertEqual(messages, ["master", "worker"])
+
+    def test_dropping(self):
+        handler = DroppingQueueHandler(queue.Queue(1))
+        record = logging.LogRecord("x", logging.INFO, "", 0, "msg", None, None)
+        handler.emit(record)
+        handler.emit(record)
+        self.assertEqual(handler.dropped, 1)
@@ -0,0 +1,260 @@
+"""
+metrics.py - Classes and Tools for measuring the server
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import unittest
+from collections import defaultdict
+from contextlib import contextmanager
+
+PARSE_STAGE = "parse"
+BOARD_LOAD_STAGE = "board_load"
+UNIT_RESOLUTION_STAGE = "unit_resolution"
+SERIALIZATION_STAGE = "serialization"
+# request type of the rejected requests without a known type
+INVALID_REQUEST = "INVALID"
+
+class Histogram:
+    """
+    Histogram with logarithmic buckets (4 per factor of 2, i.e. at most
+    ~19% error) for latencies in seconds. Percentiles are estimated by the
+    upper bound of the bucket they fall into.
+    """
+    BASE = 2**0.25
+    MIN_VALUE = 1e-6
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        if value <= self.MIN_VALUE:
+            ind = 0
+        else:
+            ind = math.ceil(math.log(value/self.MIN_VALUE, self.BASE))
+        self.buckets[ind] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.
+        rank = p/100.*self.count
+        cumulative = 0
+        for ind in sorted(self.buckets):
+            cumulative += self.buckets[ind]
+            if cumulative >= rank:
+                return min(self.MIN_VALUE*self.BASE**ind, self.max)
+        return self.max
+
+    def to_dict(self):
+        """
+        Summary in milliseconds.
+        """
+        ms = 1000.
+        return {"count": self.count,
+                "mean_ms": self.total/self.count*ms if self.count else 0.,
+                "p50_ms": self.percentile(50)*ms,
+                "p95_ms": self.percentile(95)*ms,
+                "p99_ms": self.percentile(99)*ms,
+                "max_ms": self.max*ms}
+
+class RequestStats:
+    """
+    Counters of one request type.
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.request_bytes = 0
+        self.answer_bytes = 0
+        self.latency = Histogram()
+
+    def to_dict(self):
+        return {"count": self.count, "errors": self.errors,
+                "request_bytes": self.request_bytes, "answer_bytes": self.answer_bytes,
+                "latency": self.latency.to_dict()}
+
+class Metrics:
+    """
+    Thread safe collection of per request type counters and latencies
+    and of the timings of the processing stages (parse, board load,
+    unit resolution, serialization).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+        self.dump_thread = None
+        self.dump_stop = threading.Event()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.requests = defaultdict(RequestStats)
+            self.stages = defaultdict(Histogram)
+
+    def record_request(self, request_type, seconds, error=False, request_bytes=0, answer_bytes=0):
+        with self.lock:
+            stats = self.requests[request_type]
+            stats.count += 1
+            stats.errors += int(error)
+            stats.request_bytes += request_bytes
+            stats.answer_bytes += answer_bytes
+            stats.latency.add(seconds)
+
+    def record_answer(self, request_types, answer_bytes):
+        """
+        Adds the size of an answer to all request types it contains.
+        """
+        with self.lock:
+            for request_type in request_types:
+                self.requests[request_type].answer_bytes += answer_bytes
+
+    def record_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage].add(seconds)
+
+    @contextmanager
+    def time_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def time_request(self, request_type, request_bytes=0):
+        start = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.record_request(request_type, time.perf_counter() - start, error, request_bytes)
+
+    def snapshot(self):
+        with self.lock:
+            return {"uptime_s": time.time() - self.started,
+                    "requests": {key: val.to_dict() for key, val in self.requests.items()},
+                    "stages": {key: val.to_dict() for key, val in self.stages.items()}}
+
+    def dump(self, filename, extra=None):
+        """
+        Writes the snapshot atomically as JSON file.
+        """
+        snapshot = self.snapshot()
+        if extra is not None:
+            snapshot.update(extra())
+        tmp_file = filename + ".tmp"
+        with open(tmp_file, 'w', encoding="utf-8") as fp:
+            json.dump(snapshot, fp)
+        os.replace(tmp_file, filename)
+
+    def start_dump(self, filename, interval, extra=None):
+        """
+        Dumps the snapshot every interval seconds on a background thread.
+        """
+        self.stop_dump()
+        self.dump_stop.clear()
+        def run():
+            while not self.dump_stop.wait(interval):
+                self.dump(filename, extra)
+            self.dump(filename, extra)
+        self.dump_thread = threading.Thread(target=run, name="metrics-dump", daemon=True)
+        self.dump_thread.start()
+
+    def stop_dump(self):
+        if self.dump_thread is not None:
+            self.dump_stop.set()
+            self.dump_thread.join()
+            self.dump_thread = None
+
+metrics = Metrics()
+
+
+##########################################################
+# Tests
+#########################################################
+
+class HistogramTests(unittest.TestCase):
+    """
+    Tests for the Histogram class.
+    """
+    def test_percentile(self):
+        hist = Histogram()
+        self.assertEqual(hist.percentile(50), 0.)
+        for k in range(1, 1001):
+            hist.add(k*1e-3)
+        self.assertEqual(hist.count, 1000)
+        self.assertAlmostEqual(hist.percentile(50), 0.5, delta=0.1)
+        self.assertAlmostEqual(hist.percentile(99), 0.99, delta=0.2)
+        self.assertLessEqual(hist.percentile(100), 1.)
+        self.assertAlmostEqual(hist.to_dict()["mean_ms"], 500.5)
+
+class MetricsTests(unittest.TestCase):
+    """
+    Tests for the Metrics class.
+    """
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_time_request(self):
+        with self.metrics.time_request("BOARD_REQUEST", 10):
+            pass
+        with self.assertRaises(KeyError):
+            with self.metrics.time_request("BOARD_REQUEST", 5):
+                raise KeyError("bla")
+        self.metrics.record_answer(["BOARD_REQUEST"], 100)
+        with self.metrics.time_stage(PARSE_STAGE):
+            pass
+        snapshot = self.metrics.snapshot()
+        stats = snapshot["requests"]["BOARD_REQUEST"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["errors"], 1)
+        self.assertEqual(stats["request_bytes"], 15)
+        self.assertEqual(stats["answer_bytes"], 100)
+        self.assertEqual(snapshot["stages"][PARSE_STAGE]["count"], 1)
+
+    def test_dump(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "stats.json")
+            self.metrics.record_stage(PARSE_STAGE, 0.01)
+            self.metrics.start_dump(filename, 0.01, extra=lambda: {"extra": 1})
+            time.sleep(0.05)
+            self.metrics.stop_dump()
+            with open(filename, 'r', encoding="utf-8") as fp:
+                snapshot = json.load(fp)
+        self.assertEqual(snapshot["extra"], 1)
+        self.assertEqual(snapshot["stages"][PARSE_STAGE]["count"], 1)
+
+    def test_stats_request(self):
+        from . import requests as req
+        answer = req.request_type_map["STATS_REQUEST"]({}, None)
+        self.assertIn("requests", answer)
+        self.assertIn("stages", answer)
+        self.assertIn("board_cache", answer)
@@ -0,0 +1,312 @@
+"""
+replay.py - Recording and deterministic replay of the requests of a server
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Usage (from the repository root):
+    python -m UltraMekPy --record session.rec
+    python -m UltraMekPy.replay session.rec --repeat 5
+A recording has one JSON line per new game {"game": {"session_id", "seed"}}
+and per request {"request": ..., "digest": ..., "ms": ...} ("error" instead
+of "digest" if it failed). Since the rolls of a game only draw from its own
+generator, replaying the requests in recorded order without a network gives
+the same answers, which is checked with the digests. Requests of the same
+game which raced on different connections may be recorded in another order
+than they rolled and show up as mismatches.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from collections import defaultdict
+
+from .constants import NL
+from .metrics import Histogram
+from . import server
+from . import sessions
+from . import wire
+
+GAME_KEY = "game"
+REQUEST_KEY = "request"
+DIGEST_KEY = "digest"
+ERROR_KEY = "error"
+TIME_KEY = "ms"
+SEED_KEY = "seed"
+# answers which depend on the time or the server load are not compared
+UNCHECKED_TYPES = frozenset(["STATS_REQUEST", "HEARTBEAT_REQUEST"])
+MAX_REPORTED_MISMATCHES = 20
+FLUSH_INTERVAL = 1.
+
+def answer_digest(answer):
+    """
+    Digest of an encoded answer, None for streamed answers.
+    """
+    if wire.answer_size(answer) is None:
+        return None
+    digest = hashlib.blake2b(digest_size=16)
+    for buffer in (answer if isinstance(answer, wire.Buffers) else [answer]):
+        digest.update(buffer)
+    return digest.hexdigest()
+
+def request_types(request):
+    if not isinstance(request, dict):
+        return "INVALID"
+    return "+".join(sorted(key for key in request
+                           if key != sessions.SESSION_KEY and key not in wire.OPTION_KEYS)) or "EMPTY"
+
+class Recorder:
+    """
+    Appends the requests a SessionRegistry processes and the seeds of its
+    new games to a recording file. Can be called from any thread, writes
+    are buffered and flushed at most every FLUSH_INTERVAL seconds.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, 'a', encoding="utf-8")
+        self.lock = threading.Lock()
+        self.count = 0
+        self.last_flush = time.monotonic()
+
+    def _write(self, entry):
+        line = json.dumps(entry) + NL
+        with self.lock:
+            if self.fp is not None:
+                self.fp.write(line)
+                self.count += 1
+                now = time.monotonic()
+                if now - self.last_flush > FLUSH_INTERVAL:
+                    self.fp.flush()
+                    self.last_flush = now
+
+    def record_game(self, session_id, seed):
+        self._write({GAME_KEY: {sessions.SESSION_KEY: session_id, SEED_KEY: seed}})
+
+    def record(self, request, answer, seconds, err=None):
+        entry = {REQUEST_KEY: request}
+        if err is not None:
+            entry[ERROR_KEY] = str(err)
+        else:
+            entry[DIGEST_KEY] = answer_digest(answer)
+        entry[TIME_KEY] = seconds*1000.
+        self._write(entry)
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+def read_recording(filename):
+    """
+    Yields the entries of a recording. A torn last line ends it.
+    """
+    with open(filename, 'r', encoding="utf-8") as fp:
+        for line in fp:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                break
+
+class ReplayResults:
+    """
+    Recorded and replayed processing times per request type and the
+    requests whose answers differ.
+    """
+    def __init__(self):
+        self.recorded = defaultdict(Histogram)
+        self.replayed = defaultdict(Histogram)
+        self.mismatches = []
+        self.nr_mismatches = 0
+        self.unchecked = 0
+        self.duration = 0.
+
+    def add(self, index, entry, digest, error, seconds):
+        types = request_types(entry[REQUEST_KEY])
+        self.recorded[types].add(entry.get(TIME_KEY, 0.)/1000.)
+        self.replayed[types].add(seconds)
+        if any(key in UNCHECKED_TYPES for key in types.split("+")):
+            self.unchecked += 1
+            return
+        if ERROR_KEY in entry or error is not None:
+            same = entry.get(ERROR_KEY) == error
+        elif digest is None or entry.get(DIGEST_KEY) is None:
+            self.unchecked += 1
+            return
+        else:
+            same = entry[DIGEST_KEY] == digest
+        if not same:
+            self.nr_mismatches += 1
+            if len(self.mismatches) < MAX_REPORTED_MISMATCHES:
+                self.mismatches.append({"index": index, "types": types,
+                                        "recorded": entry.get(ERROR_KEY, entry.get(DIGEST_KEY)),
+                                        "replayed": error if error is not None else digest})
+
+    def to_dict(self):
+        total = sum(hist.count for hist in self.replayed.values())
+        return {"requests": total,
+                "duration_s": self.duration,
+                "throughput_rps": total/self.duration if self.duration else 0.,
+                "mismatches": self.nr_mismatches,
+                "unchecked": self.unchecked,
+                "first_mismatches": self.mismatches,
+                "per_type": {key: {"recorded": self.recorded[key].to_dict(), "replayed": hist.to_dict()}
+                             for key, hist in self.replayed.items()}}
+
+def replay(filename, registry=None):
+    """
+    Feeds the requests of a recording to the games of registry (a new
+    SessionRegistry by default) and returns the ReplayResults.
+    """
+    if registry is None:
+        registry = sessions.SessionRegistry()
+    results = ReplayResults()
+    start = time.perf_counter()
+    index = 0
+    for entry in read_recording(filename):
+        if GAME_KEY in entry:
+            # a new game, even if the old one of the session was evicted while recording
+            session_id = entry[GAME_KEY][sessions.SESSION_KEY]
+            registry.remove(session_id)
+            registry.get(session_id).reseed(entry[GAME_KEY][SEED_KEY])
+            continue
+        request_start = time.perf_counter()
+        digest = error = None
+        try:
+            answer = server.process_request(entry[REQUEST_KEY], registry)
+            digest = answer_digest(answer)
+            if digest is None:
+                # streamed answers are encoded while they are consumed
+                for _ in answer:
+                    pass
+        except Exception as err:
+            error = str(err)
+        results.add(index, entry, digest, error, time.perf_counter() - request_start)
+        index += 1
+    results.duration = time.perf_counter() - start
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="UltraMekPy.replay",
+                                     description="Replays a recording of python -m UltraMekPy --record")
+    parser.add_argument("recording")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="replays the recording several times (with fresh games, but warm caches)")
+    parser.add_argument("--output", default=None, help="JSON result file (default: replay_<time>.json)")
+    args = parser.parse_args(argv)
+
+    runs = [replay(args.recording).to_dict() for _ in range(args.repeat)]
+    report = {"recording": args.recording, "runs": runs}
+    output = args.output or time.strftime("replay_%Y%m%d_%H%M%S.json")
+    with open(output, 'w', encoding="utf-8") as fp:
+        json.dump(report, fp, indent=2)
+    for k, summary in enumerate(runs):
+        print(f"Run {k + 1}: {summary['requests']} requests in {summary['duration_s']:.2f}s: "
+              f"{summary['throughput_rps']:.1f} req/s, {summary['mismatches']} mismatches, "
+              f"{summary['unchecked']} unchecked")
+    for request_type, stats in runs[-1]["per_type"].items():
+        recorded, replayed = stats["recorded"], stats["replayed"]
+        print(f"  {request_type}: p50 {replayed['p50_ms']:.2f}ms (recorded {recorded['p50_ms']:.2f}ms) "
+              f"p99 {replayed['p99_ms']:.2f}ms (recorded {recorded['p99_ms']:.2f}ms)")
+    for mismatch in runs[0]["first_mismatches"]:
+        print(f"  Mismatch of request {mismatch['index']} ({mismatch['types']}): "
+              f"{mismatch['recorded']} != {mismatch['replayed']}")
+    print(f"Results written to {output}")
+    return 1 if any(summary["mismatches"] for summary in runs) else 0
+
+
+##########################################################
+# Tests
+#########################################################
+
+class TableRegistry(sessions.SessionRegistry):
+    """
+    Games with two players without forces (players with forces need the MekHQ data).
+    """
+    def create_game_state(self):
+        from .player import Player
+        game_state = super().create_game_state()
+        game_state.players = {name: Player(name, {}) for name in ("p1", "p2")}
+        return game_state
+
+class ReplayTests(unittest.TestCase):
+    """
+    Tests for recording and replaying requests.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, "session.rec")
+        self.unit_handler = server.session_registry.unit_handler
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def record(self, requests):
+        registry = TableRegistry(unit_handler=self.unit_handler)
+        registry.recorder = Recorder(self.filename)
+        for request in requests:
+            try:
+                server.process_request(request, registry)
+            except ValueError:
+                pass
+        registry.recorder.close()
+        return registry.recorder.count
+
+    def test_replay(self):
+        requests = [{"session_id": "table1", "BOARD_REQUEST": {"filename": "test/samples/snow.board"}},
+                    {"session_id": "table1", "HEARTBEAT_REQUEST": {"sent": 1.}},
+                    {"session_id": "table1", "BOARD_REQUEST": {}}]
+        requests += [{"session_id": f"table{k%2 + 1}", "INITIATIVE_REQUEST": {"player": f"p{k%4//2 + 1}",
+                                                                              "round_nr": k//4}}
+                     for k in range(20)]
+        self.assertEqual(self.record(requests), 25)
+        results = replay(self.filename, TableRegistry(unit_handler=self.unit_handler)).to_dict()
+        self.assertEqual(results["requests"], 23)
+        self.assertEqual(results["unchecked"], 1)
+        self.assertEqual(results["mismatches"], 0)
+        self.assertEqual(results["per_type"]["INITIATIVE_REQUEST"]["replayed"]["count"], 20)
+
+        # other seeds roll other dice
+        with open(self.filename, 'r', encoding="utf-8") as fp:
+            entries = [json.loads(line) for line in fp]
+        with open(self.filename, 'w', encoding="utf-8") as fp:
+            for entry in entries:
+                if GAME_KEY in entry:
+                    entry[GAME_KEY][SEED_KEY] += 1
+                fp.write(json.dumps(entry) + NL)
+        results = replay(self.filename, TableRegistry(unit_handler=self.unit_handler)).to_dict()
+        self.assertGreater(results["mismatches"], 0)
+        self.assertEqual(results["first_mismatches"][0]["types"], "INITIATIVE_REQUEST")
+
+    def test_torn_recording(self):
+        self.record([{"session_id": "table1", "HEARTBEAT_REQUEST": {}}])
+        with open(self.filename, 'a', encoding="utf-8") as fp:
+            fp.write('{"request": {"session_id"')
+        entries = list(read_recording(self.filename))
+        self.assertEqual(len(entries), 2)
+        self.assertIn(SEED_KEY, entries[0][GAME_KEY])
+        self.assertIn(DIGEST_KEY, entries[1])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,33 +20,62 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+import hmac
+import importlib
 import json
 import os 
+import sys
+import time
 from copy import deepcopy
 
+from . import batch
 from . import boards
+from . import data
+from . import events as ev
 from . import functions as fn
 from . import game
+from . import metrics as met
 from . import parsers as par
+from . import schema
+from . import wire
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+SCHEMA_FILE = os.path.join(DIR_PATH,"requests.json")
 
-with open(os.path.join(DIR_PATH,"requests.json"),'r') as fp:
-    REQUEST_MAP = json.load(fp)
+# compiled once, every request is validated before it is processed
+VALIDATORS = schema.load_request_schemas(SCHEMA_FILE)
 
 class RequestProcessor:
 
-    def __init__(self):
+    def __init__(self, validators=None):
+        if validators is None:
+            validators = VALIDATORS
         cls_name = self.__class__.__name__
         self.request_type = fn.split_camel_case(cls_name)
         self.request_type = [word.upper() for word in self.request_type]
         self.request_type = "_".join(self.request_type)
+        if self.request_type not in validators:
+            raise ValueError(f"Error: No schema for {self.request_type} in requests.json!")
+        self.validator = validators[self.request_type]
 
     def get_request(self, dic):
         return dic[self.request_type] 
+
+    def validate(self, request):
+        """
+        Raises a schema.ValidationError if the request data is invalid.
+        """
+        self.validator(request)
     
     def _process(self,request,game_state):
         raise NotImplementError("Error: Request processing not implemented yet!")
+
+    def encode_binary(self, result):
+        """
+        Returns the result in binary wire format or None if the
+        request type has none.
+        """
+        return None
     
     def __call__(self, dic, game_state):
         request = dic
@@ -56,13 +85,44 @@ class RequestProcessor:
 
 
 class BoardRequest(RequestProcessor):
+    """
+    Loads a board for the game. If the game already plays on that board,
+    it is kept with its changes, so players joining later get the board
+    as it is now.
+    """
+    JSON_ENCODING = "json"
+    BINARY_ENCODING = "binary"
+    cache = boards.BoardCache()
 
     def _process(self, request, game_state):
         fname = request['filename']
-        b = boards.Board(fname)
-        j = b.to_flat_dict()
-        game_state.setup_board(b)
-        return j
+        with met.metrics.time_stage(met.BOARD_LOAD_STAGE):
+            entry = self.cache.get(fname)
+        board = game_state.join_board(entry.board)
+        if board is not entry.board:
+            # changed during the game, the encodings of the file do not fit
+            return board.to_flat_dict()
+        def encode_json():
+            j = wire.Encoded.from_value(entry.board.to_flat_dict())
+            j.entry = entry
+            return j
+        return entry.encoding(self.JSON_ENCODING, encode_json)
+
+    def encode_binary(self, result):
+        if not isinstance(result, wire.Encoded):
+            return wire.encode_layers(result)
+        return result.entry.encoding(self.BINARY_ENCODING,
+                                     lambda: wire.encode_layers(result.value))
+
+class BoardChangeRequest(RequestProcessor):
+    """
+    Changes hexes of the board of the game (fires, collapsed buildings,
+    craters). The answer is the delta of the changed layer cells (see
+    boards.Board.delta) instead of the whole board, the other players
+    get it as event.
+    """
+    def _process(self, request, game_state):
+        return game_state.change_board(request["changes"])
 
 class PlayerRequest(RequestProcessor):
     
@@ -77,9 +137,137 @@ class InitiativeRequest(RequestProcessor):
         answer = game_state.roll_initiative(request)
         return answer
 
-rtypes = [BoardRequest,PlayerRequest,InitiativeRequest]
+class BatchRequest(RequestProcessor):
+    """
+    Runs a list of requests of the same game in one go. Independent entries
+    run concurrently, entries with 'after' wait for the listed ids.
+    """
+    executor = batch.BatchExecutor()
+
+    def _process(self, request, game_state):
+        def process_entry(entry):
+            # invalid entries fail on their own, like entries failing later
+            processors = []
+            for request_type, request_data in entry.items():
+                if request_type == self.request_type:
+                    raise batch.BatchError("Error: Batches can not be nested!")
+                processor = get_processor(request_type)
+                processor.validate(request_data)
+                processors.append((request_type, processor, request_data))
+            result = {}
+            for request_type, processor, request_data in processors:
+                res = processor(request_data,game_state)
+                result[request_type] = wire.plain(res)
+            return result
+        return self.executor.run(request, process_entry)
+
+class StatsRequest(RequestProcessor):
+    """
+    Returns the request counters, latencies and stage timings of the server.
+    """
+    def _process(self, request, game_state):
+        stats = met.metrics.snapshot()
+        stats["board_cache"] = BoardRequest.cache.stats()
+        return stats
+
+class SubscribeRequest(RequestProcessor):
+    """
+    Subscribes the connection of the request to the events of its game.
+    Subscriptions are counted, every subscribe needs its own unsubscribe.
+    """
+    EVENTS = [ev.INITIATIVE_EVENT, ev.PLAYERS_EVENT, ev.ROUND_EVENT, ev.HOVER_EVENT, ev.BOARD_EVENT]
+
+    def _process(self, request, game_state):
+        subscriber = ev.subscriber_var.get()
+        if subscriber is None:
+            raise ValueError("Error: Events need a persistent connection!")
+        subscriptions = subscriber.subscribe(game_state)
+        return {"events": self.EVENTS, "subscriptions": subscriptions}
+
+class UnsubscribeRequest(RequestProcessor):
+
+    def _process(self, request, game_state):
+        subscriber = ev.subscriber_var.get()
+        if subscriber is None:
+            raise ValueError("Error: Events need a persistent connection!")
+        return {"subscriptions": subscriber.unsubscribe(game_state)}
+
+class HeartbeatRequest(RequestProcessor):
+    """
+    Keeps the game of the session alive, echoes the time sent by the
+    client so it can measure the round trip.
+    """
+    def _process(self, request, game_state):
+        return {"sent": request.get("sent"), "server_time": time.time()}
+
+class HoverRequest(RequestProcessor):
+    """
+    Updates the hex a player points at, the other players get it as event.
+    """
+    def _process(self, request, game_state):
+        x, y = game_state.set_hover(request[game_state.PLAYER_NAME_KEY], request["x"], request["y"])
+        return {"x": x, "y": y}
+
+class ReloadRequest(RequestProcessor):
+    """
+    Reloads the config, the request processors and the unit handler of
+    the server (like SIGHUP). With several workers only the worker of
+    the session reloads. The request needs the reload_token of the admin
+    section of config.json, without a token only SIGHUP reloads.
+    """
+    ADMIN_KEY = "admin"
+    TOKEN_KEY = "reload_token"
+    read_config = staticmethod(data.UnitHandler.read_config)
+
+    def _process(self, request, game_state):
+        # the server imports this module, so it is imported when it is needed
+        from . import server
+        config = self.read_config()
+        token = config.get(self.ADMIN_KEY, {}).get(self.TOKEN_KEY)
+        if not token:
+            raise ValueError("Error: Reloading by request is disabled!")
+        if not hmac.compare_digest(str(token).encode(), request["token"].encode()):
+            raise ValueError("Error: Invalid reload token!")
+        return server.reload_config(config=config)
+
+rtypes = [BoardRequest,BoardChangeRequest,PlayerRequest,InitiativeRequest,BatchRequest,StatsRequest,
+          SubscribeRequest,UnsubscribeRequest,HeartbeatRequest,HoverRequest,ReloadRequest]
 
 request_type_map = {}
 for rtype in rtypes:
     r = rtype()
     request_type_map[r.request_type] = r
+
+def reload_processors(modules=()):
+    """
+    Re-reads requests.json, imports (or reloads) the modules, which add
+    request processors with rtypes lists of their own and their schemas
+    with SCHEMAS dictionaries, and swaps in the new request_type_map.
+    The processors of this module are created again, but keep their
+    class level caches. Requests being processed finish with the old map.
+    Returns the new map.
+    """
+    global VALIDATORS, request_type_map
+    specs = {}
+    processor_types = list(rtypes)
+    for name in modules:
+        module = importlib.reload(sys.modules[name]) if name in sys.modules else importlib.import_module(name)
+        specs.update(getattr(module, "SCHEMAS", {}))
+        processor_types.extend(getattr(module, "rtypes", []))
+    with open(SCHEMA_FILE, 'r', encoding="utf-8") as fp:
+        specs.update(json.load(fp))
+    validators = schema.compile_request_schemas(specs)
+    new_map = {}
+    for rtype in processor_types:
+        r = rtype(validators)
+        new_map[r.request_type] = r
+    VALIDATORS = validators
+    request_type_map = new_map
+    return new_map
+
+def get_processor(request_type):
+    try:
+        return request_type_map[request_type]
+    except KeyError:
+        raise schema.ValidationError(f"Error: Unknown request type {request_type}!",
+                                     [request_type], "request type") from None
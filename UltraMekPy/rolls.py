@@ -21,7 +21,6 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 from abc import ABC, abstractmethod
-import random
 import unittest
 
 class Roll(ABC):
@@ -40,7 +39,7 @@ class Roll(ABC):
         result = self.compute_modifiers()
         eyes = [0]*nr_dices
         for k in range(nr_dices):
-            eyes[k] = random.randint(1,6)
+            eyes[k] = self.game_state.rng.randint(1,6)
             result += eyes[k]
         return result, eyes
     
@@ -0,0 +1,163 @@
+"""
+schema.py - Classes and Tools for validating requests against a schema
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Schema format (requests.json maps every request type to its schema):
+    "str", "int", "number", "bool", "object", "list", "any"  a value of that type
+    [schema]                                                 a list of values
+    {"key": schema, "opt?": schema, "*": schema}             an object with the
+        required key, the optional key opt and any other keys matching "*".
+        Other keys are allowed if there is no "*".
+Schemas are compiled once into nested check functions.
+"""
+import json
+import unittest
+
+OPTIONAL_SUFFIX = "?"
+ANY_KEY = "*"
+TYPES = {"str": (str,), "int": (int,), "number": (int, float), "bool": (bool,),
+         "object": (dict,), "list": (list,), "any": (object,)}
+
+class ValidationError(ValueError):
+    """
+    Invalid request, path is the list of keys and indices leading
+    to the invalid value.
+    """
+    def __init__(self, msg, path=(), expected=None):
+        super().__init__(msg)
+        self.path = list(path)
+        self.expected = expected
+
+    @property
+    def details(self):
+        return {"path": ".".join(str(p) for p in self.path), "expected": self.expected}
+
+def _path(path):
+    return ".".join(str(p) for p in path)
+
+def _compile_type(name):
+    if name not in TYPES:
+        raise ValueError(f"Error: Unknown schema type {name}!")
+    types = TYPES[name]
+    reject_bool = bool not in types and int in types
+    def check(value, path):
+        if not isinstance(value, types) or (reject_bool and isinstance(value, bool)):
+            raise ValidationError(f"Error: Invalid value at {_path(path)}, expected {name}!", path, name)
+    return check
+
+def _compile_list(spec):
+    if len(spec) != 1:
+        raise ValueError("Error: List schemas need exactly one item schema!")
+    check_item = compile_schema(spec[0])
+    def check(value, path):
+        if not isinstance(value, list):
+            raise ValidationError(f"Error: Invalid value at {_path(path)}, expected list!", path, "list")
+        for k, item in enumerate(value):
+            check_item(item, path + (k,))
+    return check
+
+def _compile_object(spec):
+    fields = []
+    for key, val in spec.items():
+        if key == ANY_KEY:
+            continue
+        optional = key.endswith(OPTIONAL_SUFFIX)
+        fields.append((key.rstrip(OPTIONAL_SUFFIX), optional, compile_schema(val)))
+    check_other = compile_schema(spec[ANY_KEY]) if ANY_KEY in spec else None
+    known = {key for key, _, _ in fields}
+    def check(value, path):
+        if not isinstance(value, dict):
+            raise ValidationError(f"Error: Invalid value at {_path(path)}, expected object!", path, "object")
+        for key, optional, check_field in fields:
+            if key in value:
+                check_field(value[key], path + (key,))
+            elif not optional:
+                raise ValidationError(f"Error: Missing field {_path(path + (key,))}!", path + (key,), "field")
+        if check_other is not None:
+            for key, val in value.items():
+                if key not in known:
+                    check_other(val, path + (key,))
+    return check
+
+def compile_schema(spec):
+    """
+    Compiles a schema into a function check(value, path), which raises
+    a ValidationError if value does not match.
+    """
+    if isinstance(spec, str):
+        return _compile_type(spec)
+    if isinstance(spec, list):
+        return _compile_list(spec)
+    if isinstance(spec, dict):
+        return _compile_object(spec)
+    raise ValueError(f"Error: Invalid schema {spec!r}!")
+
+def compile_request_schemas(specs):
+    """
+    Compiles the schemas of all request types into validators, which
+    take the data of a request and raise a ValidationError.
+    """
+    validators = {}
+    for request_type, spec in specs.items():
+        check = compile_schema(spec)
+        validators[request_type] = lambda value, check=check, path=(request_type,): check(value, path)
+    return validators
+
+def load_request_schemas(filename):
+    with open(filename, 'r', encoding="utf-8") as fp:
+        return compile_request_schemas(json.load(fp))
+
+
+##########################################################
+# Tests
+#########################################################
+
+class SchemaTests(unittest.TestCase):
+    """
+    Tests for the schema compiler.
+    """
+    def setUp(self):
+        self.validators = compile_request_schemas({
+            "PLAYER_REQUEST": {ANY_KEY: {"forces": "str", "color?": ["number"]}},
+            "INITIATIVE_REQUEST": {"player": "str", "round_nr": "int"}})
+
+    def assertInvalid(self, request_type, value, path):
+        with self.assertRaises(ValidationError) as cm:
+            self.validators[request_type](value)
+        self.assertEqual(cm.exception.details["path"], path)
+
+    def test_valid(self):
+        self.validators["PLAYER_REQUEST"]({"p1": {"forces": "a.mul", "color": [0.5, 0, 1]}, "p2": {"forces": "b.mul"}})
+        self.validators["INITIATIVE_REQUEST"]({"player": "p1", "round_nr": 1, "extra": None})
+
+    def test_invalid(self):
+        self.assertInvalid("INITIATIVE_REQUEST", {"player": "p1"}, "INITIATIVE_REQUEST.round_nr")
+        self.assertInvalid("INITIATIVE_REQUEST", {"player": "p1", "round_nr": "1"}, "INITIATIVE_REQUEST.round_nr")
+        self.assertInvalid("INITIATIVE_REQUEST", {"player": "p1", "round_nr": True}, "INITIATIVE_REQUEST.round_nr")
+        self.assertInvalid("INITIATIVE_REQUEST", [], "INITIATIVE_REQUEST")
+        self.assertInvalid("PLAYER_REQUEST", {"p1": {"forces": "a.mul", "color": [0, "red"]}},
+                           "PLAYER_REQUEST.p1.color.1")
+        self.assertInvalid("PLAYER_REQUEST", {"p1": "a.mul"}, "PLAYER_REQUEST.p1")
+
+    def test_invalid_schema(self):
+        with self.assertRaises(ValueError):
+            compile_schema({"a": "float"})
+        with self.assertRaises(ValueError):
+            compile_schema(["str", "int"])
@@ -19,15 +19,170 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+import asyncio
+import collections
+import contextvars
+import importlib
+import itertools
 import json
+import logging
+import os
 import socket
 import socketserver
-from .constants import NL
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from .constants import NL, ERROR_KEY, ERROR_DETAILS_KEY
 
+from . import data
+from . import events
+from . import logs
+from . import metrics as met
 from . import requests as req
-from . import game
+from . import schema
+from . import sessions
+from . import wire
 
-game_state = game.GameState()
+IOV_MAX = 1024 # max. number of buffers of one sendmsg
+REQUEST_MODULES_KEY = "request_modules"
+
+logger = logs.get_logger("server")
+
+session_registry = sessions.SessionRegistry()
+_reload_lock = threading.Lock()
+
+def reload_config(registry=None, config=None):
+    """
+    Applies config (default: config.json read again) to the running server:
+    the request processors of the modules listed in request_modules are
+    (re)loaded and the unit handler is replaced if the unit paths changed.
+    The games, the board cache and an unchanged unit handler are kept.
+    """
+    if registry is None:
+        registry = session_registry
+    with _reload_lock:
+        if config is None:
+            config = data.UnitHandler.read_config()
+        processors = req.reload_processors(config.get(REQUEST_MODULES_KEY, []))
+        swapped = registry.reload_unit_handler(config)
+    logger.info("Reloaded config: %d request types, unit handler %s", len(processors),
+                   "replaced" if swapped else "kept")
+    return {"request_types": sorted(processors), "unit_handler_replaced": swapped}
+
+def handle_reload_signal(signum, frame):
+    """
+    Signal handler (SIGHUP) reloading the config in a thread of its own,
+    so that it does not interrupt the request the main thread is processing.
+    """
+    def run():
+        try:
+            reload_config()
+        except Exception as err:
+            logger.error("Could not reload the config: %s", err)
+    threading.Thread(target=run, name="reload", daemon=True).start()
+
+def error_answer(err, request=None):
+    """
+    Encodes an error as answer line (with the request id of the request if it has one).
+    """
+    answer = {}
+    if isinstance(request, dict) and wire.REQUEST_ID_KEY in request:
+        answer[wire.REQUEST_ID_KEY] = request[wire.REQUEST_ID_KEY]
+    answer[ERROR_KEY] = str(err)
+    details = getattr(err, "details", None)
+    if details is not None:
+        answer[ERROR_DETAILS_KEY] = details
+    return wire.encode_answer(answer)
+
+def parse_request(data):
+    with met.metrics.time_stage(met.PARSE_STAGE):
+        try:
+            return json.loads(data.decode())
+        except ValueError:
+            met.metrics.record_request(met.INVALID_REQUEST, 0., True, len(data))
+            raise
+
+def process_request(request, registry, request_bytes=0):
+    """
+    Takes a request dictionary and handles it accordingly
+    """
+    recorder = registry.recorder
+    if recorder is None:
+        return _process_request(request, registry, request_bytes)
+    start = time.perf_counter()
+    try:
+        answer = _process_request(request, registry, request_bytes)
+    except Exception as err:
+        recorder.record(request, None, time.perf_counter() - start, err)
+        raise
+    recorder.record(request, answer, time.perf_counter() - start)
+    return answer
+
+def _process_request(request, registry, request_bytes):
+    metrics = met.metrics
+    # reject invalid requests before any of their parts is processed or a game is created,
+    # they are counted as errors of their type (or as invalid requests if it is unknown)
+    rejected = met.INVALID_REQUEST
+    try:
+        if not isinstance(request, dict):
+            raise schema.ValidationError("Error: Requests must be JSON objects!", [], "object")
+        request, options = wire.split_options(request)
+        processors = [(request_type, req.get_processor(request_type), request_data)
+                      for request_type, request_data in request.items() if request_type != sessions.SESSION_KEY]
+        for request_type, processor, request_data in processors:
+            rejected = request_type
+            processor.validate(request_data)
+    except ValueError:
+        metrics.record_request(rejected, 0., True, request_bytes)
+        raise
+    binary = options.get(wire.FORMAT_KEY) == wire.BINARY_FORMAT
+    game_state, request = registry.split_request(request)
+    result = {}
+    if wire.REQUEST_ID_KEY in options:
+        result[wire.REQUEST_ID_KEY] = options[wire.REQUEST_ID_KEY]
+    blobs = []
+    for request_type, processor, request_data in processors:
+        with metrics.time_request(request_type, request_bytes):
+            res = processor(request_data,game_state)
+            if binary:
+                blob = processor.encode_binary(res)
+                if blob is not None:
+                    res = wire.add_blob(blobs, blob)
+        result[request_type] = res
+    with metrics.time_stage(met.SERIALIZATION_STAGE):
+        answer = wire.encode_answer_buffers(result, blobs, options)
+    size = wire.answer_size(answer)
+    if size is not None:
+        metrics.record_answer(request.keys(), size)
+    return answer
+
+def iter_chunks(answer):
+    """
+    Answers are either bytes, wire.Buffers or iterators over streamed chunks.
+    """
+    if isinstance(answer, (bytes, bytearray, memoryview)):
+        return (answer,)
+    return answer
+
+def send_buffers(sock, buffers):
+    """
+    Sends a list of buffers with scatter writes (sendmsg) without joining them.
+    """
+    if not hasattr(sock, "sendmsg"):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    views = collections.deque(memoryview(buffer).cast("B") for buffer in buffers if len(buffer))
+    while views:
+        sent = sock.sendmsg(list(itertools.islice(views, IOV_MAX)))
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.popleft())
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
 
 class UltraMekHandler(socketserver.StreamRequestHandler):
     """
@@ -36,40 +191,566 @@ class UltraMekHandler(socketserver.StreamRequestHandler):
 
     def setup(self):
         super().setup()
-        self.setup_game_state()
+        self.setup_sessions()
     
-    def setup_game_state(self):
-        self.game_state = game_state
+    def setup_sessions(self):
+        self.sessions = session_registry
     
     def request_processor(self, request):
         """
         Takes a request dictionary and handles it accordingly
         """
-        result = {}
-        for request_type, request_data in request.items():
-            res = req.request_type_map[request_type](request_data,self.game_state)
-            result[request_type] = res
-        return json.dumps(result) + NL
+        return process_request(request, self.sessions, len(self.data))
     
     def handle(self): # must be implemented
         # self.rfile is a file-like object created by the handler;
         # we can now use e.g. readline() instead of raw recv() calls
         self.data = self.rfile.readline().strip()
-        print("Data: ",self.data)
-        print("{}:{} sent:".format(self.client_address[0],self.client_address[1]))
+        logs.new_request_id()
+        log_payloads = logger.isEnabledFor(logging.DEBUG) and logs.sampled()
+        if log_payloads:
+            logger.debug("%s:%s sent: %s", self.client_address[0], self.client_address[1],
+                         logs.Payload(self.data))
+        request = None
         try:
-            request = json.loads(self.data.decode())
-            print(request)
+            request = parse_request(self.data)
             result = self.request_processor(request)
             # Likewise, self.wfile is a file-like object used to write back
             # to the client
-            print("Answer: ", result)
-            #self.wfile.write(self.data.upper())
-            self.wfile.write(result.encode())
-            #self.wfile.write("Help!\n".encode())
+            if isinstance(result, wire.Buffers):
+                send_buffers(self.connection, result)
+            else:
+                for chunk in iter_chunks(result):
+                    self.wfile.write(chunk)
+            if log_payloads:
+                logger.debug("Answer: %s", logs.Payload(result))
         except Exception as jerr:
-            print("Invalid Request Data!")
-            print("Data: ",self.data,"Error: ", jerr)
-            
+            logger.warning("Invalid Request Data! Error: %s Data: %s", jerr, logs.Payload(self.data))
+            self.wfile.write(error_answer(jerr, request))
+
+
+class ThreadedUltraMekServer(socketserver.ThreadingTCPServer):
+    """
+    TCP Server which handles every connection in its own thread, so slow
+    requests (e.g. parsing a large board) do not block fast ones.
+    The games guard their state with their own locks.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 40
+
+
+class AsyncUltraMekServer:
+    """
+    asyncio based TCP Server for UltraMek. Connections stay open and every
+    connection may send any number of newline delimited JSON requests.
+    Requests are pipelined, i.e. the client does not have to wait for an
+    answer before sending the next request, and answers are always
+    written back in the order the requests came in.
+    """
+    PIPELINE_DEPTH = 64
+    LIMIT = 2**24 # max. length of a single request line
+
+    def __init__(self, host, port, negotiate=True):
+        self.host = host
+        self.port = port
+        # remember the connection options (compression, stream) of the connections,
+        # not for connections shared by the requests of several clients
+        self.negotiate = negotiate
+        self.server = None
+        self.connections = set()
+        self.setup_sessions()
+
+    def setup_sessions(self):
+        self.sessions = session_registry
+
+    def process(self, request, request_bytes=0):
+        """
+        Processes one decoded request and returns the encoded answer.
+        Invalid requests are answered with an error, so the answers
+        stay in sync with the requests of a pipelined connection.
+        """
+        try:
+            answer = process_request(request, self.sessions, request_bytes)
+        except Exception as jerr:
+            logger.warning("Invalid Request Data! Error: %s Data: %s", jerr, logs.Payload(request))
+            return error_answer(jerr, request)
+        if logger.isEnabledFor(logging.DEBUG) and logs.sampled():
+            logger.debug("Answer: %s", logs.Payload(answer))
+        return answer
+
+    def dispatch(self, request, data):
+        """
+        Schedules the processing of a decoded request and returns an
+        awaitable for its answer. data is the raw request line.
+        The request is processed on a thread of the default executor
+        once its answer is awaited, so the requests of a connection are
+        processed in order without blocking the other connections.
+        """
+        # the request id and the subscriber of the connection are context variables
+        context = contextvars.copy_context()
+        async def run():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, context.run, self.process, request, len(data))
+        return run()
+
+    def submit(self, data, connection_options=None):
+        """
+        Decodes a request line and returns an awaitable for its answer.
+        connection_options holds the wire options negotiated for the connection.
+        """
+        logs.new_request_id()
+        request = None
+        try:
+            request = parse_request(data)
+            if connection_options is not None:
+                request, changed = wire.negotiate(request, connection_options)
+                if changed:
+                    # forwarded requests carry the options of their connection
+                    data = json.dumps(request).encode()
+        except ValueError as jerr:
+            if request is not None:
+                # invalid options, requests which can not be parsed are counted by parse_request
+                met.metrics.record_request(met.INVALID_REQUEST, 0., True, len(data))
+            logger.warning("Invalid Request Data! Error: %s Data: %s", jerr, logs.Payload(data))
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(error_answer(jerr, request))
+            return future
+        return self.dispatch(request, data)
+
+    async def _respond(self, pending, writer, write_lock):
+        while True:
+            future = await pending.get()
+            if future is None:
+                break
+            try:
+                answer = await future
+            except Exception as err:
+                logger.warning("Could not answer a request! Error: %s", err)
+                answer = error_answer(err)
+            # events of subscribed games are written between the answers
+            async with write_lock:
+                if isinstance(answer, (bytes, bytearray, memoryview)):
+                    writer.write(answer)
+                    if pending.empty():
+                        await writer.drain()
+                elif isinstance(answer, wire.Buffers):
+                    writer.writelines(answer)
+                    if pending.empty():
+                        await writer.drain()
+                else:
+                    await self._write_stream(answer, writer)
+
+    async def _write_stream(self, answer, writer):
+        """
+        Writes a streamed answer, which is encoded while it is written. If
+        encoding fails before anything is written, the request is answered
+        with an error. Afterwards the frames are broken, so the connection
+        is closed instead of leaving the client waiting.
+        """
+        written = False
+        try:
+            for chunk in answer:
+                writer.write(chunk)
+                written = True
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as err:
+            logger.warning("Could not encode an answer! Error: %s", err)
+            if written:
+                writer.close()
+                return
+            writer.write(error_answer(err))
+            await writer.drain()
+
+    def release_subscriber(self, subscriber):
+        """
+        Called when a connection closes.
+        """
+        subscriber.close()
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        pending = asyncio.Queue(self.PIPELINE_DEPTH)
+        write_lock = asyncio.Lock()
+        responder = asyncio.create_task(self._respond(pending, writer, write_lock))
+        subscriber = events.Subscriber(writer, write_lock)
+        # requests of this connection are processed in the context of its task
+        events.subscriber_var.set(subscriber)
+        connection_options = {} if self.negotiate else None
+        try:
+            while not responder.done():
+                data = await reader.readline()
+                if not data:
+                    break
+                data = data.strip()
+                if data:
+                    await pending.put(self.submit(data, connection_options))
+            await pending.put(None)
+            await responder
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            responder.cancel()
+            # requests which were never answered are not processed anymore
+            while not pending.empty():
+                awaitable = pending.get_nowait()
+                if asyncio.iscoroutine(awaitable):
+                    awaitable.close()
+            self.release_subscriber(subscriber)
+            writer.close()
+            self.connections.discard(task)
+
+    async def start(self, **kwargs):
+        self.server = await asyncio.start_server(self.handle_connection, self.host,
+                                                 self.port, limit=self.LIMIT, **kwargs)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def close(self, timeout=1.):
+        """
+        Stops accepting connections and closes the open ones after
+        giving them timeout seconds to finish.
+        """
+        self.server.close()
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=timeout)
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve_forever())
+
+
+##########################################################
+# Tests
+#########################################################
+
+class AsyncServerTests(unittest.TestCase):
+    """
+    Tests for the AsyncUltraMekServer class.
+    """
+    def setUp(self):
+        self.board_request = {"BOARD_REQUEST":{"filename":"test/samples/snow.board"}}
+        self.sessions = sessions.SessionRegistry(unit_handler=session_registry.unit_handler)
+
+    async def _send_pipelined(self, lines):
+        server = AsyncUltraMekServer("127.0.0.1", 0)
+        server.sessions = self.sessions
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port, limit=server.LIMIT)
+        writer.write(b"".join(lines))
+        await writer.drain()
+        answers = [wire.decode_answer(await wire.read_answer(reader)) for line in lines]
+        writer.close()
+        await server.close()
+        return answers
+
+    def test_pipelined_requests(self):
+        lines = [(json.dumps(self.board_request) + NL).encode(),
+                 b"no json" + NL.encode(),
+                 (json.dumps(self.board_request) + NL).encode()]
+        answers = asyncio.run(self._send_pipelined(lines))
+        self.assertEqual(len(answers), 3)
+        self.assertIn("BOARD_REQUEST", answers[0])
+        self.assertIn(ERROR_KEY, answers[1])
+        self.assertEqual(answers[0], answers[2])
+        self.assertEqual(answers[0]["BOARD_REQUEST"]["size_x"], 16)
+
+    def test_compression(self):
+        compressed = dict(self.board_request, compression=wire.ZLIB)
+        lines = [(json.dumps(compressed) + NL).encode(),
+                 (json.dumps(dict(self.board_request, format=wire.BINARY_FORMAT)) + NL).encode(),
+                 (json.dumps(dict(self.board_request, compression=wire.NO_COMPRESSION)) + NL).encode()]
+        raw = []
+        async def send():
+            server = AsyncUltraMekServer("127.0.0.1", 0)
+            server.sessions = self.sessions
+            await server.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"".join(lines))
+            for line in lines:
+                raw.append(await wire.read_answer(reader))
+            writer.close()
+            await server.close()
+        asyncio.run(send())
+        self.assertTrue(wire.STREAM_PATTERN.match(raw[0]))
+        self.assertTrue(wire.STREAM_PATTERN.match(raw[1]))
+        self.assertFalse(wire.STREAM_PATTERN.match(raw[2]))
+        self.assertLess(len(raw[0]), len(raw[2]))
+        answers = [wire.decode_answer(answer) for answer in raw]
+        self.assertEqual(answers[0], answers[1])
+        self.assertEqual(answers[0], answers[2])
+
+    def test_invalid_options(self):
+        lines = [(json.dumps(dict(self.board_request, compression="lzma", request_id=1)) + NL).encode(),
+                 (json.dumps(dict(self.board_request, stream="yes")) + NL).encode(),
+                 (json.dumps(self.board_request) + NL).encode()]
+        answers = asyncio.run(asyncio.wait_for(self._send_pipelined(lines), 5.))
+        self.assertEqual(answers[0][wire.REQUEST_ID_KEY], 1)
+        self.assertEqual(answers[0]["details"]["path"], wire.COMPRESSION_KEY)
+        self.assertEqual(answers[1]["details"]["path"], wire.STREAM_KEY)
+        # the invalid options are not remembered for the connection
+        self.assertEqual(answers[2]["BOARD_REQUEST"]["size_x"], 16)
+
+    def test_blocking_request(self):
+        async def send():
+            server = AsyncUltraMekServer("127.0.0.1", 0)
+            server.sessions = self.sessions
+            release = threading.Event()
+            released = []
+            process = server.process
+            def blocking(request, request_bytes=0):
+                if "blocking" in request:
+                    released.append(release.wait(2.))
+                    request = self.board_request
+                return process(request, request_bytes)
+            server.process = blocking
+            await server.start()
+            slow_reader, slow_writer = await asyncio.open_connection("127.0.0.1", server.port)
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            slow_writer.write((json.dumps({"blocking": True}) + NL + json.dumps(self.board_request) + NL).encode())
+            writer.write((json.dumps(self.board_request) + NL).encode())
+            # the other connection is answered while the first request is processed
+            answers = [wire.decode_answer(await wire.read_answer(reader))]
+            release.set()
+            answers += [wire.decode_answer(await wire.read_answer(slow_reader)) for k in range(2)]
+            for stream in (writer, slow_writer):
+                stream.close()
+            await server.close()
+            return answers, released
+        answers, released = asyncio.run(asyncio.wait_for(send(), 5.))
+        self.assertEqual(released, [True])
+        self.assertEqual(answers[0], answers[1])
+        self.assertEqual(answers[1], answers[2])
+
+    def test_broken_stream(self):
+        async def send():
+            server = AsyncUltraMekServer("127.0.0.1", 0)
+            server.sessions = self.sessions
+            def broken(*args):
+                raise ValueError("Error: Broken answer!")
+                yield
+            server.process = lambda request, request_bytes=0: broken()
+            await server.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write((json.dumps(self.board_request) + NL).encode()*2)
+            answers = [wire.decode_answer(await wire.read_answer(reader)) for k in range(2)]
+            writer.close()
+            await server.close()
+            return answers
+        answers = asyncio.run(asyncio.wait_for(send(), 5.))
+        self.assertEqual(answers[0][ERROR_KEY], "Error: Broken answer!")
+        self.assertEqual(answers[0], answers[1])
+
+    def test_binary_format(self):
+        lines = [(json.dumps(dict(self.board_request, format=wire.BINARY_FORMAT)) + NL).encode(),
+                 (json.dumps(self.board_request) + NL).encode()]
+        answers = asyncio.run(self._send_pipelined(lines))
+        self.assertEqual(answers[0], answers[1])
+
+    def test_sessions(self):
+        tables = ["table1", "table2"]
+        lines = [(json.dumps(dict(self.board_request, session_id=t)) + NL).encode() for t in tables]
+        answers = asyncio.run(self._send_pipelined(lines))
+        self.assertEqual(answers[0], answers[1])
+        self.assertNotIn(sessions.SESSION_KEY, answers[0])
+        for t in tables:
+            self.assertIn(t, self.sessions)
+        self.assertEqual(len(self.sessions), 2)
+
+    def test_batch(self):
+        entries = [{"id":"board1","BOARD_REQUEST":{"filename":"test/samples/snow.board"}},
+                   {"id":"board2","after":["board1"],"BOARD_REQUEST":{"filename":"test/samples/test.board"}},
+                   {"id":"bad","INITIATIVE_REQUEST":{}}]
+        lines = [(json.dumps({"session_id":"batch","BATCH_REQUEST":entries}) + NL).encode()]
+        answer = asyncio.run(self._send_pipelined(lines))[0]["BATCH_REQUEST"]
+        self.assertEqual([a["id"] for a in answer], ["board1","board2","bad"])
+        self.assertEqual(answer[0]["BOARD_REQUEST"]["size_x"], 16)
+        self.assertIn("BOARD_REQUEST", answer[1])
+        self.assertIn(ERROR_KEY, answer[2])
+        self.assertEqual(self.sessions.get("batch").board.size_x, answer[1]["BOARD_REQUEST"]["size_x"])
+
+    def test_validation(self):
+        lines = [(json.dumps({"session_id":"invalid", "BOARD_REQUEST":{"filename":"test/samples/snow.board"},
+                              "INITIATIVE_REQUEST":{"player":"player1"}}) + NL).encode(),
+                 (json.dumps({"session_id":"invalid", "UNKNOWN_REQUEST":{}}) + NL).encode(),
+                 b"[1, 2]" + NL.encode()]
+        answers = asyncio.run(self._send_pipelined(lines))
+        self.assertEqual(answers[0][ERROR_DETAILS_KEY], {"path":"INITIATIVE_REQUEST.round_nr", "expected":"field"})
+        self.assertEqual(answers[1][ERROR_DETAILS_KEY]["path"], "UNKNOWN_REQUEST")
+        self.assertIn(ERROR_KEY, answers[2])
+        self.assertNotIn("invalid", self.sessions)
+
+    def test_rejected_metrics(self):
+        met.metrics.reset()
+        lines = [(json.dumps({"INITIATIVE_REQUEST": {"player": "player1"}}) + NL).encode(),
+                 (json.dumps({"UNKNOWN_REQUEST": {}}) + NL).encode(),
+                 (json.dumps(dict(self.board_request, compression="lzma")) + NL).encode(),
+                 b"no json" + NL.encode()]
+        asyncio.run(self._send_pipelined(lines))
+        requests = met.metrics.snapshot()["requests"]
+        self.assertEqual(requests["INITIATIVE_REQUEST"]["errors"], 1)
+        self.assertEqual(requests[met.INVALID_REQUEST]["count"], 3)
+        self.assertEqual(requests[met.INVALID_REQUEST]["errors"], 3)
+        self.assertNotIn("UNKNOWN_REQUEST", requests)
+
+    def test_events(self):
+        from .client import AsyncClient
+        from .player import Player
+        game_state = self.sessions.get("events")
+        for name in ("player1", "player2"):
+            game_state.players[name] = Player(name, {})
+        async def run():
+            server = AsyncUltraMekServer("127.0.0.1", 0)
+            server.sessions = self.sessions
+            await server.start()
+            options = {"session_id": "events"}
+            clients = [AsyncClient(server.port, options=options) for k in range(2)]
+            for client in clients:
+                answer = await client.request({"SUBSCRIBE_REQUEST": {}})
+                self.assertEqual(answer["SUBSCRIBE_REQUEST"]["subscriptions"], 1)
+            answer = await clients[0].request({"INITIATIVE_REQUEST": {"player": "player1", "round_nr": 1}})
+            received = [[await client.next_event(1.) for k in range(2)] for client in clients]
+            await clients[1].request({"UNSUBSCRIBE_REQUEST": {}})
+            await clients[0].request({"INITIATIVE_REQUEST": {"player": "player2", "round_nr": 1}})
+            last = await clients[0].next_event(1.)
+            self.assertTrue(clients[1].events.empty())
+            for client in clients:
+                await client.close()
+            await server.close()
+            return answer, received, last
+        answer, received, last = asyncio.run(run())
+        self.assertEqual(received[0], received[1])
+        self.assertEqual([event["type"] for event in received[0]], [events.ROUND_EVENT, events.INITIATIVE_EVENT])
+        self.assertEqual(received[0][1]["data"], answer["INITIATIVE_REQUEST"])
+        self.assertEqual(received[0][1]["session_id"], "events")
+        self.assertEqual(last["data"]["player"], "player2")
+        self.assertEqual(len(game_state.subscribers), 0)
+
+
+class ThreadedServerTests(unittest.TestCase):
+    """
+    Tests for the ThreadedUltraMekServer class.
+    """
+    def setUp(self):
+        self.server = ThreadedUltraMekServer(("127.0.0.1", 0), UltraMekHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval":0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_concurrent_requests(self):
+        answers = {}
+        def send(table):
+            request = {"session_id":table,"BOARD_REQUEST":{"filename":"test/samples/snow.board"}}
+            with socket.create_connection(self.server.server_address) as sock:
+                sock.sendall((json.dumps(request) + NL).encode())
+                with sock.makefile('rb') as fp:
+                    answers[table] = json.loads(fp.readline())
+        threads = [threading.Thread(target=send, args=(f"table{k}",)) for k in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(answers), 4)
+        self.assertTrue(all(answer["BOARD_REQUEST"]["size_x"] == 16 for answer in answers.values()))
+
+    def test_send_buffers(self):
+        buffers = [b"a"*100000, b"", memoryview(b"b"*70000), wire.Encoded(b"c"*10)]
+        left, right = socket.socketpair()
+        with left, right:
+            thread = threading.Thread(target=send_buffers, args=(left, buffers))
+            thread.start()
+            received = b""
+            while len(received) < 170010:
+                received += right.recv(2**16)
+            thread.join()
+        self.assertEqual(received, b"".join(buffers))
+
+class ReloadTests(unittest.TestCase):
+    """
+    Tests for reloading the config of a running server.
+    """
+    PLUGIN = (
+        "from UltraMekPy import requests as req\n"
+        "SCHEMAS = {'PING_REQUEST': {}}\n"
+        "class PingRequest(req.RequestProcessor):\n"
+        "    def _process(self, request, game_state):\n"
+        "        return {'pong': VERSION}\n"
+        "rtypes = [PingRequest]\n")
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        sys.path.insert(0, self.tmp_dir.name)
+        self.unit_handler = session_registry.unit_handler
+        self.registry = sessions.SessionRegistry(unit_handler=self.unit_handler)
+        self.config = data.UnitHandler.read_config()
+
+    def tearDown(self):
+        sys.path.remove(self.tmp_dir.name)
+        sys.modules.pop("ultramek_plugin", None)
+        req.reload_processors()
+        self.tmp_dir.cleanup()
+
+    def write_plugin(self, version):
+        filename = os.path.join(self.tmp_dir.name, "ultramek_plugin.py")
+        with open(filename, 'w', encoding="utf-8") as fp:
+            fp.write(self.PLUGIN + f"VERSION = {version}\n")
+        # versions written within a second would look unchanged to the bytecode cache
+        os.utime(filename, (version, version))
+        importlib.invalidate_caches()
+
+    def ping(self):
+        request = {"session_id": "table1", "PING_REQUEST": {}}
+        return wire.decode_answer(wire.Buffers([process_request(request, self.registry)]).join())
+
+    def test_reload_processors(self):
+        with self.assertRaises(schema.ValidationError):
+            self.ping()
+        config = dict(self.config, request_modules=["ultramek_plugin"])
+        for version in (1, 2):
+            self.write_plugin(version)
+            summary = reload_config(self.registry, config)
+            self.assertIn("PING_REQUEST", summary["request_types"])
+            self.assertEqual(self.ping()["PING_REQUEST"], {"pong": version})
+        self.assertFalse(summary["unit_handler_replaced"])
+        self.assertIs(self.registry.unit_handler, self.unit_handler)
+        reload_config(self.registry, self.config)
+        with self.assertRaises(schema.ValidationError):
+            self.ping()
 
+    def test_reload_unit_handler(self):
+        game_state = self.registry.get("table1")
+        os.makedirs(os.path.join(self.tmp_dir.name, data.UnitHandler.GFX_PATH))
+        summary = reload_config(self.registry, dict(self.config, units=self.tmp_dir.name))
+        self.assertTrue(summary["unit_handler_replaced"])
+        self.assertIs(self.registry.get("table1"), game_state)
+        self.assertIsNot(game_state.unit_handler, self.unit_handler)
+        self.assertEqual(game_state.unit_handler.units_path, self.tmp_dir.name)
+        self.assertIs(self.registry.create_game_state().unit_handler, game_state.unit_handler)
 
+    def test_reload_request(self):
+        processor = req.get_processor("RELOAD_REQUEST")
+        request = {"session_id": "table1", "RELOAD_REQUEST": {"token": "secret"}}
+        for admin in ({}, {"reload_token": None}, {"reload_token": "other"}):
+            processor.read_config = lambda: dict(self.config, admin=admin)
+            with self.assertRaises(ValueError):
+                process_request(request, self.registry)
+        processor.read_config = lambda: dict(self.config, admin={"reload_token": "secret"})
+        answer = wire.decode_answer(wire.Buffers([process_request(request, self.registry)]).join())
+        self.assertIn("RELOAD_REQUEST", answer["RELOAD_REQUEST"]["request_types"])
@@ -0,0 +1,188 @@
+"""
+sessions.py - Classes and Tools for hosting several games in one server
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com 
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+import threading
+import time
+import unittest
+
+from . import data
+from . import game
+from . import parsers as par
+
+SESSION_KEY = "session_id"
+DEFAULT_SESSION = "default"
+
+class SessionRegistry:
+    """
+    Class to manage the games of a server. Every game has its own GameState
+    which is created on the first request of its session and evicted
+    after it was idle for idle_timeout seconds.
+    The unit handler and the mul parser are read only and shared by all games.
+    """
+    IDLE_TIMEOUT = 4*3600.
+    EVICTION_INTERVAL = 60.
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, unit_handler=None, mul_parser=None):
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.last_access = {}
+        self.last_eviction = time.monotonic()
+        self._unit_handler = unit_handler
+        self._mul_parser = mul_parser
+        # journal.Journal of the games (set by its recovery)
+        self.journal = None
+        # replay.Recorder the requests and the seeds of new games are recorded to
+        self.recorder = None
+        self.lock = threading.RLock()
+
+    @property
+    def unit_handler(self):
+        with self.lock:
+            if self._unit_handler is None:
+                self._unit_handler = data.UnitHandler()
+            return self._unit_handler
+
+    @property
+    def mul_parser(self):
+        with self.lock:
+            if self._mul_parser is None:
+                self._mul_parser = par.MulParser()
+            return self._mul_parser
+
+    def set_unit_handler(self, unit_handler):
+        """
+        Swaps the unit handler of the registry and all its games at once
+        (e.g. after the unit paths changed). Games keep their state,
+        requests being processed finish with the old handler.
+        """
+        with self.lock:
+            self._unit_handler = unit_handler
+            for game_state in self.sessions.values():
+                game_state.unit_handler = unit_handler
+
+    def reload_unit_handler(self, config):
+        """
+        Replaces the unit handler if config points to other unit paths
+        than the current one and returns True if it did.
+        """
+        with self.lock:
+            current = self._unit_handler
+        if current is None or current.uses_paths_of(config):
+            return False
+        self.set_unit_handler(data.UnitHandler(config))
+        return True
+
+    def create_game_state(self):
+        return game.GameState(unit_handler=self.unit_handler, mul_parser=self.mul_parser)
+
+    def get(self, session_id=DEFAULT_SESSION):
+        """
+        Returns the GameState of the session and creates it if necessary.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_eviction > self.EVICTION_INTERVAL:
+                self.evict_idle(now)
+            game_state = self.sessions.get(session_id)
+            if game_state is None:
+                game_state = self.create_game_state()
+                game_state.session_id = session_id
+                game_state.journal = self.journal
+                self.sessions[session_id] = game_state
+                if self.recorder is not None:
+                    self.recorder.record_game(session_id, game_state.seed)
+            self.last_access[session_id] = now
+        return game_state
+
+    def remove(self, session_id):
+        with self.lock:
+            self.last_access.pop(session_id, None)
+            game_state = self.sessions.pop(session_id, None)
+            if game_state is not None and self.journal is not None:
+                self.journal.remove(session_id)
+            return game_state
+
+    def evict_idle(self, now=None):
+        """
+        Removes all games which were idle for longer than idle_timeout
+        and returns their session ids.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self.last_eviction = now
+            idle = [sid for sid, last in self.last_access.items()
+                    if now - last > self.idle_timeout]
+            for sid in idle:
+                self.remove(sid)
+        return idle
+
+    def split_request(self, request):
+        """
+        Splits the session id from a request and returns the GameState
+        of the session together with the remaining request.
+        """
+        request = dict(request)
+        session_id = request.pop(SESSION_KEY, DEFAULT_SESSION)
+        return self.get(str(session_id)), request
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+##########################################################
+# Tests
+#########################################################
+
+class SessionRegistryTests(unittest.TestCase):
+    """
+    Tests for the SessionRegistry class.
+    """
+    def setUp(self):
+        self.registry = SessionRegistry(idle_timeout=10.)
+
+    def test_get(self):
+        g1 = self.registry.get("table1")
+        g2 = self.registry.get("table2")
+        self.assertIsNot(g1, g2)
+        self.assertIs(g1, self.registry.get("table1"))
+        self.assertEqual(len(self.registry), 2)
+        self.assertIs(g1.unit_handler, g2.unit_handler)
+        self.assertIs(g1.mul_parser, g2.mul_parser)
+
+    def test_evict_idle(self):
+        self.registry.get("table1")
+        self.registry.get("table2")
+        self.registry.last_access["table1"] -= 20.
+        evicted = self.registry.evict_idle()
+        self.assertEqual(evicted, ["table1"])
+        self.assertNotIn("table1", self.registry)
+        self.assertIn("table2", self.registry)
+
+    def test_split_request(self):
+        game_state, request = self.registry.split_request({SESSION_KEY: "table1", "BOARD_REQUEST": {}})
+        self.assertIs(game_state, self.registry.get("table1"))
+        self.assertEqual(request, {"BOARD_REQUEST": {}})
+        game_state, request = self.registry.split_request({"BOARD_REQUEST": {}})
+        self.assertIs(game_state, self.registry.get(DEFAULT_SESSION))
@@ -0,0 +1,313 @@
+"""
+udp.py - Classes and Tools for the UDP fast path of the server
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Every datagram is one JSON request like on TCP, restricted to small request
+types (UDP_REQUEST_TYPES). Its request_id is an integer sequence number,
+increasing per client (address). A datagram with the last sequence number
+is a duplicate and gets the cached answer again without being processed,
+so clients can simply resend on timeouts. Datagrams with older sequence
+numbers are stale and dropped.
+"""
+import asyncio
+import contextvars
+import json
+import socket
+import threading
+import time
+import unittest
+
+from . import logs
+from . import schema
+from . import server
+from . import sessions
+from . import wire
+
+UDP_REQUEST_TYPES = frozenset(["HEARTBEAT_REQUEST", "HOVER_REQUEST", "INITIATIVE_REQUEST"])
+MAX_DATAGRAM = 1400 # answers have to fit into one packet without fragmentation
+STREAM_TIMEOUT = 30.
+
+logger = logs.get_logger("udp")
+
+class SequenceStream:
+    """
+    Sequence number and cached answer of the last datagram of a client.
+    """
+    __slots__ = ("seq", "answer", "last_access")
+
+    def __init__(self):
+        self.seq = -1
+        self.answer = None
+        self.last_access = time.monotonic()
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    """
+    Answers request datagrams with the request processors of the TCP servers.
+    Clients are forgotten after stream_timeout seconds without datagrams, so
+    a restarted client may start its sequence numbers again.
+    """
+    def __init__(self, sessions=None, stream_timeout=STREAM_TIMEOUT):
+        self.sessions = sessions if sessions is not None else server.session_registry
+        self.stream_timeout = stream_timeout
+        self.streams = {}
+        self.last_eviction = time.monotonic()
+        self.transport = None
+        self.stats = {"received": 0, "duplicates": 0, "stale": 0, "errors": 0}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        logs.new_request_id()
+        self.stats["received"] += 1
+        request, stream, answer = self.admit(data, addr)
+        if request is None:
+            if answer is not None:
+                self.transport.sendto(answer, addr)
+            return
+        # requests wait for the lock of their game, so they are processed on the
+        # executor (with the request id of their context) instead of the event loop
+        context = contextvars.copy_context()
+        future = asyncio.get_running_loop().run_in_executor(
+            None, context.run, self.answer_request, request, len(data))
+        def send(future):
+            answer = self.finish(stream, request[wire.REQUEST_ID_KEY], *future.result())
+            self.transport.sendto(answer, addr)
+        future.add_done_callback(send)
+
+    def error_received(self, exc):
+        logger.warning("UDP error: %s", exc)
+
+    def get_stream(self, addr, now):
+        if now - self.last_eviction > self.stream_timeout:
+            self.last_eviction = now
+            self.streams = {key: stream for key, stream in self.streams.items()
+                            if now - stream.last_access <= self.stream_timeout}
+        stream = self.streams.get(addr)
+        if stream is None:
+            stream = self.streams[addr] = SequenceStream()
+        stream.last_access = now
+        return stream
+
+    @staticmethod
+    def check_request(request):
+        if not isinstance(request, dict):
+            raise schema.ValidationError("Error: Requests must be JSON objects!", [], "object")
+        seq = request.get(wire.REQUEST_ID_KEY)
+        if not isinstance(seq, int) or isinstance(seq, bool):
+            raise schema.ValidationError("Error: UDP requests need an integer request_id!",
+                                         [wire.REQUEST_ID_KEY], "int")
+        for key in request:
+            if key in (sessions.SESSION_KEY, wire.REQUEST_ID_KEY):
+                continue
+            if key in wire.OPTION_KEYS:
+                raise schema.ValidationError(f"Error: Option {key} is not supported over UDP!", [key], "option")
+            if key not in UDP_REQUEST_TYPES:
+                raise schema.ValidationError(f"Error: {key} is not allowed over UDP!", [key], "udp request type")
+        return seq
+
+    def admit(self, data, addr):
+        """
+        Parses a datagram and checks its sequence number. Returns the request
+        and its stream if it has to be processed, otherwise (None, None, answer)
+        with the answer datagram (None if nothing is sent back).
+        """
+        request = None
+        try:
+            request = server.parse_request(data)
+            seq = self.check_request(request)
+        except ValueError as err:
+            self.stats["errors"] += 1
+            logger.warning("Invalid UDP Data! Error: %s Data: %s", err, logs.Payload(data))
+            return None, None, server.error_answer(err, request)
+
+        stream = self.get_stream(addr, time.monotonic())
+        if seq == stream.seq:
+            self.stats["duplicates"] += 1
+            return None, None, stream.answer
+        if seq < stream.seq:
+            self.stats["stale"] += 1
+            return None, None, None
+        # duplicates arriving while the request is processed get no answer, the client resends
+        stream.seq = seq
+        stream.answer = None
+        return request, stream, None
+
+    def answer_request(self, request, request_bytes):
+        """
+        Processes an admitted request. Returns the answer datagram and
+        whether the request failed.
+        """
+        try:
+            answer = server.process_request(request, self.sessions, request_bytes)
+            if isinstance(answer, wire.Buffers):
+                answer = answer.join()
+            if len(answer) > MAX_DATAGRAM:
+                raise ValueError("Error: Answer is too large for UDP!")
+        except Exception as err:
+            logger.warning("Invalid UDP Data! Error: %s Data: %s", err, logs.Payload(request))
+            return server.error_answer(err, request), True
+        return answer, False
+
+    def finish(self, stream, seq, answer, failed):
+        """
+        Caches the answer for duplicates unless a newer datagram came in meanwhile.
+        """
+        self.stats["errors"] += int(failed)
+        if stream.seq == seq:
+            stream.answer = answer
+        return answer
+
+    def process(self, data, addr):
+        """
+        Returns the answer datagram or None if nothing is sent back.
+        """
+        request, stream, answer = self.admit(data, addr)
+        if request is None:
+            return answer
+        return self.finish(stream, request[wire.REQUEST_ID_KEY], *self.answer_request(request, len(data)))
+
+class UDPServer:
+    """
+    UDP listener next to one of the TCP servers, sharing their games.
+    """
+    def __init__(self, host, port, sessions=None):
+        self.host = host
+        self.port = port
+        self.sessions = sessions
+        self.transport = None
+        self.protocol = None
+        self.thread = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, self.protocol = await loop.create_datagram_endpoint(
+            lambda: UDPProtocol(self.sessions), local_addr=(self.host, self.port))
+        self.port = self.transport.get_extra_info("sockname")[1]
+        return self.transport
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def start_thread(self):
+        """
+        Serves on an event loop of its own in a daemon thread (for the threaded
+        TCP servers). Returns when the listener is bound.
+        """
+        started = threading.Event()
+        async def serve():
+            try:
+                await self.start()
+            finally:
+                started.set()
+            await asyncio.Event().wait()
+        self.thread = threading.Thread(target=asyncio.run, args=(serve(),), name="udp", daemon=True)
+        self.thread.start()
+        started.wait()
+        if self.transport is None:
+            raise OSError(f"Error: Could not listen on UDP port {self.port}!")
+        return self.thread
+
+
+##########################################################
+# Tests
+#########################################################
+
+class UDPTests(unittest.TestCase):
+    """
+    Tests for the UDP listener.
+    """
+    def setUp(self):
+        self.sessions = sessions.SessionRegistry(unit_handler=server.session_registry.unit_handler)
+        self.protocol = UDPProtocol(self.sessions)
+        self.addr = ("127.0.0.1", 5000)
+
+    def request(self, seq, request, addr=None):
+        request = dict(request, request_id=seq, session_id="udp")
+        answer = self.protocol.process(json.dumps(request).encode(), addr or self.addr)
+        return None if answer is None else wire.decode_answer(answer)
+
+    def test_sequence(self):
+        hover = {"HOVER_REQUEST": {"player": "player1", "x": 3, "y": 4}}
+        self.assertEqual(self.request(1, hover)["HOVER_REQUEST"], {"x": 3, "y": 4})
+        self.assertEqual(self.request(3, dict(hover, HOVER_REQUEST={"player": "player1", "x": 5, "y": 4}))
+                         ["HOVER_REQUEST"], {"x": 5, "y": 4})
+        # duplicates get the same answer without processing, stale datagrams none
+        self.assertEqual(self.request(3, hover)["HOVER_REQUEST"], {"x": 5, "y": 4})
+        self.assertIsNone(self.request(2, hover))
+        self.assertEqual(self.sessions.get("udp").hover["player1"], (5, 4))
+        self.assertEqual(self.request(1, hover, ("127.0.0.1", 5001))["HOVER_REQUEST"], {"x": 3, "y": 4})
+        self.assertEqual(self.protocol.stats["duplicates"], 1)
+        self.assertEqual(self.protocol.stats["stale"], 1)
+
+    def test_rejected(self):
+        answer = self.request(1, {"BOARD_REQUEST": {"filename": "test/samples/snow.board"}})
+        self.assertEqual(answer["details"]["path"], "BOARD_REQUEST")
+        answer = self.protocol.process(b'{"HEARTBEAT_REQUEST": {}}', self.addr)
+        self.assertEqual(wire.decode_answer(answer)["details"]["path"], wire.REQUEST_ID_KEY)
+        self.assertIn("details", self.request(2, {"HOVER_REQUEST": {"player": "player1"}}))
+
+    def test_server(self):
+        from .client import UDPClient
+        async def run():
+            udp_server = UDPServer("127.0.0.1", 0, self.sessions)
+            await udp_server.start()
+            client = UDPClient(udp_server.port)
+            answer = await asyncio.get_running_loop().run_in_executor(
+                None, client.request, {"HEARTBEAT_REQUEST": {"sent": 1.5}})
+            client.socket.close()
+            udp_server.close()
+            return answer
+        answer = asyncio.run(run())
+        self.assertEqual(answer["HEARTBEAT_REQUEST"]["sent"], 1.5)
+
+    def test_locked_game(self):
+        locked, release = threading.Event(), threading.Event()
+        def hold():
+            with self.sessions.get("locked").lock:
+                locked.set()
+                release.wait(5.)
+        async def run():
+            loop = asyncio.get_running_loop()
+            udp_server = UDPServer("127.0.0.1", 0, self.sessions)
+            await udp_server.start()
+            clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for k in range(2)]
+            for client in clients:
+                client.settimeout(2.)
+            holder = threading.Thread(target=hold)
+            holder.start()
+            locked.wait()
+            for client, request in zip(clients, [
+                    {"session_id": "locked", "HOVER_REQUEST": {"player": "player1", "x": 1, "y": 2}},
+                    {"session_id": "free", "HEARTBEAT_REQUEST": {}}]):
+                client.sendto(json.dumps(dict(request, request_id=1)).encode(), ("127.0.0.1", udp_server.port))
+            # the other game is answered while the locked one waits
+            answers = [wire.decode_answer(await loop.run_in_executor(None, clients[1].recv, MAX_DATAGRAM))]
+            release.set()
+            answers.append(wire.decode_answer(await loop.run_in_executor(None, clients[0].recv, MAX_DATAGRAM)))
+            holder.join()
+            for client in clients:
+                client.close()
+            udp_server.close()
+            return answers
+        heartbeat, hover = asyncio.run(run())
+        self.assertIn("HEARTBEAT_REQUEST", heartbeat)
+        self.assertEqual(hover["HOVER_REQUEST"], {"x": 1, "y": 2})
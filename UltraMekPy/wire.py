@@ -0,0 +1,592 @@
+"""
+wire.py - Classes and Tools for encoding answers on the wire
+
+Copyright © 2024 Stefan H. Reiterer.
+stefan.harald.reiterer@gmail.com
+This work is under GPL v2 as it should remain free but compatible with MekHQ
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Answers are newline terminated JSON lines. If the request asks for
+"format": "binary", large results (e.g. boards) are replaced in the JSON line
+by {"binary": [offset, length]} and appended as binary block after the line.
+The line then starts with {"BINARY": <length of the block>, ...}, so a reader
+knows how many bytes follow without parsing the whole line.
+
+With "compression": "zlib"/"deflate" or "stream": true the answer is streamed
+while it is encoded: a line {"STREAM": {"compression": ...}} is followed by
+frames (u32 big endian length + data) and a frame of length 0. The joined
+(and decompressed) frames are the plain answer described above.
+Both options stay active for all later answers of the connection.
+
+A request may carry a "request_id", which is echoed in its answer, so clients
+can match answers to requests without relying on their order. Connections
+which subscribed to a game also get event lines {"EVENT": ...} between the
+answers (see events.py).
+
+Binary layer format (all numbers little endian):
+    header: b"UMB1", u32 size_x, u32 size_y, u16 number of layers
+    layer:  u8 name length, name (ascii), u8 dtype, u8 ndim, ndim x u32 dims,
+            u32 number of bytes, data
+dtypes: 1 uint8, 2 int32, 3 utf-8 strings separated by newlines.
+Layers of strings (tile_type) are sent as codes plus a <name>_names layer.
+"""
+import json
+import re
+import struct
+import sys
+import unittest
+import zlib
+from array import array
+
+from .constants import NL
+from . import schema
+
+FORMAT_KEY = "format"
+JSON_FORMAT = "json"
+BINARY_FORMAT = "binary"
+COMPRESSION_KEY = "compression"
+STREAM_KEY = "stream"
+REQUEST_ID_KEY = "request_id"
+NO_COMPRESSION = "none"
+ZLIB = "zlib"
+DEFLATE = "deflate"
+COMPRESSION_WBITS = {ZLIB: zlib.MAX_WBITS, DEFLATE: -zlib.MAX_WBITS}
+OPTION_KEYS = (FORMAT_KEY, COMPRESSION_KEY, STREAM_KEY, REQUEST_ID_KEY)
+CONNECTION_OPTION_KEYS = (COMPRESSION_KEY, STREAM_KEY)
+
+BINARY_KEY = "binary"
+BINARY_HEADER_KEY = "BINARY"
+BINARY_PATTERN = re.compile(rb'^\{"BINARY": (\d+)')
+STREAM_HEADER_KEY = "STREAM"
+STREAM_PATTERN = re.compile(rb'^\{"STREAM": ')
+REQUEST_ID_PATTERN = re.compile(rb'^\{(?:"BINARY": \d+, |"STREAM": \{[^}]*\}, )?"request_id": ')
+MAX_ID_LENGTH = 256
+FRAME = struct.Struct(">I")
+CHUNK_SIZE = 2**16
+
+MAGIC = b"UMB1"
+HEADER = struct.Struct("<4sIIH")
+SIZE_KEYS = ("size_x", "size_y")
+NAMES_SUFFIX = "_names"
+UINT8 = 1
+INT32 = 2
+STRINGS = 3
+
+def check_options(options):
+    """
+    Raises a schema.ValidationError if the connection options of a request
+    are invalid, before they are remembered or an answer is encoded with them.
+    """
+    compression = options.get(COMPRESSION_KEY, NO_COMPRESSION)
+    if compression != NO_COMPRESSION and compression not in COMPRESSION_WBITS:
+        raise schema.ValidationError(f"Error: Unknown compression {compression}!", [COMPRESSION_KEY],
+                                     "|".join([NO_COMPRESSION] + list(COMPRESSION_WBITS)))
+    if not isinstance(options.get(STREAM_KEY, False), bool):
+        raise schema.ValidationError(f"Error: Invalid value at {STREAM_KEY}, expected bool!", [STREAM_KEY], "bool")
+
+def split_options(request):
+    """
+    Splits the wire options from a request.
+    """
+    options = {key: request[key] for key in OPTION_KEYS if key in request}
+    check_options(options)
+    if options:
+        request = {key: val for key, val in request.items() if key not in options}
+    return request, options
+
+def negotiate(request, connection_options):
+    """
+    Remembers the connection options of a request and applies the remembered
+    ones to requests which do not set them. Returns the request and whether
+    it was changed.
+    """
+    if not isinstance(request, dict):
+        return request, False
+    check_options(request)
+    for key in CONNECTION_OPTION_KEYS:
+        if key in request:
+            connection_options[key] = request[key]
+    missing = {key: val for key, val in connection_options.items() if key not in request}
+    if not missing:
+        return request, False
+    request = dict(request)
+    request.update(missing)
+    return request, True
+
+def is_streamed(options):
+    compression = options.get(COMPRESSION_KEY, NO_COMPRESSION)
+    return bool(options.get(STREAM_KEY)) or compression != NO_COMPRESSION
+
+def _flatten(layer):
+    values = []
+    for row in layer:
+        for cell in row:
+            if isinstance(cell, (list, tuple)):
+                values.extend(cell)
+            else:
+                values.append(cell)
+    return values
+
+def _dims(layer):
+    dims = [len(layer), len(layer[0]) if layer else 0]
+    if layer and layer[0] and isinstance(layer[0][0], (list, tuple)):
+        dims.append(len(layer[0][0]))
+    return dims
+
+def _encode_layer(name, dtype, dims, data):
+    name = name.encode()
+    head = struct.pack(f"<B{len(name)}sBB{len(dims)}II", len(name), name, dtype, len(dims), *dims, len(data))
+    return head + data
+
+def _encode_numbers(values):
+    if all(0 <= v < 256 for v in values):
+        return UINT8, bytes(values)
+    data = array('i', values)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return INT32, data.tobytes()
+
+def encode_layers(flat_dict):
+    """
+    Encodes a flat board dictionary (see boards.Board.to_flat_dict) as
+    typed little endian arrays.
+    """
+    layers = []
+    for name, layer in flat_dict.items():
+        if name in SIZE_KEYS:
+            continue
+        dims = _dims(layer)
+        values = _flatten(layer)
+        if values and isinstance(values[0], str):
+            names = sorted(set(values))
+            codes = {val: k for k, val in enumerate(names)}
+            dtype, data = _encode_numbers([codes[v] for v in values])
+            layers.append(_encode_layer(name, dtype, dims, data))
+            data = NL.join(names).encode()
+            layers.append(_encode_layer(name + NAMES_SUFFIX, STRINGS, [len(names)], data))
+        else:
+            dtype, data = _encode_numbers(values)
+            layers.append(_encode_layer(name, dtype, dims, data))
+    head = HEADER.pack(MAGIC, flat_dict["size_x"], flat_dict["size_y"], len(layers))
+    return head + b"".join(layers)
+
+def _nest(values, dims):
+    if len(dims) == 1:
+        return list(values)
+    step = len(values)//dims[0]
+    return [_nest(values[k*step:(k+1)*step], dims[1:]) for k in range(dims[0])]
+
+def decode_layers(data):
+    """
+    Decodes typed arrays back into a flat board dictionary.
+    """
+    data = memoryview(data)
+    magic, size_x, size_y, nr_layers = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Error: Not a binary board!")
+    pos = HEADER.size
+    raw = {}
+    for k in range(nr_layers):
+        name_len = data[pos]
+        name = bytes(data[pos+1:pos+1+name_len]).decode()
+        pos += 1 + name_len
+        dtype, ndim = data[pos], data[pos+1]
+        pos += 2
+        dims = struct.unpack_from(f"<{ndim}I", data, pos)
+        pos += 4*ndim
+        nbytes, = struct.unpack_from("<I", data, pos)
+        pos += 4
+        block = data[pos:pos+nbytes]
+        pos += nbytes
+        if dtype == STRINGS:
+            values = bytes(block).decode().split(NL) if dims[0] > 0 else []
+        elif dtype == UINT8:
+            values = list(block)
+        else:
+            values = array('i')
+            values.frombytes(block)
+            if sys.byteorder == "big":
+                values.byteswap()
+            values = values.tolist()
+        raw[name] = (dtype, dims, values)
+
+    result = {"size_x": size_x, "size_y": size_y}
+    for name, (dtype, dims, values) in raw.items():
+        if dtype == STRINGS:
+            continue
+        names = raw.get(name + NAMES_SUFFIX)
+        if names is not None:
+            values = [names[2][v] for v in values]
+        result[name] = _nest(values, dims)
+    return result
+
+def _add_binary_header(result, blobs):
+    if not blobs:
+        return result
+    header = {BINARY_HEADER_KEY: sum(len(blob) for blob in blobs)}
+    header.update(result)
+    return header
+
+class Encoded(bytes):
+    """
+    Result which is already JSON encoded (e.g. cached boards) and is put
+    into answers as it is. value holds the decoded result for consumers
+    which need the object.
+    """
+    @classmethod
+    def from_value(cls, value):
+        encoded = cls(json.dumps(value).encode())
+        encoded.value = value
+        return encoded
+
+def plain(result):
+    """
+    Returns the object of a result, no matter if it is encoded or not.
+    """
+    return result.value if isinstance(result, Encoded) else result
+
+class Buffers(list):
+    """
+    An answer as list of buffers, written with one scatter write (writelines,
+    sendmsg) instead of being joined. Pre-encoded parts (Encoded values,
+    cached binary blocks) are thus sent without being copied.
+    """
+    def nbytes(self):
+        return sum(len(buffer) for buffer in self)
+
+    def join(self):
+        return b"".join(self)
+
+def answer_size(answer):
+    """
+    Number of bytes of an encoded answer, None for streamed answers.
+    """
+    if isinstance(answer, Buffers):
+        return answer.nbytes()
+    if isinstance(answer, (bytes, bytearray, memoryview)):
+        return len(answer)
+    return None
+
+def encode_answer_buffers(result, blobs=(), options=None):
+    """
+    Like encode_answer, but answers with pre-encoded parts are returned
+    as Buffers.
+    """
+    if options and is_streamed(options):
+        return stream_answer(result, blobs, options.get(COMPRESSION_KEY, NO_COMPRESSION))
+    result = _add_binary_header(result, blobs)
+    if not blobs and not any(isinstance(val, Encoded) for val in result.values()):
+        return (json.dumps(result) + NL).encode()
+    parts = Buffers()
+    pieces = ["{"]
+    for k, (key, val) in enumerate(result.items()):
+        if k > 0:
+            pieces.append(", ")
+        pieces.append(json.dumps(key) + ": ")
+        if isinstance(val, Encoded):
+            parts.append("".join(pieces).encode())
+            parts.append(val)
+            pieces.clear()
+        else:
+            pieces.append(json.dumps(val))
+    pieces.append("}" + NL)
+    parts.append("".join(pieces).encode())
+    parts.extend(blobs)
+    return parts
+
+def encode_answer(result, blobs=(), options=None):
+    """
+    Encodes the result dictionary of a request and the binary blocks it refers to.
+    If the options ask for streaming an iterator over the frames is returned.
+    """
+    answer = encode_answer_buffers(result, blobs, options)
+    if isinstance(answer, Buffers):
+        return answer.join()
+    return answer
+
+def _json_pieces(result):
+    encoder = json.JSONEncoder()
+    yield "{"
+    for k, (key, val) in enumerate(result.items()):
+        if k > 0:
+            yield ", "
+        yield json.dumps(key) + ": "
+        if isinstance(val, Encoded):
+            yield val
+        else:
+            yield from encoder.iterencode(val)
+    yield "}" + NL
+
+def iter_answer(result, blobs=(), chunk_size=CHUNK_SIZE):
+    """
+    Encodes an answer piece by piece (the same bytes as encode_answer).
+    """
+    result = _add_binary_header(result, blobs)
+    pieces = []
+    size = 0
+    for piece in _json_pieces(result):
+        if isinstance(piece, bytes):
+            if pieces:
+                yield "".join(pieces).encode()
+                pieces.clear()
+                size = 0
+            yield piece
+            continue
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(pieces).encode()
+            pieces.clear()
+            size = 0
+    if pieces:
+        yield "".join(pieces).encode()
+    yield from blobs
+
+def _frames(data, chunk_size):
+    for k in range(0, len(data), chunk_size):
+        chunk = data[k:k+chunk_size]
+        yield FRAME.pack(len(chunk)) + chunk
+
+def stream_answer(result, blobs=(), compression=NO_COMPRESSION, chunk_size=CHUNK_SIZE):
+    """
+    Yields an answer as frames of at most chunk_size bytes, compressed on the fly.
+    """
+    if compression != NO_COMPRESSION and compression not in COMPRESSION_WBITS:
+        raise ValueError(f"Error: Unknown compression {compression}!")
+    header = {STREAM_HEADER_KEY: {COMPRESSION_KEY: compression}}
+    if REQUEST_ID_KEY in result:
+        header[REQUEST_ID_KEY] = result[REQUEST_ID_KEY]
+    yield (json.dumps(header) + NL).encode()
+    compressor = None
+    if compression != NO_COMPRESSION:
+        compressor = zlib.compressobj(wbits=COMPRESSION_WBITS[compression])
+    buffer = b""
+    for piece in iter_answer(result, blobs, chunk_size):
+        if compressor is not None:
+            piece = compressor.compress(piece)
+        buffer += piece
+        if len(buffer) >= chunk_size:
+            yield from _frames(buffer, chunk_size)
+            buffer = b""
+    if compressor is not None:
+        buffer += compressor.flush()
+    yield from _frames(buffer, chunk_size)
+    yield FRAME.pack(0)
+
+def add_blob(blobs, blob):
+    """
+    Appends a binary block and returns the reference which replaces it in the answer.
+    """
+    offset = sum(len(b) for b in blobs)
+    blobs.append(blob)
+    return {BINARY_KEY: [offset, len(blob)]}
+
+def binary_length(line):
+    """
+    Returns the number of binary bytes following an answer line.
+    """
+    match = BINARY_PATTERN.match(line)
+    return int(match.group(1)) if match else 0
+
+def answer_id(answer):
+    """
+    Returns the request id echoed at the start of an answer (None if there is
+    none) without decoding the whole answer.
+    """
+    match = REQUEST_ID_PATTERN.match(answer)
+    if match is None:
+        return None
+    text = bytes(answer[match.end():match.end()+MAX_ID_LENGTH]).decode(errors="ignore")
+    try:
+        return json.JSONDecoder().raw_decode(text)[0]
+    except ValueError:
+        return None
+
+async def read_answer(reader):
+    """
+    Reads one complete answer (line and binary block or frames) from an asyncio stream.
+    """
+    line = await reader.readline()
+    if STREAM_PATTERN.match(line):
+        parts = [line]
+        while True:
+            head = await reader.readexactly(FRAME.size)
+            parts.append(head)
+            length, = FRAME.unpack(head)
+            if length == 0:
+                return b"".join(parts)
+            parts.append(await reader.readexactly(length))
+    nbytes = binary_length(line)
+    if nbytes:
+        line += await reader.readexactly(nbytes)
+    return line
+
+def read_answer_sync(fp):
+    """
+    Reads one complete answer (line and binary block or frames) from a file like object.
+    """
+    line = fp.readline()
+    if STREAM_PATTERN.match(line):
+        parts = [line]
+        while True:
+            head = fp.read(FRAME.size)
+            parts.append(head)
+            length, = FRAME.unpack(head)
+            if length == 0:
+                return b"".join(parts)
+            parts.append(fp.read(length))
+    nbytes = binary_length(line)
+    if nbytes:
+        line += fp.read(nbytes)
+    return line
+
+def unstream(answer):
+    """
+    Joins and decompresses the frames of a streamed answer.
+    """
+    line, _, frames = answer.partition(NL.encode())
+    compression = json.loads(line)[STREAM_HEADER_KEY][COMPRESSION_KEY]
+    frames = memoryview(frames)
+    parts = []
+    pos = 0
+    while True:
+        length, = FRAME.unpack_from(frames, pos)
+        pos += FRAME.size
+        if length == 0:
+            break
+        parts.append(frames[pos:pos+length])
+        pos += length
+    data = b"".join(parts)
+    if compression != NO_COMPRESSION:
+        data = zlib.decompress(data, wbits=COMPRESSION_WBITS[compression])
+    return data
+
+def decode_answer(answer):
+    """
+    Decodes an answer and replaces references to binary blocks by their decoded content.
+    """
+    if STREAM_PATTERN.match(answer):
+        answer = unstream(answer)
+    line, _, block = answer.partition(NL.encode())
+    result = json.loads(line)
+    if result.pop(BINARY_HEADER_KEY, None) is not None:
+        for key, val in result.items():
+            if isinstance(val, dict) and BINARY_KEY in val:
+                offset, length = val[BINARY_KEY]
+                result[key] = decode_layers(block[offset:offset+length])
+    return result
+
+
+##########################################################
+# Tests
+#########################################################
+
+class WireTests(unittest.TestCase):
+    """
+    Tests for the wire format.
+    """
+    def setUp(self):
+        self.flat = {"size_x": 2, "size_y": 3,
+                     "heights": [[0,-1,2],[3,400,5]],
+                     "woods": [[0,1,0],[0,0,2]],
+                     "road": [[[0,0],[1,2],[0,0]],[[0,0],[0,0],[3,4]]],
+                     "tile_type": [["snow","snow",""],["grass","snow","snow"]]}
+
+    def test_encode_layers(self):
+        data = encode_layers(self.flat)
+        self.assertTrue(data.startswith(MAGIC))
+        self.assertEqual(decode_layers(data), self.flat)
+
+    def test_split_options(self):
+        request, options = split_options({FORMAT_KEY: BINARY_FORMAT, "BOARD_REQUEST": {}})
+        self.assertEqual(request, {"BOARD_REQUEST": {}})
+        self.assertEqual(options, {FORMAT_KEY: BINARY_FORMAT})
+        for invalid in ({COMPRESSION_KEY: "lzma"}, {STREAM_KEY: "yes"}):
+            with self.assertRaises(schema.ValidationError):
+                split_options(dict(invalid, BOARD_REQUEST={}))
+
+    def test_encode_answer(self):
+        blobs = []
+        result = {"BOARD_REQUEST": add_blob(blobs, encode_layers(self.flat)), "OTHER": 1}
+        answer = encode_answer(result, blobs)
+        self.assertEqual(binary_length(answer), len(blobs[0]))
+        self.assertEqual(decode_answer(answer), {"BOARD_REQUEST": self.flat, "OTHER": 1})
+        answer = encode_answer({"OTHER": 1})
+        self.assertEqual(binary_length(answer), 0)
+        self.assertEqual(decode_answer(answer), {"OTHER": 1})
+
+    def test_iter_answer(self):
+        blobs = []
+        result = {"BOARD_REQUEST": add_blob(blobs, encode_layers(self.flat)), "OTHER": self.flat}
+        self.assertEqual(b"".join(iter_answer(result, blobs, chunk_size=16)), encode_answer(result, blobs))
+        result = {"BOARD_REQUEST": Encoded.from_value(self.flat), "OTHER": self.flat}
+        self.assertEqual(b"".join(iter_answer(result, chunk_size=16)), encode_answer(result))
+
+    def test_buffers(self):
+        encoded = Encoded.from_value(self.flat)
+        blob = encode_layers(self.flat)
+        blobs = []
+        result = {REQUEST_ID_KEY: 1, "BOARD_REQUEST": encoded, "OTHER": add_blob(blobs, blob)}
+        answer = encode_answer_buffers(result, blobs)
+        self.assertIsInstance(answer, Buffers)
+        self.assertIs(answer[1], encoded)
+        self.assertIs(answer[-1], blob)
+        self.assertEqual(answer.join(), encode_answer(result, blobs))
+        self.assertEqual(answer_size(answer), len(answer.join()))
+        self.assertIsInstance(encode_answer_buffers({"OTHER": 1}), bytes)
+        self.assertIsNone(answer_size(encode_answer_buffers({"OTHER": 1}, options={STREAM_KEY: True})))
+
+    def test_encoded(self):
+        encoded = Encoded.from_value(self.flat)
+        self.assertIs(plain(encoded), self.flat)
+        self.assertIs(plain(self.flat), self.flat)
+        answer = encode_answer({"BOARD_REQUEST": encoded, "OTHER": 1})
+        self.assertEqual(answer, encode_answer({"BOARD_REQUEST": self.flat, "OTHER": 1}))
+
+    def test_stream_answer(self):
+        blobs = []
+        result = {"BOARD_REQUEST": add_blob(blobs, encode_layers(self.flat)), "OTHER": self.flat}
+        plain = encode_answer(result, blobs)
+        for compression in (NO_COMPRESSION, ZLIB, DEFLATE):
+            frames = list(stream_answer(result, blobs, compression, chunk_size=32))
+            self.assertTrue(all(len(frame) <= 32 + FRAME.size for frame in frames[1:]))
+            answer = b"".join(frames)
+            self.assertEqual(unstream(answer), plain)
+            self.assertEqual(decode_answer(answer), decode_answer(plain))
+        with self.assertRaises(ValueError):
+            list(stream_answer(result, blobs, "lzma"))
+
+    def test_answer_id(self):
+        blobs = []
+        result = {REQUEST_ID_KEY: 7, "BOARD_REQUEST": add_blob(blobs, encode_layers(self.flat))}
+        self.assertEqual(answer_id(encode_answer(result, blobs)), 7)
+        self.assertEqual(answer_id(b"".join(stream_answer(result, blobs, ZLIB))), 7)
+        self.assertEqual(answer_id(encode_answer({REQUEST_ID_KEY: "a,b", "OTHER": 1})), "a,b")
+        self.assertIsNone(answer_id(encode_answer({"OTHER": 1, REQUEST_ID_KEY: 7})))
+        self.assertEqual(decode_answer(encode_answer(result, blobs))[REQUEST_ID_KEY], 7)
+
+    def test_negotiate(self):
+        connection = {}
+        request, changed = negotiate({COMPRESSION_KEY: ZLIB, "A": 1}, connection)
+        self.assertFalse(changed)
+        self.assertEqual(connection, {COMPRESSION_KEY: ZLIB})
+        request, changed = negotiate({"A": 1}, connection)
+        self.assertTrue(changed)
+        self.assertEqual(request, {COMPRESSION_KEY: ZLIB, "A": 1})
+        # invalid options are not remembered
+        with self.assertRaises(schema.ValidationError):
+            negotiate({COMPRESSION_KEY: "lzma", "A": 1}, connection)
+        self.assertEqual(connection, {COMPRESSION_KEY: ZLIB})
@@ -29,9 +29,9 @@ sys.path.append(os.getcwd())
 
 import unittest
 import UltraMekPy
-from UltraMekPy import boards, functions, parsers, data, player, rolls, game
+from UltraMekPy import boards, functions, parsers, data, player, rolls, game, server, sessions, cluster, batch, wire, logs, metrics, benchmark, client, schema, events, udp, journal, replay
 
-MODULES = [boards,data,functions,parsers,player,rolls,game]
+MODULES = [boards,data,functions,parsers,player,rolls,game,server,sessions,cluster,batch,wire,logs,metrics,benchmark,client,schema,events,udp,journal,replay]
 
 if __name__ == "__main__":
     loader = unittest.TestLoader()